@@ -5,6 +5,12 @@ from .mixins import ProducerMixin, ConsumerMixin
 
 from .consumer import ConsumerClient, ConsumerServer
 from .producer import ProducerClient, ProducerServer
+from .peer import PeerClient, PeerServer, PeerNode
+from .relay import (
+    Relay, RelayConsumerClient, RelayConsumerServer, RelayProducerClient,
+    RelayProducerServer,
+)
+from .broker import Broker
 
 
 def generate_id():
@@ -22,5 +28,14 @@ __all__ = [
     'ConsumerServer',
     'ProducerClient',
     'ProducerServer',
+    'PeerClient',
+    'PeerServer',
+    'PeerNode',
+    'Relay',
+    'RelayConsumerClient',
+    'RelayConsumerServer',
+    'RelayProducerClient',
+    'RelayProducerServer',
+    'Broker',
     'generate_id',
 ]
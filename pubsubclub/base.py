@@ -1,14 +1,44 @@
 import json
+import time
+from collections import deque
 try:
     from weakref import WeakSet
 except ImportError:
     from weakrefset import WeakSet
 
 from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
 from twisted.internet.protocol import ReconnectingClientFactory
+from twisted.internet.task import LoopingCall
 
 from autobahn.twisted import websocket
 
+from . import heartbeat, monitor
+from .capture import Recorder
+from .codec import FAILED, PENDING, Offload
+from .dedup import DedupWindow, OriginTagger
+from .directory import LocalSessions, SessionDirectory
+from .deltas import BASELINE_SIZE, DeltaEncoder
+from .filters import FilterCache
+from .hitters import HeavyHitters
+from .fragments import (
+    FRAGMENT_PREFIX, FRAGMENT_SIZE, MAX_MESSAGE_SIZE, OVERSIZE_FACTOR,
+    Fragments, Reassembly, parse_fragment,
+)
+from .outbound import (
+    OutboundQueue, OutboundStats, PriorityClasses, TopicWeights, is_data,
+)
+from .ratelimit import DROP, RateLimiter
+from .retain import RETAIN_SIZE, LastValueCache
+from .ring import HashRing
+from .stats import Counters
+from .topics import SubscriberCounts, TopicTable
+
+
+DRAIN_TIMEOUT = 30.0  # Seconds before connections still draining are dropped
+DRAIN_POLL = 0.1  # Seconds between checks for the connections left to drain
+
 
 class ProtocolBase(object):
     """
@@ -19,14 +49,74 @@ class ProtocolBase(object):
     CALLBACK_MAP = {
         101: 'onDeclaredVersions',
         102: 'onVersionChosen',
+        104: 'onResume',
+        105: 'onDrain',
         201: 'onSubscribe',
         202: 'onUnsubscribe',
+        203: 'onSubscribeAlias',
+        204: 'onSubscribeFilter',
+        205: 'onResync',
+        206: 'onSessions',
         301: 'onPublish',
+        302: 'onFragment',
+        303: 'onDelta',
     }
 
     #: Set to true after handshake is completed.
     ready = False
 
+    #: Protocol extensions supported by this side.  Extensions are negotiated
+    #: during the handshake from version 1.2 onwards.
+    EXTENSIONS = frozenset(['fragments', 'drain'])
+
+    #: The extensions agreed upon for this connection.
+    extensions = frozenset()
+
+    #: The ID of the node on the other end of the connection, once known.
+    remote_id = None
+
+    #: The :class:`pubsubclub.heartbeat.Liveness` of the connection, for the
+    #: side sending the pings.
+    liveness = None
+
+    #: The :class:`pubsubclub.outbound.OutboundQueue` of publishes waiting
+    #: for the transport to drain.
+    outbound = None
+
+    #: Set while the transport is backlogged.
+    paused = False
+
+    #: The :class:`pubsubclub.fragments.Reassembly` of incoming fragments,
+    #: created with the first one.
+    reassembly = None
+
+    #: The ID of the last message we split into fragments.
+    fragment_id = 0
+
+    #: The size of the message being received, in bytes.
+    message_size = 0
+
+    #: Set if the reactor monitor times our callbacks, see
+    #: :mod:`pubsubclub.monitor`.
+    monitored = False
+
+    #: Set once we're leaving the other party, see :meth:`drain`.
+    draining = False
+
+    #: Set once the other party told us it's leaving with PSC105.
+    drained = False
+
+    #: Set once we acknowledged the other party leaving with PSC105.
+    drain_acknowledged = False
+
+    #: The messages received behind one being decoded by the worker pool,
+    #: as ``[size, message]`` entries (see :mod:`pubsubclub.codec`).
+    decoding = None
+
+    #: The publications to send behind one being encoded by the worker pool,
+    #: as ``[topic, serialized]`` entries.
+    encoding = None
+
     def onConnect(self, request):
         """
         When a connection is made, remove node from ``starting_nodes`` (if
@@ -34,6 +124,16 @@ class ProtocolBase(object):
 
         """
         self.factory.nodes.add(self)
+        self.outbound = OutboundQueue(
+            self.factory.priority_classes, self.factory.topic_weights,
+            self.factory.outbound_stats,
+        )
+        # Have the transport tell us when it's backlogged, so publishes can
+        # be held back in favor of control messages.
+        self.registerProducer(self, True)
+        if self.factory.monitor_reactor:
+            self.monitored = True
+            monitor.MONITOR.register(self)
 
     def onClose(self, clean, code, reason):
         """
@@ -43,34 +143,334 @@ class ProtocolBase(object):
         log.msg('Lost connection!  Discarding self from nodes.')
         log.msg('Reason:  {0}'.format(reason))
         self.factory.nodes.discard(self)
+        self.leave_ring()
+        if self.monitored:
+            monitor.MONITOR.unregister(self)
+        if self.outbound is not None:
+            self.outbound.clear()
+        if self.reassembly is not None:
+            self.reassembly.clear()
+        self.decoding = self.encoding = None
         if clean:
             log.msg('Connection was closed cleanly.')
             self.factory.clean_close = True
 
     def onMessage(self, payload, is_binary):
+        max_size = self.factory.max_message_size
+        if max_size and len(payload) > max_size:
+            log.msg(
+                'Dropping message of {0} bytes, exceeds {1}.'.format(
+                    len(payload), max_size,
+                )
+            )
+            return
+        self.receive(payload)
+
+    def receive(self, payload, current=False):
+        """
+        Parse an incoming action and process it, in the order received.
+        Large payloads are parsed by the worker pool if the container
+        offloads them, but fragments never are.
+
+        :param current:  Whether the payload stands for the message being
+            processed (as a reassembled message does), rather than the last
+            one received.
+        :type current:  bool
+
+        """
+        offload = self.factory.offload
+        if payload.startswith(FRAGMENT_PREFIX):
+            loads, pooled = parse_fragment, False
+        else:
+            loads = json.loads
+            pooled = offload is not None and offload.decodes(len(payload))
+        if not pooled and (current or not self.decoding):
+            self.process(len(payload), loads(payload))
+            return
+        entry = [len(payload), PENDING]
+        if self.decoding is None:
+            self.decoding = deque()
+        if current:
+            self.decoding.appendleft(entry)
+        else:
+            self.decoding.append(entry)
+        if not pooled:
+            entry[1] = loads(payload)
+            return
+        queue = self.decoding
+
+        def decoded(message):
+            entry[1] = message
+            if queue is self.decoding:
+                self.process_decoded()
+
+        def failed(failure):
+            log.err(failure, 'Failed to decode message')
+            decoded(FAILED)
+
+        offload.pool.decode(payload).addCallbacks(decoded, failed)
+
+    def process_decoded(self):
+        """
+        Process the messages received, up to the next one still being decoded
+        by the worker pool.
+
         """
-        Receive and parse an incoming action.
+        while self.decoding and self.decoding[0][1] is not PENDING:
+            size, obj = self.decoding.popleft()
+            if obj is not FAILED:
+                self.process(size, obj)
 
+    def process(self, size, obj):
         """
-        obj = json.loads(payload)
+        Process an incoming action, timing its callback if monitored.
+
+        """
+        self.message_size = size
         action, params = obj[0], obj[1:]
         callback = self.CALLBACK_MAP[action]
-        getattr(self, callback)(*params)
+        if not self.monitored:
+            getattr(self, callback)(*params)
+            return
+        started = time.time()
+        try:
+            getattr(self, callback)(*params)
+        finally:
+            monitor.MONITOR.record(callback, time.time() - started, self.peer)
 
     def send(self, action, *params):
         """
-        Trigger an action to send to the other party.
+        Trigger an action to send to the other party.  Control messages are
+        written immediately, publications are queued behind the ones already
+        waiting for the transport (see :meth:`send_data`).
+
+        """
+        if is_data(action):
+            self.send_data(params[0], action, *params)
+            return
+        self.sendMessage(json.dumps([action] + list(params)), False)
+
+    def send_data(self, topic, action, *params):
+        """
+        Queue a publication for the topic to send to the other party.  It's
+        encoded by the worker pool if the container offloads the topic.
+
+        :returns:  The size of the encoded publication, or ``None`` if it's
+            being encoded by the worker pool.
+        :rtype:  int
+
+        """
+        message = [action] + list(params)
+        offload = self.factory.offload
+        pooled = offload is not None and offload.encodes(topic)
+        if not pooled and not self.encoding:
+            serialized = json.dumps(message)
+            self.queue_data(topic, serialized)
+            return len(serialized)
+        entry = [topic, PENDING]
+        if self.encoding is None:
+            self.encoding = deque()
+        self.encoding.append(entry)
+        if not pooled:
+            entry[1] = json.dumps(message)
+            return len(entry[1])
+        queue = self.encoding
+
+        def encoded(serialized):
+            entry[1] = serialized
+            if queue is self.encoding:
+                self.queue_encoded()
+
+        def failed(failure):
+            log.err(failure, 'Failed to encode message')
+            encoded(FAILED)
+
+        offload.pool.encode(message).addCallbacks(encoded, failed)
+
+    def queue_encoded(self):
+        """
+        Queue the publications encoded, up to the next one still being
+        encoded by the worker pool.
 
         """
-        serialized = json.dumps([action] + list(params))
-        self.sendMessage(serialized, False)
+        while self.encoding and self.encoding[0][1] is not PENDING:
+            topic, serialized = self.encoding.popleft()
+            if serialized is not FAILED:
+                self.queue_data(topic, serialized)
+        if not self.encoding and (self.draining or self.drained):
+            self.drain_flushed()
 
-    def ready(self):
+    def queue_data(self, topic, serialized):
+        """
+        Queue an encoded publication for the topic.
+
+        """
+        if self.factory.offload is not None:
+            self.factory.offload.encoded(topic, len(serialized))
+        if self.outbound is None:
+            self.sendMessage(serialized, False)
+            return
+        max_size = self.factory.max_message_size
+        if max_size and len(serialized) > max_size:
+            log.msg(
+                'Not sending message of {0} bytes, exceeds {1}.'.format(
+                    len(serialized), max_size,
+                )
+            )
+            return
+        if self.factory.hitters is not None:
+            self.factory.hitters.add('sent_bytes', topic, len(serialized))
+        if 'fragments' in self.extensions and len(serialized) > FRAGMENT_SIZE:
+            self.fragment_id += 1
+            serialized = Fragments(topic, self.fragment_id, serialized)
+        self.outbound.push(topic, serialized)
+        self.flush()
+
+    def onFragment(self, id, final, chunk):
+        """
+        Receive a fragment of a message, processing the message once it's
+        complete.
+
+        """
+        if self.reassembly is None:
+            self.reassembly = Reassembly(self.factory.max_message_size)
+        payload = self.reassembly.add(id, final, chunk)
+        if payload is not None:
+            self.receive(payload, current=True)
+
+    def flush(self):
+        """
+        Write queued publications until the transport is backlogged.
+
+        """
+        while self.outbound and not self.paused:
+            self.sendMessage(self.outbound.pop(), False)
+        if self.draining or self.drained:
+            self.drain_flushed()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        self.flush()
+
+    def stopProducing(self):
+        self.paused = True
+
+    def set_ready(self):
         """
         Mark this connection as having successfully shook hands.
 
         """
         self.ready = True
+        if self.factory.draining:
+            self.drain()
+
+    def drain(self):
+        """
+        Leave the other party gracefully:  tell it to stop routing to us with
+        PSC105, and close the connection once the publishes queued for it are
+        written and it has acknowledged.  Connections still opening are
+        drained once the handshake is complete.
+
+        """
+        if self.draining or self.state != self.STATE_OPEN:
+            return
+        self.draining = True
+        if not self.factory.isServer:
+            self.factory.stopTrying()
+        if self.ready and 'drain' in self.extensions and not self.drained:
+            self.send(105)
+        self.drain_flushed()
+
+    def onDrain(self):
+        """
+        The other party is leaving, or acknowledges us leaving.  Stop routing
+        to it and don't reconnect to it, then acknowledge once the publishes
+        queued for it are written.
+
+        """
+        self.drained = True
+        if not self.draining:
+            log.msg('Node {0} is draining.'.format(self.remote_id))
+            self.factory.counters.incr('drain.received')
+            if not self.factory.isServer:
+                self.factory.drained = True
+                self.factory.stopTrying()
+            self.leave_ring()
+        self.drain_flushed()
+
+    def drain_flushed(self):
+        """
+        Once the publishes queued are written, acknowledge the other party
+        leaving, or close the connection if we're leaving.
+
+        """
+        if self.outbound or self.encoding:
+            return
+        if self.draining:
+            if (
+                    self.drained or not self.ready or
+                    'drain' not in self.extensions
+            ):
+                self.sendClose()
+        elif self.drained and not self.drain_acknowledged:
+            self.drain_acknowledged = True
+            self.send(105)
+
+    def send_sessions(self, added, removed=(), full=False):
+        """
+        Announce the WAMP sessions of the end users, which only consumers do
+        (see :mod:`pubsubclub.directory`).
+
+        """
+
+    def handshake_options(self):
+        """
+        The options sent alongside the handshake from version 1.2 onwards.
+
+        """
+        return {
+            'id': self.factory.id,
+            'extensions': sorted(self.EXTENSIONS),
+        }
+
+    def join_ring(self):
+        """
+        Add the node to the hash ring of a brokered container.
+
+        """
+        ring = self.factory.ring
+        if ring is not None and self.remote_id is not None:
+            ring.add(self.remote_id)
+
+    def leave_ring(self):
+        """
+        Remove the node from the hash ring of a brokered container, unless
+        another connection to it remains, and move its topics elsewhere.
+
+        """
+        ring = self.factory.ring
+        if ring is None or self.remote_id not in ring:
+            return
+        for node in self.factory.nodes:
+            if (
+                    node.remote_id == self.remote_id and node.ready and
+                    not node.drained
+            ):
+                return
+        ring.remove(self.remote_id)
+        self.factory.rebalance()
+
+    def negotiate(self, options):
+        """
+        Agree on the extensions to use, given the options sent by the other
+        party.
+
+        """
+        offered = set((options or {}).get('extensions', ()))
+        self.extensions = self.EXTENSIONS & offered
 
 
 class ClientFactory(
@@ -82,12 +482,19 @@ class ClientFactory(
     #: on unclean closures.
     clean_close = False
 
+    #: The ID of the node we're connecting to, if it was known beforehand.
+    remote_id = None
+
+    #: Set when the server drained the connection (see
+    #: :meth:`ProtocolBase.onDrain`), which isn't reestablished.
+    drained = False
+
     def clientConnectionFailed(self, connector, reason):
         """
         If we fail to connect, try try again.
 
         """
-        if not self.clean_close:
+        if not self.clean_close and self.continueTrying:
             log.msg("Connection failed, attempting to reconnect.")
             self.retry(connector)
 
@@ -96,7 +503,9 @@ class ClientFactory(
         If we lose the connection, attempt to reestablish it.
 
         """
-        if not self.clean_close:
+        if self.drained:
+            self.drained_nodes.add((self.host, self.port))
+        if not self.clean_close and self.continueTrying:
             log.msg("Connection lost, attempting to reconnect.")
             self.retry(connector)
 
@@ -108,11 +517,131 @@ class ClientFactory(
     def id(self):
         return self.container.id
 
+    @property
+    def processor(self):
+        return self.container.processor
 
-class ClientBase(object):
-    #: The client factory.  Use for connecting to a server.
-    factory = None
+    @property
+    def priority_classes(self):
+        return self.container.priority_classes
+
+    @property
+    def topic_weights(self):
+        return self.container.topic_weights
+
+    @property
+    def outbound_stats(self):
+        return self.container.outbound_stats
+
+    @property
+    def max_message_size(self):
+        return self.container.max_message_size
+
+    @property
+    def topics(self):
+        return self.container.topics
+
+    @property
+    def sessions(self):
+        return self.container.sessions
+
+    @property
+    def resume_states(self):
+        return self.container.resume_states
+
+    @property
+    def detached_sessions(self):
+        return self.container.detached_sessions
+
+    @property
+    def subscribers(self):
+        return self.container.subscribers
+
+    @property
+    def counters(self):
+        return self.container.counters
+
+    @property
+    def last_values(self):
+        return self.container.last_values
+
+    @property
+    def topic_filters(self):
+        return self.container.topic_filters
+
+    @property
+    def filter_cache(self):
+        return self.container.filter_cache
+
+    @property
+    def deltas(self):
+        return self.container.deltas
+
+    @property
+    def ring(self):
+        return self.container.ring
+
+    @property
+    def dedup(self):
+        return self.container.dedup
+
+    @property
+    def hitters(self):
+        return self.container.hitters
+
+    @property
+    def monitor_reactor(self):
+        return self.container.monitor_reactor
+
+    @property
+    def recorder(self):
+        return self.container.recorder
+
+    @property
+    def origin_tagger(self):
+        return self.container.origin_tagger
+
+    @property
+    def draining(self):
+        return self.container.draining
+
+    @property
+    def offload(self):
+        return self.container.offload
+
+    @property
+    def directory(self):
+        return self.container.directory
+
+    @property
+    def local_sessions(self):
+        return self.container.local_sessions
 
+    @property
+    def drained_nodes(self):
+        return self.container.drained_nodes
+
+    def rebalance(self):
+        self.container.rebalance()
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        self.container.forward(topic, message, via, origin, targets)
+
+    def subscribed_topics(self):
+        return self.container.subscribed_topics()
+
+    def subscriptions_changed(self, topics):
+        self.container.subscriptions_changed(topics)
+
+    def sessions_changed(self, located, gone):
+        self.container.sessions_changed(located, gone)
+
+
+class ContainerBase(object):
+    """
+    Functionality shared by the client and server containers.
+
+    """
     #: A :class:`set` of :class:`ProtocolBase` for each connection to a node.
     nodes = None
 
@@ -120,47 +649,372 @@ class ClientBase(object):
     #: users.
     processor = None
 
-    def __init__(self, nodes=tuple(), id=None):
-        self.factory.container = self
+    #: Set once the container is leaving the cluster, see :meth:`drain`.
+    draining = False
+
+    #: The attributes holding the state of the container, as set up by
+    #: :meth:`setup`.
+    STATE = (
+        'nodes', 'id', 'priority_classes', 'max_message_size', 'topics',
+        'sessions', 'detached_sessions', 'subscribers', 'resume_states',
+        'counters', 'last_values', 'topic_filters', 'filter_cache', 'deltas',
+        'ring', 'dedup', 'origin_tagger', 'hitters', 'recorder',
+        'rate_limiter', 'drained_nodes', 'offload', 'directory',
+        'local_sessions', 'topic_weights', 'outbound_stats', 'monitor_reactor',
+    )
+
+    def setup(
+            self, id=None, priorities=tuple(),
+            max_message_size=MAX_MESSAGE_SIZE, retain=tuple(),
+            retain_size=RETAIN_SIZE, deltas=tuple(),
+            baseline_size=BASELINE_SIZE, brokered=False, dedup=False,
+            hitters_interval=None, capture=None,
+            capture_payloads=True, rate_limits=tuple(),
+            session_rate_limit=None, throttle=DROP, offload_size=None,
+            weights=tuple(), monitor_reactor=False,
+    ):
+        """
+        Set up the container.
+
+        :param id:  The ID of the node.
+        :type id:  int
+        :param priorities:  Pairs of topic prefix and priority class for
+            publishes, see :class:`pubsubclub.outbound.PriorityClasses`.
+        :type priorities:  list of (str, int) tuples
+        :param max_message_size:  The largest message to send or receive, in
+            bytes.  Larger messages are dropped, and connections receiving
+            one :data:`pubsubclub.fragments.OVERSIZE_FACTOR` times larger are
+            failed by Autobahn rather than buffering it whole.
+        :type max_message_size:  int
+        :param retain:  For producers, the prefixes of the topics whose last
+            message is sent to new subscribers, see
+            :class:`pubsubclub.retain.LastValueCache`.
+        :type retain:  list of str
+        :param retain_size:  The memory to use for retained messages, in
+            bytes.
+        :type retain_size:  int
+        :param deltas:  For producers, the prefixes of the topics to send as
+            patches of the previous message, see :mod:`pubsubclub.deltas`.
+        :type deltas:  list of str
+        :param baseline_size:  The memory to use for the previous messages of
+            delta encoded topics, per connection, in bytes.
+        :type baseline_size:  int
+        :param brokered:  For clients, whether the servers are brokers which
+            the topics are sharded between, see :mod:`pubsubclub.broker`.
+        :type brokered:  bool
+        :param dedup:  For consumers, whether to drop the publishes already
+            received along another path, see :mod:`pubsubclub.dedup`.
+        :type dedup:  bool
+        :param hitters_interval:  The seconds between logs of the heaviest
+            topics (see :mod:`pubsubclub.hitters`), or ``None`` not to track
+            them.
+        :type hitters_interval:  float
+        :param capture:  A file to record the traffic to, see
+            :mod:`pubsubclub.capture`.
+        :type capture:  str
+        :param capture_payloads:  Whether to record the messages, rather than
+            just their size.
+        :type capture_payloads:  bool
+        :param rate_limits:  For producers, triples of topic prefix, rate
+            (messages per second) and burst limiting the messages of each
+            topic published by local sessions, see
+            :mod:`pubsubclub.ratelimit`.
+        :type rate_limits:  list of (str, float, int) tuples
+        :param session_rate_limit:  For producers, the rate and burst limiting
+            the messages of each local session.
+        :type session_rate_limit:  tuple
+        :param throttle:  ``'drop'`` or ``'delay'`` the messages over a rate
+            limit.
+        :type throttle:  str
+        :param offload_size:  The bytes of JSON above which messages are
+            encoded and decoded by worker processes rather than the reactor
+            thread (see :mod:`pubsubclub.codec`), or ``None`` not to use
+            them.
+        :type offload_size:  int
+        :param weights:  Pairs of topic prefix and weight, sharing congested
+            connections between the topics of a priority class, see
+            :class:`pubsubclub.outbound.TopicWeights`.
+        :type weights:  list of (str, float) tuples
+        :param monitor_reactor:  Whether to measure the reactor lag and the
+            time spent in the callbacks of the connections, see
+            :mod:`pubsubclub.monitor`.
+        :type monitor_reactor:  bool
+
+        """
         self.nodes = WeakSet()
         self.id = id
+        self.priority_classes = PriorityClasses(priorities)
+        self.topic_weights = TopicWeights(weights)
+        self.outbound_stats = OutboundStats()
+        self.max_message_size = max_message_size
+        self.topics = TopicTable()
+        #: Producer sessions (see :mod:`pubsubclub.resume`) by consumer ID.
+        self.sessions = dict()
+        #: The sessions of disconnected consumers, by consumer ID.
+        self.detached_sessions = dict()
+        #: For producers, the topics consumers are subscribed to.
+        self.subscribers = SubscriberCounts()
+        #: Consumer resume states by producer ID.
+        self.resume_states = dict()
+        self.counters = Counters()
+        self.last_values = LastValueCache(retain, retain_size)
+        #: For consumers, the filters subscribed with by topic.
+        self.topic_filters = dict()
+        #: For producers, the filters consumers subscribed with.
+        self.filter_cache = FilterCache()
+        self.deltas = DeltaEncoder(deltas, baseline_size)
+        #: For brokered clients, the ring of the brokers connected to.
+        self.ring = HashRing() if brokered else None
+        #: For consumers, the origins of the publishes received, if dropping
+        #: duplicates.
+        self.dedup = DedupWindow() if dedup else None
+        #: For producers, tags publishes with their origin.
+        self.origin_tagger = None if id is None else OriginTagger(id)
+        self.hitters = None
+        if hitters_interval is not None:
+            self.hitters = HeavyHitters(interval=hitters_interval)
+        self.monitor_reactor = monitor_reactor
+        self.recorder = None
+        if capture is not None:
+            self.recorder = Recorder(capture, capture_payloads)
+        self.rate_limiter = RateLimiter(
+            rate_limits, session_rate_limit, throttle,
+        )
+        #: For clients, the ``(host, port)`` of the servers which drained
+        #: their connection, until connected to again.
+        self.drained_nodes = set()
+        #: For producers, the consumers hosting each WAMP session.
+        self.directory = SessionDirectory()
+        #: For consumers, the WAMP sessions of the end users.
+        self.local_sessions = LocalSessions(self.announce_sessions)
+        self.offload = None
+        if offload_size is not None:
+            self.offload = Offload(offload_size)
+            # Before listening, so the workers don't inherit the socket.
+            self.offload.pool.start()
+
+    def share_state(self, container):
+        """
+        Make another container use the state of this one.
+
+        """
+        for name in self.STATE:
+            setattr(container, name, getattr(self, name))
+
+    def rebalance(self):
+        """
+        Move topics between connections after the hash ring has changed.
+
+        """
+
+    def announce_sessions(self, added, removed):
+        """
+        Tell the producers about the WAMP sessions of the end users added and
+        removed, see :mod:`pubsubclub.directory`.
+
+        """
+        for node in self.nodes:
+            node.send_sessions(added, removed)
+
+    def stats(self):
+        """
+        The counters of the container, the statistics of the outbound queues
+        (see :class:`pubsubclub.outbound.OutboundStats`) and those of the
+        worker pool if it's in use.
+
+        """
+        stats = self.counters.snapshot()
+        stats.update(self.outbound_stats.snapshot(
+            [node.outbound for node in self.nodes
+             if node.outbound is not None],
+            self.priority_classes.count,
+        ))
+        if self.offload is not None:
+            for name, value in self.offload.pool.stats().items():
+                stats['codec.' + name] = value
+        return stats
+
+    def rtt_stats(self):
+        """
+        Round-trip time statistics for each connection, keyed by the peer
+        address.
+
+        """
+        return heartbeat.rtt_stats(self.nodes)
+
+    def reactor_stats(self):
+        """
+        Reactor lag and protocol callback durations, shared by every
+        container of the process monitoring the reactor (see
+        :mod:`pubsubclub.monitor`).
+
+        """
+        return monitor.MONITOR.stats()
+
+    def top_topics(self):
+        """
+        The heaviest topics by metric since they were last logged, see
+        :class:`pubsubclub.hitters.HeavyHitters`.  Empty unless tracked.
+
+        """
+        if self.hitters is None:
+            return dict()
+        return self.hitters.top()
+
+    def websocket_options(self):
+        """
+        The Autobahn protocol options of the container's connections.
+
+        """
+        return {
+            'maxMessagePayloadSize': (
+                (self.max_message_size or 0) * OVERSIZE_FACTOR
+            ),
+        }
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Leave the cluster gracefully, e.g. before a restart.  Every connected
+        node is told to stop routing to this one and not to reconnect to it,
+        and each connection is closed once the publishes queued for it are
+        written (see :meth:`ProtocolBase.drain`).  No connections are made
+        from then on.
+
+        :param timeout:  The seconds after which the connections still open
+            are dropped.
+        :type timeout:  float
+
+        :returns:  A deferred which fires once every connection is closed.
+
+        """
+        self.draining = True
+        for node in list(self.nodes):
+            node.drain()
+        deadline = reactor.seconds() + timeout
+        done = Deferred()
+
+        def check():
+            if not self.nodes:
+                polling.stop()
+                done.callback(None)
+            elif reactor.seconds() >= deadline:
+                log.msg('Dropping {0} connections still draining.'.format(
+                    len(self.nodes),
+                ))
+                for node in list(self.nodes):
+                    node.dropConnection(abort=True)
+
+        polling = LoopingCall(check)
+        polling.start(DRAIN_POLL)
+        return done
+
+
+class ClientBase(ContainerBase):
+    #: The client factory.  Use for connecting to a server.
+    factory = None
+
+    def __init__(self, nodes=tuple(), id=None, **kwargs):
+        # A factory class of our own, as containers of the same class each
+        # have their own state.
+        self.factory = type(
+            self.factory.__name__, (self.factory,), {'container': self},
+        )
+        #: The factories of the connections made, including those waiting to
+        #: reconnect.
+        self.factories = WeakSet()
+        self.setup(id, **kwargs)
         for host, port in nodes:
             self.connect(host, port)
 
-    def connect(self, host, port):
+    def connect(self, host, port, id=None):
         """
         Make a connection to a server.
 
+        :param id:  The ID of the remote node, if known (e.g. from discovery
+            metadata).  If it matches our own ID the connection is skipped
+            entirely, rather than being closed after the handshake.
+        :type id:  int
+
         """
+        if is_self(self.id, id):
+            log.msg(
+                'pubsubclub:  Not connecting to {0}:{1}, it is ourself.'
+                .format(host, port)
+            )
+            return
+        if self.draining:
+            log.msg(
+                'pubsubclub:  Not connecting to {0}:{1}, draining.'.format(
+                    host, port,
+                )
+            )
+            return
+        self.drained_nodes.discard((host, port))
         url = 'ws://{0}:{1}/'.format(host, port)
         log.msg('pubsubclub:  Connecting to %s' % url)
-        websocket.connectWS(self.factory(url))
+        factory = self.factory(url)
+        factory.remote_id = id
+        factory.setProtocolOptions(**self.websocket_options())
+        self.factories.add(factory)
+        websocket.connectWS(factory)
 
     def disconnect(self, host, port):
         """
-        Lose a previously made connection.
+        Lose a previously made connection, and stop reconnecting to the
+        server, including while waiting to retry.
 
         """
+        for factory in list(self.factories):
+            if factory.host == host and factory.port == port:
+                factory.stopTrying()
         for node in self.nodes:
+            if node.factory.isServer:
+                continue
             if node.factory.host == host and node.factory.port == port:
                 node.sendClose()
 
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Stop reconnecting, including to the servers we're not connected to at
+        the moment, then drain the connections (see
+        :meth:`ContainerBase.drain`).
 
-class ServerBase(websocket.WebSocketServerFactory, object):
-    #: A :class:`set` of :class:`ProtocolBase` for each connection to a node.
-    nodes = None
+        """
+        for factory in list(self.factories):
+            factory.stopTrying()
+        return ContainerBase.drain(self, timeout)
 
-    #: For consumers only, a WAMP class which forwards consumed data to the end
-    #: users.
-    processor = None
 
-    def __init__(self, interface, port, id=None):
-        self.nodes = WeakSet()
+class ServerBase(websocket.WebSocketServerFactory, ContainerBase):
+    #: The :class:`twisted.internet.interfaces.IListeningPort` of the server.
+    listener = None
+
+    def __init__(self, interface, port, id=None, **kwargs):
+        self.setup(id, **kwargs)
         url = 'ws://{0}:{1}/'.format(interface, port)
         log.msg('pubsubclub:  Listening on %s' % url)
         websocket.WebSocketServerFactory.__init__(self, url)
-        websocket.listenWS(self)
-        self.id = id
+        self.setProtocolOptions(**self.websocket_options())
+        self.listener = websocket.listenWS(self)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Stop listening, then drain the connections (see
+        :meth:`ContainerBase.drain`).
+
+        """
+        if self.listener is not None:
+            self.listener.stopListening()
+        return ContainerBase.drain(self, timeout)
+
+
+def is_self(id, other_id):
+    """
+    Check whether two node IDs refer to the same node.  Unknown IDs never
+    match.
+
+    """
+    return id is not None and other_id is not None and id == other_id
 
 
 def passthrough_factory(name):
@@ -175,7 +1029,7 @@ def passthrough_factory(name):
     return method
 
 
-def make_client(name, passthrough, protocol):
+def make_client(name, passthrough, protocol, bases=tuple()):
     """
     Create a WebSocket client container (subclass of :class:`ClientBase`),
     subclassing from the given class.
@@ -184,6 +1038,8 @@ def make_client(name, passthrough, protocol):
     :type passthrough:  list of str
     :param protocol:  The class to subclass the protocol from.
     :type protocol:  type
+    :param bases:  Extra classes for the container to subclass from.
+    :type bases:  tuple of types
 
     :returns:  The WebSocket client container
     :rtype:  type
@@ -207,13 +1063,13 @@ def make_client(name, passthrough, protocol):
         attrs[method] = passthrough_factory(method)
     Client = type(
         'Client',
-        (ClientBase,),
+        bases + (ClientBase,),
         attrs,
     )
     return Client
 
 
-def make_server(name, passthrough, protocol):
+def make_server(name, passthrough, protocol, bases=tuple()):
     """
     Create a WebSocket server factory (subclass of :class:`ServerBase`),
     subclassing from the given class.
@@ -222,6 +1078,8 @@ def make_server(name, passthrough, protocol):
     :type passthrough:  list of str
     :param protocol:  The class to subclass the protocol from.
     :type protocol:  type
+    :param bases:  Extra classes for the container to subclass from.
+    :type bases:  tuple of types
 
     :returns:  The WebSocket server factory
     :rtype:  type
@@ -240,7 +1098,7 @@ def make_server(name, passthrough, protocol):
         attrs[method] = passthrough_factory(method)
     Server = type(
         'Server',
-        (ServerBase,),
+        bases + (ServerBase,),
         attrs,
     )
     return Server
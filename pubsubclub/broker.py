@@ -0,0 +1,45 @@
+"""
+A broker tier, for clusters too large for every producer to connect to every
+consumer.
+
+Brokers sit between the producers and the consumers, which connect to every
+broker rather than to each other.  The topics are sharded between the brokers
+by consistent hashing of their node IDs (see :mod:`pubsubclub.ring`):  a
+producer only sends a publish to the broker owning its topic, and a consumer
+only subscribes to a topic at its owner.  Each broker is a
+:class:`pubsubclub.relay.Relay` from the producers to the consumers.
+
+The ring of a client is made of the brokers it has a connection to, so it is
+rebalanced as brokers are discovered and connected to, or their connections
+are lost.  Consumers then move their subscriptions to the new owners.
+
+"""
+from __future__ import absolute_import
+
+from .relay import Relay, RelayConsumerServer, RelayProducerServer
+
+
+class Broker(Relay):
+    """
+    A node of the broker tier.  Producers connect to it with a
+    :class:`pubsubclub.ProducerClient` and consumers with a
+    :class:`pubsubclub.ConsumerClient`, both created with ``brokered=True``.
+
+    :param interface:  The interface to listen on.
+    :type interface:  str
+    :param port:  The port to listen on for producers.
+    :type port:  int
+    :param downstream_port:  The port to listen on for consumers.
+    :type downstream_port:  int
+    :param id:  The ID of the node.  Required, the topics are sharded by it.
+    :type id:  int
+
+    Further keyword arguments are those of
+    :meth:`pubsubclub.base.ContainerBase.setup`.
+
+    """
+    def __init__(self, interface, port, downstream_port, id, **kwargs):
+        super(Broker, self).__init__(
+            RelayConsumerServer(interface, port, id=id, **kwargs),
+            RelayProducerServer(interface, downstream_port, id=id, **kwargs),
+        )
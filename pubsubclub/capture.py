@@ -0,0 +1,138 @@
+"""
+Capture of the traffic a node sees, to replay it later (see
+:mod:`pubsubclub.replay`).
+
+A container created with ``capture=path`` appends a record to the file for
+each subscription change of its users, each message published locally and
+each message received from a producer.  Records hold the time since the
+previous record, the topic, the size of the message and, unless
+``capture_payloads=False``, the message itself.
+
+The file starts with :data:`MAGIC`, followed by the records.  Each record is
+a :data:`HEADER` (kind, microseconds since the previous record, length of the
+topic and size of the message), the topic in UTF-8 and, if the kind has the
+:data:`PAYLOAD` bit set, the message as JSON.
+
+"""
+from __future__ import absolute_import
+
+import json
+import struct
+import time
+from collections import namedtuple
+
+from twisted.internet import reactor
+
+
+MAGIC = b'PSCCAP\x01\n'
+HEADER = struct.Struct('>BIHI')
+MAX_DELAY = 2**32 - 1  # In microseconds, longer pauses are shortened
+
+SUBSCRIBE = 1
+UNSUBSCRIBE = 2
+PUBLISH = 3  # Published by the node itself
+RECEIVE = 4  # Received from a producer
+PAYLOAD = 0x80  # Set on the kind if the message follows the header
+
+KINDS = {
+    SUBSCRIBE: 'subscribe',
+    UNSUBSCRIBE: 'unsubscribe',
+    PUBLISH: 'publish',
+    RECEIVE: 'receive',
+}
+
+#: A record read from a capture.  ``time`` is in seconds since the first
+#: record, ``message`` is ``None`` unless the payload was captured.
+Record = namedtuple('Record', 'kind time topic size message')
+
+
+class Recorder(object):
+    """
+    Appends records to a capture file, opened when first written to.
+
+    :param path:  The file to append to.
+    :type path:  str
+    :param payloads:  Whether to capture the messages, rather than just their
+        size.
+    :type payloads:  bool
+
+    """
+    def __init__(self, path, payloads=True):
+        self.path = path
+        self.payloads = payloads
+        self.file = None
+        self.last = None
+
+    def open(self):
+        self.file = open(self.path, 'ab')
+        if self.file.tell() == 0:
+            self.file.write(MAGIC)
+        reactor.addSystemEventTrigger('before', 'shutdown', self.close)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def record(self, kind, topic, message=None, size=None):
+        """
+        Append a record.
+
+        :param size:  The size of the message as received, if known.  The
+            size of the message as JSON otherwise.
+        :type size:  int
+
+        """
+        if self.file is None:
+            self.open()
+        now = time.time()
+        delay = 0 if self.last is None else int((now - self.last) * 1e6)
+        self.last = now
+        payload = b''
+        if message is not None:
+            serialized = json.dumps(message)
+            if self.payloads:
+                kind |= PAYLOAD
+                payload = serialized.encode('utf-8')
+                size = len(payload)
+            elif size is None:
+                size = len(serialized)
+        if isinstance(topic, unicode):
+            topic = topic.encode('utf-8')
+        self.file.write(HEADER.pack(
+            kind, min(max(delay, 0), MAX_DELAY), len(topic), size or 0,
+        ))
+        self.file.write(topic)
+        self.file.write(payload)
+
+
+def read_capture(path):
+    """
+    Read the records of a capture file.
+
+    :raises ValueError:  if the file isn't a capture.
+    :returns:  The records, in order.
+    :rtype:  iterator of :class:`Record`
+
+    """
+    with open(path, 'rb') as capture:
+        if capture.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{0} is not a capture file'.format(path))
+        elapsed = 0
+        while True:
+            header = capture.read(HEADER.size)
+            if len(header) < HEADER.size:
+                return
+            kind, delay, topic_length, size = HEADER.unpack(header)
+            elapsed += delay
+            topic = capture.read(topic_length)
+            payload = capture.read(size) if kind & PAYLOAD else b''
+            if len(topic) < topic_length or len(payload) < (
+                    size if kind & PAYLOAD else 0
+            ):
+                return  # Truncated by a crash
+            topic = topic.decode('utf-8')
+            message = None
+            if kind & PAYLOAD:
+                message = json.loads(payload.decode('utf-8'))
+            yield Record(kind & ~PAYLOAD, elapsed / 1e6, topic, size, message)
@@ -0,0 +1,208 @@
+"""
+Encoding and decoding of large messages in worker processes, so a few
+megabyte-sized payloads don't stall every connection of the node while the
+reactor thread is busy with their JSON.
+
+Incoming messages larger than the ``offload_size`` of the container are
+decoded by the pool, as are the publishes of topics whose last message
+encoded to more than that.  Each connection processes the messages it
+receives, and sends the messages it encodes, in their original order:  the
+messages following one being handled by the pool wait for it.
+
+Worker processes are used rather than threads, as the JSON encoder and
+decoder hold the interpreter lock.  The pool is shared by the containers of
+the process, and started by the first one using it, which should be created
+before any server starts listening so the workers don't hold its socket.
+
+"""
+from __future__ import absolute_import
+
+import json
+import multiprocessing
+import signal
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+
+OFFLOAD_SIZE = 1024 * 1024  # Bytes of JSON above which the pool is used
+WORKERS = 2  # Processes of the pool
+CACHE_SIZE = 10000  # Large topics to remember
+
+#: The result of a message still in the pool.
+PENDING = object()
+
+#: The result of a message the pool failed to handle.
+FAILED = object()
+
+
+def _init_worker():
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    # The reactor's handler is inherited if the pool is started once it
+    # runs, and would keep the pool from terminating a stuck worker.
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+
+
+def _work(function, argument):
+    """
+    Run a function in a worker, timing it.
+
+    :returns:  Whether it succeeded, its result (or error message) and the
+        seconds it took.
+    :rtype:  tuple
+
+    """
+    started = time.time()
+    try:
+        result = function(argument)
+    except Exception as exc:
+        return False, '{0}: {1}'.format(type(exc).__name__, exc), (
+            time.time() - started
+        )
+    return True, result, time.time() - started
+
+
+class CodecPool(object):
+    """
+    The worker processes encoding and decoding JSON, started when first
+    needed.
+
+    """
+    def __init__(self):
+        self.pool = None
+        self.workers = 0
+        self.started = None
+        #: Messages handed to the pool and not handled yet.
+        self.pending = 0
+        self.peak_pending = 0
+        self.decoded = 0
+        self.encoded = 0
+        self.failed = 0
+        #: Seconds the workers spent on messages.
+        self.busy = 0.0
+        #: Seconds messages spent queued or in transit, beyond their work.
+        self.waited = 0.0
+
+    def start(self, workers=None):
+        if self.pool is not None:
+            return
+        self.workers = workers or WORKERS
+        self.pool = multiprocessing.Pool(self.workers, _init_worker)
+        self.started = time.time()
+        reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+
+    def stop(self):
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+
+    def decode(self, payload):
+        """
+        :returns:  A deferred firing with the decoded message.
+
+        """
+        self.decoded += 1
+        return self._submit(json.loads, payload)
+
+    def encode(self, message):
+        """
+        :returns:  A deferred firing with the message as JSON.
+
+        """
+        self.encoded += 1
+        return self._submit(json.dumps, message)
+
+    def _submit(self, function, argument):
+        self.start()
+        d = Deferred()
+        submitted = time.time()
+        self.pending += 1
+        self.peak_pending = max(self.peak_pending, self.pending)
+        self.pool.apply_async(
+            _work, (function, argument),
+            callback=lambda result: reactor.callFromThread(
+                self._done, d, submitted, result,
+            ),
+        )
+        return d
+
+    def _done(self, d, submitted, result):
+        ok, value, elapsed = result
+        self.pending -= 1
+        self.busy += elapsed
+        self.waited += max(time.time() - submitted - elapsed, 0.0)
+        if ok:
+            d.callback(value)
+        else:
+            self.failed += 1
+            d.errback(ValueError(value))
+
+    def stats(self):
+        """
+        :returns:  The messages handled by the pool, how many are pending,
+            the fraction of the time the workers were busy and the mean
+            seconds a message waited for a worker.
+        :rtype:  dict
+
+        """
+        handled = self.decoded + self.encoded - self.pending
+        elapsed = time.time() - self.started if self.started else 0.0
+        return {
+            'workers': self.workers,
+            'decoded': self.decoded,
+            'encoded': self.encoded,
+            'failed': self.failed,
+            'pending': self.pending,
+            'peak_pending': self.peak_pending,
+            'utilization': (
+                self.busy / (elapsed * self.workers) if elapsed else 0.0
+            ),
+            'mean_wait': self.waited / handled if handled else 0.0,
+        }
+
+
+POOL = CodecPool()
+
+
+class Offload(object):
+    """
+    Which messages of a container go through the pool.
+
+    :param size:  The bytes of JSON above which messages are handled by the
+        pool.
+    :type size:  int
+    :param pool:  The :class:`CodecPool`, by default the one of the process.
+
+    """
+    def __init__(self, size=OFFLOAD_SIZE, pool=None):
+        self.size = size
+        self.pool = POOL if pool is None else pool
+        #: The topics whose last message encoded to more than ``size``.
+        self.large_topics = set()
+
+    def decodes(self, size):
+        """
+        Whether to decode a message of the given size in the pool.
+
+        """
+        return size > self.size
+
+    def encodes(self, topic):
+        """
+        Whether to encode a message for the topic in the pool.
+
+        """
+        return topic in self.large_topics
+
+    def encoded(self, topic, size):
+        """
+        Remember the size of the topic's last message as JSON.
+
+        """
+        if size > self.size:
+            if len(self.large_topics) >= CACHE_SIZE:
+                self.large_topics.clear()
+            self.large_topics.add(topic)
+        else:
+            self.large_topics.discard(topic)
@@ -9,51 +9,20 @@ from twisted.internet.task import deferLater
 from twisted.internet.defer import Deferred, maybeDeferred
 from twisted.python import log
 from twisted.python.failure import Failure
-from twisted.web.client import Agent, readBody
+from twisted.web.client import Agent, FileBodyProducer, readBody
 from twisted.web.http_headers import Headers
 
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from io import BytesIO as StringIO
 
-POLL_WAIT = 60  #: The duration to longpoll
-DEBOUNCE_PERIOD = 30.0  # How long to wait before applying changes
-MIN_QUERY_PERIOD = 5.0  # Throttle polling if it returns too quickly
+from .discovery import Discovery
 
 
-class Debouncer(object):
-    """
-    An object to debounce a function.  Calling a function wrapped in this will
-    delay the call for up to ``period`` seconds.  Further calls within that
-    time period will overwrite the previous call.
-
-    """
-    def __init__(self, func):
-        self.func = func
-        self.wait = None
-        self.last_args = None
-        self.last_kwargs = None
-
-    def __get__(self, obj, type=None):
-        def func(*args, **kwargs):
-            # If we haven't debounced
-            if self.wait is None:
-                self.wait = deferLater(reactor, DEBOUNCE_PERIOD, self._call)
-
-            self.last_obj = obj
-            self.last_args = args
-            self.last_kwargs = kwargs
-
-        return func
-
-    def _call(self):
-        # Need to set these up here because the function call might be
-        # recursive, triggering another debounce call.
-        obj = self.last_obj
-        args = self.last_args
-        kwargs = self.last_kwargs
-        self.wait = None
-        self.last_args = None
-        self.last_kwargs = None
-        self.last_obj = None
-        self.func(obj, *args, **kwargs)
+POLL_WAIT = 60  #: The duration to longpoll
+MIN_QUERY_PERIOD = 5.0  # Throttle polling if it returns too quickly
+ID_KEY = 'pubsubclub-id'  # Service meta key/tag prefix holding the node ID
 
 
 class HTTPResponse(object):
@@ -109,7 +78,7 @@ class HTTPResponse(object):
         return str(self)
 
 
-def http_request(method, url, headers=dict()):
+def http_request(method, url, headers=dict(), body=None):
     """
     Make an HTTP request and return the entire response (with headers).
 
@@ -119,6 +88,8 @@ def http_request(method, url, headers=dict()):
     :type url:  str
     :param headers:  The headers to send with the request.
     :type headers:  dict
+    :param body:  The body to send with the request, if any.
+    :type body:  str
 
     :returns:  A deferred which will callback with a :class:`HTTPResponse`
 
@@ -128,7 +99,7 @@ def http_request(method, url, headers=dict()):
         method,
         url,
         Headers({}),
-        None,
+        FileBodyProducer(StringIO(body)) if body is not None else None,
     )
     return request.addCallback(HTTPResponse.from_response)
 
@@ -209,27 +180,130 @@ def deferred_timeout(deferred, timeout):
     return d.addBoth(callback)
 
 
-class ConsulDiscovery(object):
-    def __init__(self, consul_url, consul_service, client):
-        self.client = client
+def service_id(service):
+    """
+    Extract the PubSubClub node ID from a service returned by Consul's health
+    API.  The ID is read from the service meta, falling back to a tag of the
+    form ``pubsubclub-id=<id>`` for Consul agents that predate service meta.
+
+    :param service:  The ``Service`` object of a health API entry.
+    :type service:  dict
+
+    :returns:  The node ID or ``None`` if the service doesn't announce one.
+    :rtype:  int
+
+    """
+    value = (service.get('Meta') or {}).get(ID_KEY)
+    if value is None:
+        prefix = ID_KEY + '='
+        for tag in service.get('Tags') or []:
+            if tag.startswith(prefix):
+                value = tag[len(prefix):]
+                break
+    try:
+        return int(value) if value is not None else None
+    except ValueError:
+        log.msg('ConsulDiscovery:  Invalid node ID {0!r}'.format(value))
+        return None
+
+
+class ConsulDiscovery(Discovery):
+    """
+    Follows the healthy instances of a service in Consul, with blocking
+    queries of its health API.
+
+    :param consul_url:  The URL of Consul's HTTP API.
+    :type consul_url:  str
+    :param consul_service:  The name of the service.
+    :type consul_service:  str
+    :param client:  The producer or consumer client to connect.
+
+    """
+    name = 'ConsulDiscovery'
+
+    def __init__(self, consul_url, consul_service, client, debounce=None):
+        super(ConsulDiscovery, self).__init__(client, debounce)
         self.consul_url = urlsplit(consul_url)[:2]
         self.consul_service = consul_service
-        self.nodes = set()
         self.index = None
         self.last_queued = 0.0
+        self.running = False
 
     def start(self):
         log.msg('ConsulDiscovery:  Starting')
+        self.running = True
         d = self._query_services()  # Get initial list
         d.addCallback(self.requeue)
         d.addErrback(self._print_traceback)
         return d
 
+    def register(self, port, id=None):
+        """
+        Register this node as an instance of the service with the local
+        Consul agent, announcing the node ID in the service metadata so other
+        nodes can avoid connecting to themselves.
+
+        :param port:  The port the PubSubClub server is listening on.
+        :type port:  int
+        :param id:  The node ID.  Defaults to the client's ID.
+        :type id:  int
+
+        :returns:  A deferred which fires once the service is registered.
+
+        """
+        if id is None:
+            id = self.client.id
+        definition = {
+            'Name': self.consul_service,
+            'Port': port,
+        }
+        if id is not None:
+            definition.update({
+                'ID': '{0}-{1}'.format(self.consul_service, id),
+                'Tags': ['{0}={1}'.format(ID_KEY, id)],
+                'Meta': {ID_KEY: str(id)},
+            })
+        url = urlunsplit(
+            self.consul_url + ('/v1/agent/service/register', '', '')
+        )
+        log.msg(
+            'ConsulDiscovery:  Registering service on port {0}'.format(port)
+        )
+        return http_request('PUT', url, body=json.dumps(definition))
+
+    def deregister(self, id=None):
+        """
+        Deregister this node from the local Consul agent, e.g. before
+        draining it (see :meth:`pubsubclub.base.ContainerBase.drain`).
+
+        :param id:  The node ID.  Defaults to the client's ID.
+        :type id:  int
+
+        :returns:  A deferred which fires once the service is deregistered.
+
+        """
+        if id is None:
+            id = self.client.id
+        service = self.consul_service
+        if id is not None:
+            service = '{0}-{1}'.format(self.consul_service, id)
+        url = urlunsplit(self.consul_url + (
+            '/v1/agent/service/deregister/{0}'.format(service), '', '',
+        ))
+        log.msg('ConsulDiscovery:  Deregistering service {0}'.format(service))
+        return http_request('PUT', url)
+
     def _print_traceback(self, result):
         result.printTraceback()
         return result
 
+    def stop(self):
+        super(ConsulDiscovery, self).stop()
+        self.running = False
+
     def requeue(self, _=None):
+        if not self.running:
+            return
         run = lambda: self._query_services(wait=POLL_WAIT, debounce=True)
         if unix_timestamp() - self.last_queued < MIN_QUERY_PERIOD:
             d = deferLater(reactor, MIN_QUERY_PERIOD, run)
@@ -240,7 +314,7 @@ class ConsulDiscovery(object):
         d.addErrback(self._handle_api_error)
 
     def _handle_api_error(self, failure):
-        failure.printTraceback()
+        self.failed(failure)
         deferLater(reactor, 10.0, self.requeue)
 
     @retry_on_failure(MIN_QUERY_PERIOD)
@@ -263,12 +337,8 @@ class ConsulDiscovery(object):
             wait * 1.5 if wait else 10.0
         )
 
-        callback = (
-            self._process_services_debounced if debounce
-            else self._process_services
-        )
-
-        return d.addCallback(self._get_new_index).addCallback(callback)
+        d.addCallback(self._get_new_index)
+        return d.addCallback(self._process_services, debounce=debounce)
 
     def _get_new_index(self, response):
         header = response.headers.get('X-Consul-Index')
@@ -276,21 +346,11 @@ class ConsulDiscovery(object):
             self.index = int(header)
         return response
 
-    def _process_services(self, result):
-        result = result.json
-        new_nodes = set(
-            (
-                service['Node']['Address'], service['Service']['Port'],
-            ) for service in result
-        )
-        # Nodes that have appeared
-        for node in new_nodes - self.nodes:
-            log.msg('ConsulDiscovery:  Connecting to %s:%s', *node)
-            self.client.connect(*node)
-        # Nodes that have disappeared
-        for node in self.nodes - new_nodes:
-            log.msg('ConsulDiscovery:  Disconnecting from %s:%s', *node)
-            self.client.disconnect(*node)
-        self.nodes = new_nodes
-
-    _process_services_debounced = Debouncer(_process_services)
+    def _process_services(self, result, debounce=False):
+        if not self.running:
+            return
+        ids = dict()
+        for service in result.json:
+            node = (service['Node']['Address'], service['Service']['Port'])
+            ids[node] = service_id(service['Service'])
+        self.update(ids, debounce)
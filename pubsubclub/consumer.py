@@ -1,13 +1,16 @@
 from __future__ import absolute_import
 
-import random
-
 from twisted.python import log
-from twisted.internet import reactor
-from twisted.internet.task import deferLater
 from autobahn.wamp1 import protocol as wamp
 
-from .base import ProtocolBase, make_client, make_server
+from . import deltas, heartbeat
+from .base import (
+    ProtocolBase, is_self, make_client, make_server, passthrough_factory,
+)
+from .capture import RECEIVE, SUBSCRIBE, UNSUBSCRIBE
+from .directory import CHUNK, Targets
+from .filters import compile_filter
+from .resume import ResumeState
 
 
 class ConsumerProtocol(ProtocolBase):
@@ -19,9 +22,30 @@ class ConsumerProtocol(ProtocolBase):
     """
     ROLE = 'consumer'
     SUPPORTED_VERSIONS = set([
-        (1, 0), (1, 1),
+        (1, 0), (1, 1), (1, 2),
+    ])
+    EXTENSIONS = ProtocolBase.EXTENSIONS | frozenset([
+        'aliases', 'resume', 'filters', 'deltas', 'dedup', 'targets',
     ])
-    pong_received = True
+
+    #: The :class:`pubsubclub.resume.ResumeState` of the session with the
+    #: producer, if the ``resume`` extension is in use.
+    resume = None
+
+    #: The :class:`pubsubclub.deltas.Baselines` of the delta encoded topics
+    #: received, created with the first snapshot.
+    received_baselines = None
+
+    #: The delta encoded topics we asked the producer a snapshot of.
+    resyncing = frozenset()
+
+    #: Map of the topics subscribed to on the producer and their alias and
+    #: filter, see :meth:`subscription`.
+    subscribed = None
+
+    def onConnect(self, request):
+        super(ConsumerProtocol, self).onConnect(request)
+        self.subscribed = dict()
 
     def onOpen(self):
         """
@@ -29,55 +53,327 @@ class ConsumerProtocol(ProtocolBase):
         handshake.
 
         """
-        self.send(101, *[list(item) for item in self.SUPPORTED_VERSIONS])
+        versions = [list(item) for item in self.SUPPORTED_VERSIONS]
+        self.send(101, *(versions + [self.handshake_options()]))
 
-    def ping(self):
-        if self.pong_received is False:
-            log.msg('Pong not received in time!')
-            self.transport.loseConnection()
-            return
-        self.pong_received = False
-        self.sendPing()
-        deferLater(reactor, random.uniform(3.0, 7.0), self.ping)
+    def handshake_options(self):
+        options = super(ConsumerProtocol, self).handshake_options()
+        if self.factory.dedup is None:
+            # Don't have the producer tag publishes for nothing.
+            options['extensions'].remove('dedup')
+        return options
+
+    def onClose(self, clean, code, reason):
+        heartbeat.HEARTBEAT.unregister(self)
+        if self.resume is not None and self.drained:
+            # The producer left for good, it won't resume the session.
+            if self.factory.resume_states.get(self.remote_id) is self.resume:
+                del self.factory.resume_states[self.remote_id]
+        elif self.resume is not None:
+            states = self.factory.resume_states
+            remote_id, state = self.remote_id, self.resume
+
+            def expire():
+                if states.get(remote_id) is state:
+                    del states[remote_id]
+
+            state.detach(expire)
+        super(ConsumerProtocol, self).onClose(clean, code, reason)
+
+    def start_heartbeat(self):
+        """
+        Start pinging the producer, to detect a broken connection.
+
+        """
+        self.liveness = heartbeat.Liveness()
+        heartbeat.HEARTBEAT.register(self)
 
-    def onPong(self, _):
-        self.pong_received = True
+    def onPong(self, payload):
+        if self.liveness is not None:
+            self.liveness.pong(payload, heartbeat.HEARTBEAT.clock.seconds())
 
-    def onVersionChosen(self, version, id=None):
+    def onVersionChosen(self, version, id=None, options=None):
         """
         Once the publisher chooses the version, start sending over all the
         subscribers.
 
         """
-        self.ready()
-        self.ping()
+        self.remote_id = id
+        self.negotiate(options)
+        self.set_ready()
+        self.start_heartbeat()
 
-        print(id, self.factory.id)
-        if(
-                id is not None
-                and self.factory.id is not None
-                and id == self.factory.id
-        ):
-            # Don't connect to self.
+        if is_self(id, self.factory.id):
+            # Don't connect to self.  Discovery should have prevented this
+            # connection from being opened, this is only a fallback.
+            log.msg('Connected to self, closing connection.')
             self.sendClose()
             return
 
-        # Start sending out all existing subscriptions
-        for topic in self.factory.processor.subscriptions.iterkeys():
+        self.join_ring()
+        if 'resume' in self.extensions and (options or {}).get('session'):
+            self.start_session(options['session'])
+        else:
+            self.replay_subscriptions()
+        if self.factory.ring is not None:
+            # Take over our topics from the other brokers.
+            self.factory.rebalance()
+        self.send_sessions(self.factory.local_sessions, full=True)
+
+    def start_session(self, token):
+        """
+        Resume our session with the producer if it still has it, otherwise
+        start a new one.  Without the producer's ID to keep it by, the
+        session isn't kept for resuming.
+
+        """
+        if self.remote_id is None:
+            self.send(104, None)
+            self.replay_subscriptions()
+            return
+        states = self.factory.resume_states
+        state = states.get(self.remote_id)
+        if state is not None:
+            state.attach()
+        if state is None or state.token != token:
+            self.resume = states[self.remote_id] = ResumeState(token)
+            self.resume.topics = self.subscribed
+            self.send(104, None)
+            self.replay_subscriptions()
+            return
+        self.resume = state
+        self.subscribed = state.topics
+        self.send(104, state.last_seq)
+        # Bring the producer up to date with the changes in the meantime.
+        self.sync_subscriptions()
+
+    def current_topics(self):
+        """
+        The topics we need to be subscribed to on this producer.
+
+        """
+        topics = self.factory.subscribed_topics()
+        if self.factory.ring is not None:
+            topics = set(topic for topic in topics if self.owns(topic))
+        return topics
+
+    def owns(self, topic):
+        """
+        Whether the topic is to be subscribed to on this producer, which is
+        only the case for the topic's owner if the producers are brokers.
+
+        """
+        ring = self.factory.ring
+        return ring is None or ring.owner(topic) == self.remote_id
+
+    def replay_subscriptions(self):
+        """
+        Send over all the topics we're currently subscribed to.
+
+        """
+        for topic in self.current_topics():
+            self.send_subscribe(topic)
+
+    def sync_subscriptions(self, subscribe=True, unsubscribe=True):
+        """
+        Send the subscriptions and unsubscriptions needed to make the
+        producer's subscriptions match ours.
+
+        """
+        topics = self.current_topics()
+        if subscribe:
+            for topic in topics:
+                if self.subscribed.get(topic) != self.subscription(topic):
+                    self.send_subscribe(topic)
+        if unsubscribe:
+            for topic in set(self.subscribed) - topics:
+                self.send_unsubscribe(topic)
+
+    def alias(self, topic):
+        """
+        The alias to subscribe to a topic with, if the producer supports them.
+
+        """
+        if 'aliases' in self.extensions:
+            return self.factory.topics.alias(topic)
+        return None
+
+    def subscription(self, topic):
+        """
+        The alias and filter expression to subscribe to a topic with, as far
+        as the producer supports them.
+
+        :rtype:  tuple
+
+        """
+        expression = None
+        if 'filters' in self.extensions:
+            compiled = self.factory.topic_filters.get(topic)
+            if compiled is not None:
+                expression = compiled.expression
+        return self.alias(topic), expression
+
+    def send_subscribe(self, topic):
+        """
+        Send a subscription, along with the topic's alias and filter if the
+        producer supports them.
+
+        """
+        alias, expression = subscription = self.subscription(topic)
+        if expression is not None:
+            self.send(204, topic, alias, expression)
+        elif alias is not None:
+            self.send(203, topic, alias)
+        else:
             self.send(201, topic)
+        self.subscribed[topic] = subscription
+
+    def send_sessions(self, added, removed=(), full=False):
+        """
+        Announce the WAMP sessions of the end users added and removed, if the
+        producer supports targeted publishes.
+
+        :param full:  Whether the sessions added are all of them, replacing
+            those announced before.
+        :type full:  bool
 
-    def onPublish(self, topic, message):
+        """
+        if not self.ready or 'targets' not in self.extensions:
+            return
+        added, removed = list(added), list(removed)
+        while True:
+            self.send(206, added[:CHUNK], removed[:CHUNK], full)
+            added, removed, full = added[CHUNK:], removed[CHUNK:], False
+            if not added and not removed:
+                return
+
+    def send_unsubscribe(self, topic):
+        self.send(202, topic)
+        self.subscribed.pop(topic, None)
+        if self.received_baselines is not None:
+            self.received_baselines.discard(topic)
+
+    def onPublish(self, topic, message, extra=None):
         """
         Receive a pubsub and dispatch it to the end users.
 
         """
+        topic = self.accept(topic, extra)
+        if topic is None:
+            return
+        if extra and 'b' in extra:
+            # A snapshot of a delta encoded topic.
+            if self.received_baselines is None:
+                self.received_baselines = deltas.Baselines(
+                    self.factory.deltas.baseline_size,
+                )
+            # The size of the frame stands for the size of the message.
+            self.received_baselines.put(topic, deltas.Baseline(
+                extra['b'], message, self.message_size,
+            ))
+            if topic in self.resyncing:
+                self.resyncing.discard(topic)
+        self.dispatch(topic, message, extra)
+
+    def onDelta(self, topic, version, ops, extra=None):
+        """
+        Receive a patch for the baseline of a delta encoded topic, and
+        dispatch the patched message to the end users.
+
+        """
+        topic = self.accept(topic, extra)
+        if topic is None:
+            return
+        baseline = None
+        if self.received_baselines is not None:
+            baseline = self.received_baselines.get(topic)
         try:
-            # We're making the call to the classmethod to prevent an infinite
-            # loop if if two producer/consumer servers are connected to
-            # eachother.
-            wamp.WampServerFactory.dispatch(
-                self.factory.processor, topic, message,
+            if baseline is None or baseline.version != version:
+                raise ValueError('Baseline {0} not found'.format(version))
+            message = deltas.patch(baseline.message, ops)
+        except ValueError as exc:
+            self.resync(topic, exc)
+            return
+        self.received_baselines.put(topic, deltas.Baseline(
+            version + 1, message, baseline.size + self.message_size,
+        ))
+        self.dispatch(topic, message, extra)
+
+    def resync(self, topic, reason):
+        """
+        Ask the producer for a snapshot of a delta encoded topic, once until
+        it arrives.
+
+        """
+        if topic in self.resyncing:
+            return
+        log.msg('Resyncing topic {0}:  {1}'.format(topic, reason))
+        if not self.resyncing:
+            self.resyncing = set()
+        self.resyncing.add(topic)
+        self.factory.counters.incr('deltas.desyncs')
+        self.send(205, topic)
+
+    def accept(self, topic, extra):
+        """
+        Resolve the topic of a publish and check it isn't a duplicate.
+
+        :returns:  The topic, or ``None`` to ignore the publish.
+        :rtype:  str
+
+        """
+        if not isinstance(topic, basestring):
+            alias, topic = topic, self.factory.topics.topic(topic)
+            if topic is None:
+                log.msg('Received publish for unknown alias {0}'.format(alias))
+                return None
+        hitters = self.factory.hitters
+        if hitters is not None:
+            hitters.add('received', topic)
+            hitters.add('received_bytes', topic, self.message_size)
+        if extra and 's' in extra and self.resume is not None:
+            missed = self.resume.receive(extra['s'])
+            if missed is None:
+                return None  # Already received before reconnecting
+            if missed:
+                log.msg('Missed {0} publishes from producer {1}'.format(
+                    missed, self.remote_id,
+                ))
+                self.factory.counters.incr('resume.gaps')
+                self.factory.counters.incr('resume.missed', missed)
+        return topic
+
+    def dispatch(self, topic, message, extra=None):
+        """
+        Dispatch a message to the end users, unless it was already received
+        along another path.
+
+        """
+        extra = extra or {}
+        origin = extra.get('o')
+        if origin is not None and self.factory.dedup is not None:
+            if not self.factory.dedup.accept(origin):
+                self.factory.counters.incr('dedup.dropped')
+                return
+        if self.factory.recorder is not None:
+            self.factory.recorder.record(
+                RECEIVE, topic, message, self.message_size,
+            )
+        if 'filters' not in self.extensions:
+            # The producer can't filter for us.
+            compiled = self.factory.topic_filters.get(topic)
+            if compiled is not None and not compiled(message):
+                return
+        via = tuple(extra.get('v') or ())
+        targets = None
+        if 'e' in extra or 'x' in extra:
+            eligible = extra.get('e')
+            targets = Targets(
+                None if eligible is None else frozenset(eligible),
+                frozenset(extra.get('x') or ()),
             )
+        try:
+            self.factory.forward(topic, message, via, origin, targets)
         except:
             import traceback
             traceback.print_exc()
@@ -87,20 +383,129 @@ class ConsumerProtocol(ProtocolBase):
         Subscribe to a topic from the producer.
 
         """
-        if not self.ready:
+        if not self.ready or not self.owns(topic):
             return
-        self.send(201, topic)
+        self.send_subscribe(topic)
 
     def unsubscribe(self, topic):
         """
         Unsubscribe from a topic from the producer.
 
         """
-        if not self.ready:
+        if not self.ready or topic not in self.subscribed:
             return
-        self.send(202, topic)
+        self.send_unsubscribe(topic)
+
+
+class ConsumerContainer(object):
+    """
+    Container methods for consumers, mixed into the consumer client and
+    server.
+
+    """
+    _subscribe = passthrough_factory('subscribe')
+    _unsubscribe = passthrough_factory('unsubscribe')
+
+    def subscribe(self, topic, filter=None):
+        """
+        Subscribe to a topic on all the producers.
+
+        :param filter:  Only receive the messages matching this filter
+            expression, see :mod:`pubsubclub.filters`.
+        :type filter:  dict
+
+        :raises ValueError:  if the filter expression is invalid.
+
+        """
+        if filter is None:
+            self.topic_filters.pop(topic, None)
+        else:
+            self.topic_filters[topic] = compile_filter(filter)
+        if self.recorder is not None:
+            self.recorder.record(SUBSCRIBE, topic)
+        self._subscribe(topic)
+
+    def unsubscribe(self, topic):
+        """
+        Unsubscribe from a topic on all the producers, and forget its alias
+        and filter.
+
+        """
+        if self.recorder is not None:
+            self.recorder.record(UNSUBSCRIBE, topic)
+        self._unsubscribe(topic)
+        self.topics.release(topic)
+        self.topic_filters.pop(topic, None)
+
+    def subscribed_topics(self):
+        """
+        The topics the end users are subscribed to.
+
+        :rtype:  set
+
+        """
+        processor = self.processor
+        topics = set(processor.subscriptions)
+        # Topics without users, but which we are lingering on.
+        topics.update(getattr(processor, 'lingering', None) or ())
+        return topics
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        """
+        Forward a message received from a producer to the end users.
+
+        :param via:  The IDs of the relays the message went through.
+        :type via:  tuple
+        :param origin:  The origin tag of the message, see
+            :mod:`pubsubclub.dedup`.
+        :type origin:  list
+        :param targets:  The sessions the message is for, see
+            :mod:`pubsubclub.directory`.
+        :type targets:  :class:`pubsubclub.directory.Targets`
+
+        """
+        # We're making the call to the classmethod to prevent an infinite
+        # loop if if two producer/consumer servers are connected to
+        # eachother.
+        processor = self.processor
+        if targets is None:
+            wamp.WampServerFactory.dispatch(processor, topic, message)
+            return
+        eligible = targets.eligible
+        if eligible is not None:
+            eligible = processor.sessionIdsToProtos(eligible)
+        wamp.WampServerFactory.dispatch(
+            processor, topic, message,
+            processor.sessionIdsToProtos(targets.exclude), eligible,
+        )
+
+    def session_opened(self, id):
+        """
+        An end user's WAMP session has opened, announce it to the producers.
+
+        """
+        self.local_sessions.add(id)
+
+    def session_closed(self, id):
+        self.local_sessions.remove(id)
+
+    def rebalance(self):
+        """
+        Move subscriptions to the brokers now owning the topics, subscribing
+        at the new owners before unsubscribing at the old ones.
+
+        """
+        nodes = [node for node in self.nodes if node.ready]
+        for node in nodes:
+            node.sync_subscriptions(unsubscribe=False)
+        for node in nodes:
+            node.sync_subscriptions(subscribe=False)
 
 
-PASSTHROUGH = ['subscribe', 'unsubscribe']
-ConsumerClient = make_client('ConsumerClient', PASSTHROUGH, ConsumerProtocol)
-ConsumerServer = make_server('ConsumerServer', PASSTHROUGH, ConsumerProtocol)
+PASSTHROUGH = []
+ConsumerClient = make_client(
+    'ConsumerClient', PASSTHROUGH, ConsumerProtocol, (ConsumerContainer,),
+)
+ConsumerServer = make_server(
+    'ConsumerServer', PASSTHROUGH, ConsumerProtocol, (ConsumerContainer,),
+)
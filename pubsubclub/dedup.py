@@ -0,0 +1,107 @@
+"""
+Suppression of duplicate publishes, for consumers which may receive the same
+publish along several paths (e.g. through redundant relays).
+
+Producers tag each publish with its origin:  the ID of the producer, an epoch
+chosen when the producer starts, and a sequence number.  The tag is kept as
+the publish is relayed.  Consumers remember the sequence numbers recently
+received from each origin in a sliding window, and drop the publishes they
+have already seen.
+
+"""
+import random
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+WINDOW = 1024  # Sequence numbers remembered per origin
+MAX_ORIGINS = 1024  # Origins remembered, the least recently seen are dropped
+
+
+class OriginTagger(object):
+    """
+    Numbers the publishes of a producer.
+
+    :param id:  The ID of the producer.
+    :type id:  int
+
+    """
+    def __init__(self, id):
+        self.id = id
+        self.epoch = random.randrange(2**31)
+        self.seq = 0
+
+    def next(self):
+        """
+        :returns:  The origin tag of the next publish.
+        :rtype:  tuple
+
+        """
+        self.seq += 1
+        return self.id, self.epoch, self.seq
+
+
+class DedupWindow(object):
+    """
+    The sequence numbers recently received from each origin.  A publish is
+    a duplicate if its sequence number was received already, within the
+    ``window`` highest received.  Older publishes are let through, as they
+    can't be told apart from a producer restarting.
+
+    """
+    def __init__(self, window=WINDOW, max_origins=MAX_ORIGINS):
+        self.window = window
+        self.max_origins = max_origins
+        #: Pairs of highest sequence number and bitmap of the ones received
+        #: below it, by origin.
+        self.origins = OrderedDict()
+
+    def __len__(self):
+        return len(self.origins)
+
+    def accept(self, origin):
+        """
+        Note the receipt of a publish.
+
+        :param origin:  The origin tag of the publish.
+        :type origin:  list
+
+        :returns:  Whether the publish should be processed, rather than
+            dropped as a duplicate.
+        :rtype:  bool
+
+        """
+        try:
+            id, epoch, seq = origin
+            key = id, epoch
+            hash(key)
+        except (TypeError, ValueError):
+            return True  # Not a valid tag, can't tell
+        if not isinstance(seq, (int, long)):
+            return True
+        entry = self.origins.pop(key, None)
+        accepted = True
+        if entry is None:
+            entry = seq, 1
+            while len(self.origins) >= self.max_origins:
+                self.origins.popitem(last=False)
+        else:
+            highest, bitmap = entry
+            if seq > highest:
+                shift = seq - highest
+                if shift >= self.window:
+                    bitmap = 1
+                else:
+                    bitmap = ((bitmap << shift) | 1) & ((1 << self.window) - 1)
+                entry = seq, bitmap
+            elif highest - seq < self.window:
+                bit = 1 << (highest - seq)
+                if bitmap & bit:
+                    accepted = False
+                else:
+                    entry = highest, bitmap | bit
+        self.origins[key] = entry
+        return accepted
@@ -0,0 +1,215 @@
+"""
+Delta encoding of publishes, for topics republishing large documents of
+which only a few fields change each time.
+
+For each connection and topic, the producer keeps the last message it sent as
+a baseline.  The next message is sent as a PSC303 patch against the baseline,
+which the consumer applies to its copy of it.  Baselines are versioned, so a
+consumer whose copy is missing or outdated notices and asks for a snapshot
+with PSC205.  A full snapshot is also sent every :data:`SNAPSHOT_INTERVAL`
+messages, and whenever the patch wouldn't be smaller than the message.
+
+A patch is a list of operations on the fields of the baseline.  ``[path,
+value]`` sets a field and ``[path]`` removes it, ``path`` being the list of
+keys leading to the field through nested objects.  Only objects are patched,
+other values are replaced whole.
+
+"""
+import json
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from .topics import TopicPrefixes
+
+
+SNAPSHOT_INTERVAL = 100  # Send a full message after this many patches
+BASELINE_SIZE = 4 * 1024 * 1024  # Default limit on baselines per connection
+
+
+def diff(old, new):
+    """
+    Compute the patch turning one object into another.
+
+    :returns:  The patch, or ``None`` if either value isn't an object.
+    :rtype:  list
+
+    """
+    if not isinstance(old, dict) or not isinstance(new, dict):
+        return None
+    ops = []
+    _diff(old, new, [], ops)
+    return ops
+
+
+def _diff(old, new, path, ops):
+    for key, value in new.iteritems():
+        if key not in old:
+            ops.append([path + [key], value])
+            continue
+        previous = old[key]
+        if isinstance(value, dict) and isinstance(previous, dict):
+            _diff(previous, value, path + [key], ops)
+        elif value != previous or type(value) is not type(previous):
+            ops.append([path + [key], value])
+    for key in old:
+        if key not in new:
+            ops.append([path + [key]])
+
+
+def patch(base, ops):
+    """
+    Apply a patch to an object.  The object isn't modified, the objects on the
+    patched paths are copied instead.
+
+    :raises ValueError:  if the patch doesn't apply to the object.
+    :returns:  The patched object.
+
+    """
+    if not isinstance(base, dict):
+        raise ValueError('Only objects can be patched')
+    result = dict(base)
+    copies = set([id(result)])
+    for op in ops:
+        if not isinstance(op, list) or not 1 <= len(op) <= 2 or not op[0]:
+            raise ValueError('Invalid patch operation')
+        path = op[0]
+        target = result
+        for key in path[:-1]:
+            child = target.get(key)
+            if not isinstance(child, dict):
+                raise ValueError('Patch path {0!r} not found'.format(path))
+            if id(child) not in copies:
+                child = target[key] = dict(child)
+                copies.add(id(child))
+            target = child
+        if len(op) == 2:
+            target[path[-1]] = op[1]
+        else:
+            target.pop(path[-1], None)
+    return result
+
+
+class Baseline(object):
+    __slots__ = ('version', 'message', 'size', 'patches')
+
+    def __init__(self, version, message, size, patches=0):
+        self.version = version
+        self.message = message
+        #: The approximate serialized size of the message.
+        self.size = size
+        #: The patches sent or applied since the last snapshot.
+        self.patches = patches
+
+
+class Baselines(object):
+    """
+    The baselines of a connection by topic, bounded by their size with the
+    least recently used topics evicted first.
+
+    :param max_size:  The total serialized size of the baselines, in bytes.
+    :type max_size:  int
+
+    """
+    __slots__ = ('max_size', 'size', 'baselines')
+
+    def __init__(self, max_size=BASELINE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.baselines = OrderedDict()
+
+    def __len__(self):
+        return len(self.baselines)
+
+    def get(self, topic):
+        """
+        :returns:  The baseline of the topic, or ``None``.
+        :rtype:  :class:`Baseline`
+
+        """
+        baseline = self.baselines.pop(topic, None)
+        if baseline is not None:
+            self.baselines[topic] = baseline
+        return baseline
+
+    def put(self, topic, baseline):
+        self.discard(topic)
+        if baseline.size > self.max_size:
+            return
+        while self.size + baseline.size > self.max_size:
+            _, evicted = self.baselines.popitem(last=False)
+            self.size -= evicted.size
+        self.baselines[topic] = baseline
+        self.size += baseline.size
+
+    def discard(self, topic):
+        baseline = self.baselines.pop(topic, None)
+        if baseline is not None:
+            self.size -= baseline.size
+
+
+class DeltaEncoder(object):
+    """
+    Delta encoding settings of a container, and the work shared between its
+    connections.  Connections in sync share the same baseline, so the patch
+    for a publish is usually computed once for all of them.
+
+    :param prefixes:  The prefixes of the topics to delta encode.
+    :type prefixes:  list of str
+    :param baseline_size:  The limit on the baselines of each connection, in
+        bytes.
+    :type baseline_size:  int
+
+    """
+    def __init__(self, prefixes=(), baseline_size=BASELINE_SIZE):
+        self.prefixes = TopicPrefixes(prefixes)
+        self.baseline_size = baseline_size
+        self.generation = None
+        self.frozen = None
+        self.patches = dict()
+
+    def encodes(self, topic):
+        return topic in self.prefixes
+
+    def freeze(self, message, generation=None):
+        """
+        Take a copy of a message to keep as a baseline, so it's unaffected by
+        the application modifying the message later.
+
+        :param generation:  Identifies the publish, if the message is being
+            published to every connection.
+
+        :returns:  The copy and its serialized size.
+        :rtype:  tuple
+
+        """
+        if generation is not None and generation == self.generation:
+            return self.frozen
+        data = json.dumps(message)
+        frozen = json.loads(data), len(data)
+        if generation is not None:
+            self.generation, self.frozen = generation, frozen
+            self.patches.clear()
+        return frozen
+
+    def diff(self, baseline, frozen, generation=None):
+        """
+        Compute the patch from a baseline to a message frozen by
+        :meth:`freeze`.
+
+        :returns:  The patch (or ``None``) and its serialized size.
+        :rtype:  tuple
+
+        """
+        memoize = generation is not None and generation == self.generation
+        if memoize:
+            base, result = self.patches.get(id(baseline.message), (None, None))
+            if base is baseline.message:
+                return result
+        ops = diff(baseline.message, frozen)
+        result = ops, None if ops is None else len(json.dumps(ops))
+        if memoize:
+            self.patches[id(baseline.message)] = baseline.message, result
+        return result
@@ -0,0 +1,174 @@
+"""
+The location of WAMP sessions across the cluster, so a message dispatched to
+some sessions only (the ``eligible`` of
+:meth:`autobahn.wamp1.protocol.WampServerFactory.dispatch`) is only sent to
+the nodes hosting them.
+
+Consumers announce the sessions of their users to the producers with PSC206,
+if the ``targets`` extension is in use.  A targeted publish carries the
+eligible and excluded sessions hosted by the consumer it is sent to, which
+the consumer dispatches it to accordingly.
+
+"""
+from collections import namedtuple
+
+from twisted.internet import reactor
+
+
+BATCH_PERIOD = 0.05  # Seconds to gather session changes before announcing
+CHUNK = 1000  # Session IDs per PSC206
+
+#: The WAMP sessions a publish is for.  ``eligible`` is ``None`` for every
+#: session, or a frozenset of session IDs.  ``exclude`` is a frozenset of
+#: session IDs.
+Targets = namedtuple('Targets', 'eligible exclude')
+
+
+def make_targets(eligible=None, exclude=(), directory=None):
+    """
+    The targets of a publish from the ``eligible`` and ``exclude`` session
+    IDs of a dispatch.
+
+    :param directory:  If given, the sessions excluded are narrowed to those
+        hosted on other nodes, as Autobahn excludes the publishing session
+        (which is local) from nearly every publish.
+    :type directory:  :class:`SessionDirectory`
+
+    :returns:  The :class:`Targets`, or ``None`` for every session.
+
+    """
+    exclude = frozenset(exclude or ())
+    if eligible is not None:
+        eligible = frozenset(eligible) - exclude
+    if directory is not None:
+        exclude = frozenset(id for id in exclude if id in directory)
+    if eligible is None and not exclude:
+        return None
+    return Targets(eligible, exclude)
+
+
+def narrow(targets, hosted):
+    """
+    The targets of a publish among the sessions hosted by a consumer.
+
+    :returns:  The :class:`Targets`, or ``None`` if no session of the
+        consumer is eligible.
+
+    """
+    eligible = targets.eligible
+    if eligible is not None:
+        eligible = eligible & hosted
+        if not eligible:
+            return None
+    return Targets(eligible, targets.exclude & hosted)
+
+
+class SessionDirectory(object):
+    """
+    The producer's record of the consumers hosting each session.
+
+    """
+    def __init__(self):
+        #: The connections hosting each session ID.
+        self.locations = dict()
+
+    def __len__(self):
+        return len(self.locations)
+
+    def __contains__(self, id):
+        return id in self.locations
+
+    def add(self, node, ids):
+        """
+        Record sessions as hosted by the consumer of a connection.
+
+        :returns:  The sessions which weren't located before.
+        :rtype:  list
+
+        """
+        located = []
+        for id in ids:
+            nodes = self.locations.get(id)
+            if nodes is None:
+                nodes = self.locations[id] = set()
+                located.append(id)
+            nodes.add(node)
+        return located
+
+    def remove(self, node, ids):
+        """
+        Forget sessions hosted by the consumer of a connection.
+
+        :returns:  The sessions no longer hosted anywhere.
+        :rtype:  list
+
+        """
+        gone = []
+        for id in ids:
+            nodes = self.locations.get(id)
+            if nodes is None:
+                continue
+            nodes.discard(node)
+            if not nodes:
+                del self.locations[id]
+                gone.append(id)
+        return gone
+
+    def locate(self, ids):
+        """
+        :returns:  The connections hosting any of the sessions.
+        :rtype:  set
+
+        """
+        found = set()
+        for id in ids:
+            nodes = self.locations.get(id)
+            if nodes:
+                found.update(nodes)
+        return found
+
+
+class LocalSessions(object):
+    """
+    The sessions hosted by a consumer, announced to the producers in batches.
+
+    :param announce:  Called with the sessions added and removed since the
+        last batch.
+
+    """
+    def __init__(self, announce):
+        self.announce = announce
+        self.sessions = set()
+        self.added = set()
+        self.removed = set()
+        self.call = None
+
+    def __iter__(self):
+        return iter(self.sessions)
+
+    def add(self, id):
+        self.sessions.add(id)
+        if id in self.removed:
+            self.removed.discard(id)
+        else:
+            self.added.add(id)
+        self.schedule()
+
+    def remove(self, id):
+        self.sessions.discard(id)
+        if id in self.added:
+            self.added.discard(id)
+        else:
+            self.removed.add(id)
+        self.schedule()
+
+    def schedule(self):
+        if self.call is None:
+            self.call = reactor.callLater(BATCH_PERIOD, self.flush)
+
+    def flush(self):
+        self.call = None
+        added, removed = self.added, self.removed
+        self.added, self.removed = set(), set()
+        if added or removed:
+            self.announce(added, removed)
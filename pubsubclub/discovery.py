@@ -0,0 +1,272 @@
+"""
+Node discovery.  A backend finds the servers of the cluster and reports the
+whole list whenever it may have changed, and :class:`Discovery` reconciles
+the client's connections with it:  servers which appeared are connected to
+and servers which disappeared are disconnected from.  Changes are debounced,
+so a burst of them (e.g. a rolling restart, or a flapping health check) is
+applied at once.
+
+Besides :class:`pubsubclub.consul.ConsulDiscovery`, :class:`FileDiscovery`
+follows a static list of servers in a file, watched with inotify.  Other
+backends (e.g. DNS SRV records) subclass :class:`Discovery`, implementing
+:meth:`Discovery.start` and :meth:`Discovery.stop`, and calling
+:meth:`Discovery.update` with the servers found.  They share the
+debouncing, the statistics and the :meth:`Discovery.connect` and
+:meth:`Discovery.disconnect` hooks.
+
+"""
+from __future__ import absolute_import
+
+import os
+import time
+
+from twisted.internet import reactor
+from twisted.python import log
+
+from .base import is_self
+from .stats import Counters
+
+
+DEBOUNCE_PERIOD = 30.0  # How long to wait before applying changes
+
+
+class Discovery(object):
+    """
+    The base class of discovery backends.
+
+    :param client:  The producer or consumer client to connect.
+    :param debounce:  The seconds to wait before applying changes, by
+        default :data:`DEBOUNCE_PERIOD`.
+    :type debounce:  float
+
+    """
+    #: The name of the backend in the logs.
+    name = 'Discovery'
+
+    def __init__(self, client, debounce=None):
+        self.client = client
+        self.debounce = debounce
+        #: The ``(host, port)`` of the servers listed, other than this node.
+        self.nodes = set()
+        self.counters = Counters()
+        #: When the nodes last changed.
+        self.changed = None
+        self.latest = None
+        self.call = None
+
+    @property
+    def debounce_period(self):
+        if self.debounce is not None:
+            return self.debounce
+        return DEBOUNCE_PERIOD
+
+    def start(self):
+        """
+        Start following the servers of the cluster.
+
+        """
+        raise NotImplementedError
+
+    def stop(self):
+        """
+        Stop following the servers, dropping any change not applied yet.
+
+        """
+        self._cancel()
+
+    def _cancel(self):
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+
+    def update(self, ids, debounce=True):
+        """
+        Report the servers currently listed.
+
+        :param ids:  The node ID (or ``None`` if unknown) of each server, by
+            ``(host, port)``.
+        :type ids:  dict
+        :param debounce:  Whether to wait for further changes before applying
+            them, rather than applying them right away (e.g. for the first
+            list).
+        :type debounce:  bool
+
+        """
+        self.counters.incr('updates')
+        self.latest = ids
+        if not debounce:
+            self._cancel()
+            self._apply()
+        elif self.call is None:
+            self.call = reactor.callLater(self.debounce_period, self._apply)
+
+    def _apply(self):
+        self.call = None
+        ids, self.latest = self.latest, None
+        self.reconcile(ids)
+
+    def reconcile(self, ids):
+        """
+        Connect to the servers which appeared and disconnect from those which
+        disappeared, skipping this node.
+
+        """
+        self.counters.incr('reconciles')
+        own_id = getattr(self.client, 'id', None)
+        new_nodes = set(
+            node for node, id in ids.items() if not is_self(own_id, id)
+        )
+        # Nodes that have appeared.  A node which drained its connection is
+        # only connected to again once it has been unlisted and listed again,
+        # as it is no longer listening while it stays listed.
+        for node in new_nodes - self.nodes:
+            log.msg('{0}:  Connecting to {1}:{2}'.format(self.name, *node))
+            self.counters.incr('connects')
+            self.connect(node[0], node[1], ids[node])
+        # Nodes that have disappeared
+        for node in self.nodes - new_nodes:
+            log.msg('{0}:  Disconnecting from {1}:{2}'.format(
+                self.name, *node
+            ))
+            self.counters.incr('disconnects')
+            self.disconnect(*node)
+        if new_nodes != self.nodes:
+            self.changed = time.time()
+        self.nodes = new_nodes
+
+    def connect(self, host, port, id=None):
+        """
+        Connect the client to a server which appeared.  Override to schedule
+        connections differently, e.g. to spread them out.
+
+        """
+        self.client.connect(host, port, id=id)
+
+    def disconnect(self, host, port):
+        """
+        Disconnect the client from a server which disappeared.
+
+        """
+        self.client.disconnect(host, port)
+
+    def failed(self, failure):
+        """
+        Log a failure of the backend.
+
+        """
+        self.counters.incr('errors')
+        log.msg('{0}:  {1}'.format(self.name, failure.getErrorMessage()))
+        failure.printTraceback()
+
+    def stats(self):
+        """
+        :returns:  The updates reported by the backend, the reconciliations,
+            connects, disconnects and errors, the servers listed, whether a
+            change is waiting to be applied, and the seconds since the
+            servers last changed.
+        :rtype:  dict
+
+        """
+        stats = self.counters.snapshot()
+        stats['nodes'] = len(self.nodes)
+        stats['pending'] = self.call is not None
+        stats['since_change'] = (
+            None if self.changed is None else time.time() - self.changed
+        )
+        return stats
+
+
+def parse_nodes(text):
+    """
+    Parse a list of servers, one per line as ``host:port``, optionally
+    followed by the node ID.  Blank lines and ``#`` comments are skipped.
+
+    :returns:  The node ID (or ``None``) of each server by ``(host, port)``.
+    :rtype:  dict
+
+    :raises ValueError:  if a line is malformed.
+
+    """
+    ids = dict()
+    for number, line in enumerate(text.splitlines(), 1):
+        fields = line.split('#', 1)[0].split()
+        if not fields:
+            continue
+        try:
+            host, port = fields[0].rsplit(':', 1)
+            id = int(fields[1]) if len(fields) > 1 else None
+            ids[(host.strip('[]'), int(port))] = id
+        except (ValueError, IndexError):
+            raise ValueError('Line {0}:  {1!r}'.format(number, line))
+    return ids
+
+
+class FileDiscovery(Discovery):
+    """
+    Follows the servers listed in a file (see :func:`parse_nodes`), which
+    is watched with inotify rather than polled.  The directory is watched,
+    so the file may be replaced by renaming a new one over it.  A file which
+    doesn't exist lists no servers, and a malformed one is ignored.
+
+    Needs Linux.
+
+    :param path:  The file listing the servers.
+    :type path:  str
+    :param client:  The producer or consumer client to connect.
+
+    """
+    name = 'FileDiscovery'
+
+    def __init__(self, path, client, debounce=None):
+        super(FileDiscovery, self).__init__(client, debounce)
+        self.path = os.path.abspath(path)
+        self.notifier = None
+
+    def start(self):
+        from twisted.internet import inotify
+        from twisted.python.filepath import FilePath
+        log.msg('{0}:  Watching {1}'.format(self.name, self.path))
+        self.notifier = inotify.INotify()
+        self.notifier.startReading()
+        self.notifier.watch(
+            FilePath(os.path.dirname(self.path)),
+            mask=(
+                inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                inotify.IN_MOVED_FROM | inotify.IN_DELETE
+            ),
+            callbacks=[self._notified],
+        )
+        self.read(debounce=False)
+
+    def stop(self):
+        super(FileDiscovery, self).stop()
+        if self.notifier is not None:
+            self.notifier.loseConnection()
+            self.notifier = None
+
+    def _notified(self, ignored, path, mask):
+        if path.path == self.path:
+            self.read()
+
+    def read(self, debounce=True):
+        """
+        Read the file, and report the servers it lists.
+
+        """
+        try:
+            with open(self.path) as nodes:
+                text = nodes.read()
+        except IOError as exc:
+            log.msg('{0}:  Cannot read {1}:  {2}'.format(
+                self.name, self.path, exc.strerror,
+            ))
+            text = ''
+        try:
+            ids = parse_nodes(text)
+        except ValueError as exc:
+            self.counters.incr('errors')
+            log.msg('{0}:  Ignoring {1}, {2}'.format(
+                self.name, self.path, exc,
+            ))
+            return
+        self.update(ids, debounce)
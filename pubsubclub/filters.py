@@ -0,0 +1,137 @@
+"""
+Content filters on subscriptions, evaluated by the producer so that events a
+consumer doesn't want never cross the network.
+
+A filter expression is an object mapping field paths to conditions, all of
+which must hold for a message to be sent.  A field path names a key of the
+message, with dots separating the keys of nested objects.  A condition is
+either a value the field must equal, or an object ``{"in": [...]}`` listing
+the values the field may have.  For example::
+
+    {"user.id": 42, "kind": {"in": ["created", "deleted"]}}
+
+Only JSON scalars may be compared, so evaluating a filter is cheap and safe
+whatever the consumer sends.
+
+"""
+import json
+import weakref
+
+from twisted.python import log
+
+
+SCALARS = (basestring, int, long, float, bool, type(None))
+
+_MISSING = object()
+
+
+def compile_filter(expression):
+    """
+    Compile a filter expression.
+
+    :raises ValueError:  if the expression is invalid.
+    :rtype:  :class:`Filter`
+
+    """
+    if not isinstance(expression, dict) or not expression:
+        raise ValueError('A filter must be a non-empty object')
+    conditions = []
+    for path, condition in sorted(expression.items()):
+        if not isinstance(path, basestring) or not path:
+            raise ValueError('Invalid field path {0!r}'.format(path))
+        if isinstance(condition, dict):
+            values = condition.get('in')
+            if len(condition) != 1 or not isinstance(values, list):
+                raise ValueError('Invalid condition on {0}'.format(path))
+            if not all(isinstance(value, SCALARS) for value in values):
+                raise ValueError('Non-scalar values for {0}'.format(path))
+            condition = frozenset(values)
+        elif isinstance(condition, SCALARS):
+            condition = frozenset([condition])
+        else:
+            raise ValueError('Non-scalar value for {0}'.format(path))
+        conditions.append((tuple(path.split('.')), condition))
+    return Filter(expression, conditions)
+
+
+class Filter(object):
+    """
+    A compiled filter expression.  Call with a message to evaluate it.
+
+    The result is remembered along with the generation of the publish (see
+    :attr:`FilterCache.generation`), so a publish is only evaluated once
+    however many consumers share the filter.
+
+    """
+    __slots__ = (
+        'expression', 'conditions', 'generation', 'result', '__weakref__',
+    )
+
+    def __init__(self, expression, conditions):
+        self.expression = expression
+        #: Pairs of path (tuple of keys) and set of accepted values.
+        self.conditions = conditions
+        self.generation = None
+        self.result = False
+
+    def __call__(self, message, generation=None):
+        if generation is not None and generation == self.generation:
+            return self.result
+        result = all(
+            self._matches(message, path, values)
+            for path, values in self.conditions
+        )
+        self.generation, self.result = generation, result
+        return result
+
+    @staticmethod
+    def _matches(message, path, values):
+        for key in path:
+            if not isinstance(message, dict):
+                return False
+            message = message.get(key, _MISSING)
+        if message is _MISSING or not isinstance(message, SCALARS):
+            return False
+        return message in values
+
+
+def filter_key(expression):
+    """
+    A canonical form of a filter expression, identifying equivalent ones.
+
+    """
+    return json.dumps(expression, sort_keys=True)
+
+
+class FilterCache(object):
+    """
+    The compiled filters in use, shared by every connection using the same
+    expression.  Filters are forgotten once no connection uses them.
+
+    """
+    def __init__(self):
+        self.filters = weakref.WeakValueDictionary()
+        #: Incremented for each publish, to tell publishes apart.
+        self.generation = 0
+
+    def __len__(self):
+        return len(self.filters)
+
+    def get(self, expression):
+        """
+        Get the compiled filter for an expression.
+
+        :returns:  The filter, or ``None`` if the expression is invalid.
+        :rtype:  :class:`Filter`
+
+        """
+        key = filter_key(expression)
+        compiled = self.filters.get(key)
+        if compiled is None:
+            try:
+                compiled = compile_filter(expression)
+            except ValueError as exc:
+                log.msg('Ignoring invalid filter {0}:  {1}'.format(key, exc))
+                return None
+            self.filters[key] = compiled
+        return compiled
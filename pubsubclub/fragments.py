@@ -0,0 +1,154 @@
+"""
+Splitting of large messages into PSC302 fragments and their reassembly.  The
+fragments of a message are interleaved with other traffic on the connection,
+so a large publish doesn't hold up every other topic until it's written.
+
+Rather than being serialized again as a JSON string, which would escape
+every quote of the message, a fragment is sent as the JSON header of the
+PSC302 followed by a newline and the raw slice of the serialized message.
+
+"""
+import json
+
+from twisted.python import log
+
+
+FRAGMENT_SIZE = 64 * 1024  # Split messages larger than this, in bytes
+MAX_MESSAGE_SIZE = 16 * 1024 * 1024  # Default limit on a message, in bytes
+OVERSIZE_FACTOR = 2  # Times the limit at which a message fails the connection
+MAX_PARTIAL_MESSAGES = 4  # Messages reassembled at once per connection
+FRAGMENT_PREFIX = '[302,'  # How the frames of fragments start
+
+
+def parse_fragment(payload):
+    """
+    Parse the frame of a fragment (see :meth:`Fragments.next`).
+
+    :returns:  The PSC302 message, with the fragment as its last parameter.
+    :rtype:  list
+
+    :raises ValueError:  if the frame is malformed.
+
+    """
+    header, sep, chunk = payload.partition('\n')
+    if not sep:
+        raise ValueError('Fragment without a header')
+    return json.loads(header) + [chunk]
+
+
+class Fragments(object):
+    """
+    A serialized message being sent as a series of fragments.
+
+    :param topic:  The topic of the message.
+    :type topic:  str
+    :param id:  Identifies the message among the connection's fragments.
+    :type id:  int
+    :param data:  The serialized message.
+    :type data:  str
+    :param size:  The largest frame to send, header included.
+    :type size:  int
+
+    """
+    __slots__ = ('topic', 'id', 'data', 'offset', 'size')
+
+    def __init__(self, topic, id, data, size=FRAGMENT_SIZE):
+        self.topic = topic
+        self.id = id
+        self.data = data
+        self.offset = 0
+        self.size = size
+
+    @property
+    def remaining(self):
+        return self.offset < len(self.data)
+
+    def header(self, final=False):
+        return json.dumps([302, self.id, final]) + '\n'
+
+    @property
+    def chunk_size(self):
+        """
+        The bytes of the message which fit in a frame besides the header.
+
+        """
+        return max(1, self.size - len(self.header()))
+
+    @property
+    def next_size(self):
+        """
+        The bytes of the next frame.
+
+        """
+        chunk = min(self.chunk_size, len(self.data) - self.offset)
+        return len(self.header(self.offset + chunk >= len(self.data))) + chunk
+
+    def next(self):
+        """
+        :returns:  The frame of the next fragment.
+        :rtype:  str
+
+        """
+        chunk = self.data[self.offset:self.offset + self.chunk_size]
+        self.offset += len(chunk)
+        return self.header(not self.remaining) + chunk
+
+
+class Reassembly(object):
+    """
+    Collects the fragments received on a connection.  Memory is bounded by
+    the maximum message size and the number of messages being reassembled at
+    once; messages exceeding those limits are dropped.
+
+    :param max_message_size:  The largest message to accept, in bytes.
+    :type max_message_size:  int
+
+    """
+    __slots__ = ('max_message_size', 'partial', 'sizes', 'dropped')
+
+    def __init__(self, max_message_size=MAX_MESSAGE_SIZE):
+        self.max_message_size = max_message_size
+        self.partial = dict()
+        self.sizes = dict()
+        self.dropped = set()
+
+    def add(self, id, final, chunk):
+        """
+        Add a fragment.
+
+        :returns:  The complete message if this was the final fragment,
+            ``None`` otherwise.
+        :rtype:  str
+
+        """
+        if id in self.dropped:
+            if final:
+                self.dropped.discard(id)
+            return None
+        if id not in self.partial:
+            if len(self.partial) >= MAX_PARTIAL_MESSAGES:
+                self._drop(min(self.partial), 'too many partial messages')
+            self.partial[id] = []
+            self.sizes[id] = 0
+        self.partial[id].append(chunk)
+        self.sizes[id] += len(chunk)
+        if self.max_message_size and self.sizes[id] > self.max_message_size:
+            self._drop(id, 'message too large')
+            if final:
+                self.dropped.discard(id)
+            return None
+        if not final:
+            return None
+        del self.sizes[id]
+        return ''.join(self.partial.pop(id))
+
+    def _drop(self, id, reason):
+        log.msg('Dropping fragmented message {0}:  {1}'.format(id, reason))
+        del self.partial[id]
+        del self.sizes[id]
+        self.dropped.add(id)
+
+    def clear(self):
+        self.partial.clear()
+        self.sizes.clear()
+        self.dropped.clear()
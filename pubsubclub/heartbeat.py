@@ -0,0 +1,292 @@
+"""
+A heartbeat scheduler shared by all connections.  Rather than each connection
+scheduling its own pings, connections are placed in the slots of a timing
+wheel which is advanced by a single timer.
+
+Liveness is judged with a phi accrual failure detector fed by the round-trip
+times of the pings, so a peer is only declared dead once a pong is overdue
+with respect to the RTTs measured so far.  A pong is always given at least
+:data:`MIN_PONG_WAIT`, and must be overdue on two consecutive checks, so that
+a pong read late because the reactor was busy doesn't drop the connection.
+
+"""
+from __future__ import absolute_import
+
+import math
+import random
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+INTERVAL = 5.0  # Seconds between pings to a peer
+TICK = 0.5  # Resolution of the timing wheel
+CHECK_INTERVAL = 1.0  # How often to check up on an overdue pong
+PHI_THRESHOLD = 8.0  # Suspicion level at which a peer is declared dead
+ACCEPTABLE_PAUSE = 5.0  # Added to the expected RTT to tolerate a busy reactor
+MIN_STD_DEVIATION = 0.5  # Floor for the RTT deviation, for very stable links
+MIN_PONG_WAIT = 7.0  # Never declare a peer dead sooner than this
+MAX_PONG_WAIT = 30.0  # Declare a peer dead after this long, regardless
+INITIAL_RTT = 0.1  # Assumed RTT before the first pong
+
+
+def phi(elapsed, mean, std_deviation):
+    """
+    The suspicion level of a peer, given the time elapsed since the ping was
+    sent and the distribution of the RTT.  Uses a logistic approximation of
+    the cumulative normal distribution.
+
+    :returns:  ``-log10`` of the probability of the pong still arriving.
+    :rtype:  float
+
+    """
+    y = (elapsed - mean) / std_deviation
+    e = math.exp(-y * (1.5976 + 0.070566 * y * y))
+    if elapsed > mean:
+        if e == 0.0:  # Underflow, the pong is hopelessly late
+            return float('inf')
+        return -math.log10(e / (1.0 + e))
+    return -math.log10(1.0 - 1.0 / (1.0 + e))
+
+
+class Liveness(object):
+    """
+    Tracks the pings sent to a single peer and the RTT measured from them.
+
+    """
+    __slots__ = (
+        'sequence', 'sent_at', 'count', 'mean', 'variance', 'last',
+        'minimum', 'maximum', 'suspected',
+    )
+
+    def __init__(self):
+        self.sequence = 0
+        self.sent_at = None
+        self.count = 0
+        self.mean = INITIAL_RTT
+        self.variance = (INITIAL_RTT / 2) ** 2
+        self.last = None
+        self.minimum = None
+        self.maximum = None
+        #: Whether the pong was overdue at the previous check.
+        self.suspected = False
+
+    @property
+    def outstanding(self):
+        return self.sent_at is not None
+
+    @property
+    def std_deviation(self):
+        return max(math.sqrt(self.variance), MIN_STD_DEVIATION)
+
+    def ping(self, now):
+        """
+        Record a ping being sent.
+
+        :returns:  The payload to send with the ping.
+        :rtype:  str
+
+        """
+        self.sequence += 1
+        self.sent_at = now
+        self.suspected = False
+        return str(self.sequence)
+
+    def pong(self, payload, now):
+        """
+        Record a pong being received.  Pongs which don't answer the outstanding
+        ping are ignored.
+
+        """
+        if not self.outstanding or payload != str(self.sequence):
+            return
+        rtt = now - self.sent_at
+        self.sent_at = None
+        self.suspected = False
+        # Smoothed like TCP's SRTT and RTTVAR.
+        if self.count == 0:
+            self.mean = rtt
+            self.variance = (rtt / 2) ** 2
+        else:
+            self.variance += 0.25 * ((rtt - self.mean) ** 2 - self.variance)
+            self.mean += 0.125 * (rtt - self.mean)
+        self.count += 1
+        self.last = rtt
+        self.minimum = rtt if self.minimum is None else min(self.minimum, rtt)
+        self.maximum = rtt if self.maximum is None else max(self.maximum, rtt)
+
+    def phi(self, now):
+        """
+        The suspicion level for the outstanding ping, or ``0.0`` if there is
+        none.
+
+        """
+        if not self.outstanding:
+            return 0.0
+        return phi(
+            now - self.sent_at,
+            self.mean + ACCEPTABLE_PAUSE,
+            self.std_deviation,
+        )
+
+    def overdue(self, now):
+        """
+        Whether the pong to the outstanding ping is overdue.
+
+        """
+        if not self.outstanding:
+            return False
+        elapsed = now - self.sent_at
+        if elapsed < MIN_PONG_WAIT:
+            return False
+        return elapsed > MAX_PONG_WAIT or self.phi(now) > PHI_THRESHOLD
+
+    def is_dead(self, now):
+        """
+        Check up on the outstanding ping.  The peer is dead once the pong is
+        overdue at two consecutive checks, giving the reactor a chance to
+        read a pong which arrived while it was busy.
+
+        """
+        overdue = self.overdue(now)
+        dead = overdue and self.suspected
+        self.suspected = overdue
+        return dead
+
+    def stats(self):
+        """
+        :returns:  A dictionary of RTT statistics, in seconds.
+
+        """
+        return {
+            'count': self.count,
+            'last': self.last,
+            'mean': self.mean if self.count else None,
+            'std_deviation': self.std_deviation if self.count else None,
+            'min': self.minimum,
+            'max': self.maximum,
+        }
+
+
+class TimingWheel(object):
+    """
+    A hashed timing wheel.  Items are scheduled into slots which are visited
+    in turn by :meth:`advance`, giving O(1) scheduling and cancellation.
+
+    :param tick:  The duration of a slot, in seconds.
+    :type tick:  float
+    :param span:  The longest delay that will be scheduled, in seconds.
+    :type span:  float
+
+    """
+    def __init__(self, tick, span):
+        self.tick = tick
+        self.slots = [set() for _ in range(int(math.ceil(span / tick)) + 1)]
+        self.cursor = 0
+        self.positions = dict()
+
+    def __len__(self):
+        return len(self.positions)
+
+    def schedule(self, item, delay):
+        """
+        Schedule an item to be returned by :meth:`advance` after ``delay``
+        seconds, replacing any previous schedule of that item.
+
+        """
+        self.cancel(item)
+        ticks = max(1, int(math.ceil(delay / self.tick)))
+        ticks = min(ticks, len(self.slots) - 1)
+        position = (self.cursor + ticks) % len(self.slots)
+        self.slots[position].add(item)
+        self.positions[item] = position
+
+    def cancel(self, item):
+        position = self.positions.pop(item, None)
+        if position is not None:
+            self.slots[position].discard(item)
+
+    def advance(self):
+        """
+        Move to the next slot.
+
+        :returns:  The items which are due.
+        :rtype:  set
+
+        """
+        self.cursor = (self.cursor + 1) % len(self.slots)
+        due = self.slots[self.cursor]
+        self.slots[self.cursor] = set()
+        for item in due:
+            del self.positions[item]
+        return due
+
+
+class Heartbeat(object):
+    """
+    Sends pings to every registered connection and drops the connections
+    which stop answering.  Connections must have a ``liveness`` attribute
+    holding a :class:`Liveness` and implement ``sendPing``.
+
+    """
+    def __init__(self, interval=INTERVAL, tick=TICK, clock=reactor):
+        self.interval = interval
+        self.clock = clock
+        self.wheel = TimingWheel(tick, max(interval, CHECK_INTERVAL))
+        self.timer = LoopingCall(self._tick)
+        self.timer.clock = clock
+
+    def register(self, protocol):
+        """
+        Start sending pings to a connection.  The first ping is sent at a
+        random point in the interval, to spread pings out evenly.
+
+        """
+        self.wheel.schedule(protocol, random.uniform(0, self.interval))
+        if not self.timer.running:
+            self.timer.start(self.wheel.tick, now=False)
+
+    def unregister(self, protocol):
+        self.wheel.cancel(protocol)
+        if not self.wheel and self.timer.running:
+            self.timer.stop()
+
+    def _tick(self):
+        now = self.clock.seconds()
+        for protocol in self.wheel.advance():
+            self._beat(protocol, now)
+
+    def _beat(self, protocol, now):
+        liveness = protocol.liveness
+        if liveness.is_dead(now):
+            log.msg('Pong not received in time!')
+            self.unregister(protocol)
+            protocol.transport.loseConnection()
+            return
+        if liveness.outstanding:
+            self.wheel.schedule(protocol, CHECK_INTERVAL)
+            return
+        protocol.sendPing(liveness.ping(now))
+        self.wheel.schedule(protocol, self.interval)
+
+
+#: The heartbeat shared by all connections.
+HEARTBEAT = Heartbeat()
+
+
+def rtt_stats(nodes):
+    """
+    Gather RTT statistics for a set of connections.
+
+    :param nodes:  The connections.
+    :type nodes:  iterable of :class:`pubsubclub.base.ProtocolBase`
+
+    :returns:  The statistics for each connection, keyed by peer address.
+    :rtype:  dict
+
+    """
+    return dict(
+        (node.peer, node.liveness.stats())
+        for node in nodes if node.liveness is not None
+    )
@@ -0,0 +1,169 @@
+"""
+Tracking of the heaviest topics in bounded memory, to tell which topics
+dominate the fanout and the bandwidth however many topics there are.
+
+Each metric is counted per topic by a count-min sketch, a fixed grid of
+counters in which each topic has one counter per row:  a topic's count is
+overestimated by collisions, never underestimated, and the smallest of its
+counters is the best estimate.  The topics whose estimate is among the
+highest are kept alongside.  Counts cover the period since they were last
+logged.
+
+Tracking is off unless the containers are created with a
+``hitters_interval``, as it costs a few hash lookups per message.
+
+"""
+from __future__ import absolute_import
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+WIDTH = 1024  # Counters per row of a sketch
+DEPTH = 4  # Rows of a sketch
+TOP = 10  # Topics reported per metric
+LOG_INTERVAL = 300.0  # Seconds between logs of the heaviest topics
+
+#: The metrics counted, and what they count.
+METRICS = {
+    'published': 'messages published by this node',
+    'fanout': 'messages sent to consumers',
+    'sent_bytes': 'bytes of messages sent to consumers',
+    'received': 'messages received from producers',
+    'received_bytes': 'bytes of messages received from producers',
+}
+
+
+class TopK(object):
+    """
+    The heaviest topics of a metric, according to a count-min sketch.
+
+    :param k:  The topics to report.
+    :type k:  int
+
+    """
+    def __init__(self, k=TOP, width=WIDTH, depth=DEPTH):
+        self.k = k
+        self.width = width
+        self.depth = depth
+        self.counts = [0] * (width * depth)
+        #: The estimates of the heaviest topics seen, by topic.
+        self.candidates = dict()
+        #: A lower bound on the estimates of the candidates.
+        self.floor = 0
+
+    def add(self, topic, amount=1):
+        """
+        Count an amount for a topic.
+
+        :returns:  The estimated count of the topic.
+        :rtype:  int
+
+        """
+        counts, width = self.counts, self.width
+        h = hash(topic)
+        step = (h >> 16) | 1
+        estimate = None
+        for row in range(self.depth):
+            index = row * width + (h + row * step) % width
+            counts[index] += amount
+            if estimate is None or counts[index] < estimate:
+                estimate = counts[index]
+        candidates = self.candidates
+        if topic in candidates:
+            candidates[topic] = estimate
+        elif len(candidates) < self.k:
+            candidates[topic] = estimate
+            self.floor = min(candidates.values())
+        elif estimate > self.floor:
+            candidates[topic] = estimate
+            del candidates[min(candidates, key=candidates.get)]
+            self.floor = min(candidates.values())
+        return estimate
+
+    def estimate(self, topic):
+        h = hash(topic)
+        step = (h >> 16) | 1
+        return min(
+            self.counts[row * self.width + (h + row * step) % self.width]
+            for row in range(self.depth)
+        )
+
+    def top(self):
+        """
+        :returns:  Pairs of topic and estimated count, heaviest first.
+        :rtype:  list
+
+        """
+        return sorted(
+            self.candidates.items(), key=lambda item: item[1], reverse=True,
+        )
+
+    def clear(self):
+        self.counts = [0] * (self.width * self.depth)
+        self.candidates.clear()
+        self.floor = 0
+
+
+class HeavyHitters(object):
+    """
+    The heaviest topics of a container for each metric (see
+    :data:`METRICS`), logged periodically while anything is counted.
+
+    :param interval:  The seconds between logs, or ``None`` not to log.
+    :type interval:  float
+
+    """
+    def __init__(self, k=TOP, interval=LOG_INTERVAL, clock=reactor):
+        self.k = k
+        self.interval = interval
+        #: :class:`TopK` by metric, created when first counted.
+        self.sketches = dict()
+        self.timer = LoopingCall(self.log)
+        self.timer.clock = clock
+
+    def add(self, metric, topic, amount=1):
+        sketch = self.sketches.get(metric)
+        if sketch is None:
+            sketch = self.sketches[metric] = TopK(self.k)
+        if self.interval and not self.timer.running:
+            self.timer.start(self.interval, now=False)
+        sketch.add(topic, amount)
+
+    def top(self):
+        """
+        :returns:  The heaviest topics by metric, as returned by
+            :meth:`TopK.top`.
+        :rtype:  dict
+
+        """
+        return dict(
+            (metric, sketch.top())
+            for metric, sketch in self.sketches.items()
+        )
+
+    def log(self):
+        """
+        Log the heaviest topics, and start counting afresh.  Logging stops
+        until something is counted again if nothing was.
+
+        """
+        counted = False
+        for metric, top in sorted(self.top().items()):
+            if top:
+                counted = True
+                log.msg('Heaviest topics by {0}:  {1}'.format(
+                    METRICS.get(metric, metric), ', '.join(
+                        '{0} ({1})'.format(topic, count)
+                        for topic, count in top
+                    ),
+                ))
+        for sketch in self.sketches.values():
+            sketch.clear()
+        if not counted:
+            self.stop()
+
+    def stop(self):
+        if self.timer.running:
+            self.timer.stop()
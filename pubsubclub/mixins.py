@@ -4,8 +4,16 @@ The following classes are mixins in for a subclass of
 integrates PubSubClub into your WAMP application.
 
 """
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from twisted.internet import reactor
 from autobahn.wamp1 import protocol as wamp
 
+from .directory import make_targets
+
 
 class ProducerMixin:
     """
@@ -17,14 +25,33 @@ class ProducerMixin:
     #: :class`pubsubclub.ProducerServer`.
     producer = None
 
-    def dispatch(self, topic, event, exclude=[], eligible=None):
+    def dispatch(
+            self, topic, event, exclude=[], eligible=None, publisher=None,
+    ):
         """
         A PubSub message has been dispatched.  We need to send it out to all
-        the other nodes with subscribed users.
+        the other nodes with subscribed users, within the producer's rate
+        limits.  If only some sessions are ``eligible``, it's only sent to the
+        nodes hosting them (see :mod:`pubsubclub.directory`).
+
+        :param publisher:  The WAMP protocol of the session publishing the
+            message, for per-session rate limits.  Defaults to the only
+            excluded session, as Autobahn excludes publishers by default.
 
         """
         if self.producer is not None:
-            self.producer.publish(topic, event)
+            if publisher is None and exclude and len(exclude) == 1:
+                publisher = exclude[0]
+            targets = make_targets(
+                None if eligible is None
+                else self.protosToSessionIds(eligible),
+                self.protosToSessionIds(exclude or []),
+                self.producer.directory,
+            )
+            self.producer.publish_local(
+                topic, event, getattr(publisher, 'session_id', None),
+                targets,
+            )
         return wamp.WampServerFactory.dispatch(
             self, topic, event, exclude, eligible,
         )
@@ -43,6 +70,33 @@ class ConsumerMixin:
     #: :class:`pubsubclub.ConsumerServer`.
     consumer = None
 
+    #: Seconds to stay subscribed to a topic on the producers after the last
+    #: user has unsubscribed, in case another user subscribes soon after.
+    unsubscribe_linger = 0
+
+    #: The most topics to keep lingering.  Once exceeded, the least recently
+    #: abandoned topics are unsubscribed right away.
+    max_lingering = 1000
+
+    #: Map of the lingering topics and the delayed calls unsubscribing them.
+    lingering = None
+
+    def _addSession(self, proto, session_id):
+        """
+        Announce the WAMP sessions to the producers, so they can send the
+        messages for some sessions only to the nodes hosting them.
+
+        """
+        wamp.WampServerFactory._addSession(self, proto, session_id)
+        if self.consumer is not None:
+            self.consumer.session_opened(session_id)
+
+    def _removeSession(self, proto):
+        session_id = self.protoToSessionId(proto)
+        wamp.WampServerFactory._removeSession(self, proto)
+        if self.consumer is not None and session_id is not None:
+            self.consumer.session_closed(session_id)
+
     def onClientSubscribed(self, protocol, topic):
         """
         When a user has subscribed, check to see if it's the first
@@ -51,15 +105,51 @@ class ConsumerMixin:
         """
         if self.consumer is not None:
             if len(self.subscriptions[topic]) == 1:  # First subscription
-                self.consumer.subscribe(topic)
+                if self.lingering and topic in self.lingering:
+                    # Still subscribed on the producers
+                    self.lingering.pop(topic).cancel()
+                else:
+                    self.consumer.subscribe(
+                        topic, filter=self.subscription_filter(topic),
+                    )
+
+    def subscription_filter(self, topic):
+        """
+        Override to subscribe to only the messages of a topic which match a
+        filter expression (see :mod:`pubsubclub.filters`), evaluated by the
+        producers.
+
+        :returns:  The filter expression, or ``None`` for every message.
+        :rtype:  dict
+
+        """
+        return None
 
     def onClientUnsubscribed(self, protocol, topic):
         """
         When a user has unsubscribed, check to see if it's the last user
         subscribed to the topic.  If it is, send a subscription request to the
-        producer.
+        producer, after lingering for ``unsubscribe_linger`` seconds.
 
         """
         if self.consumer is not None:
             if topic not in self.subscriptions:
-                self.consumer.unsubscribe(topic)
+                if self.unsubscribe_linger > 0:
+                    self._linger(topic)
+                else:
+                    self.consumer.unsubscribe(topic)
+
+    def _linger(self, topic):
+        if self.lingering is None:
+            self.lingering = OrderedDict()
+        self.lingering[topic] = reactor.callLater(
+            self.unsubscribe_linger, self._stop_lingering, topic,
+        )
+        while len(self.lingering) > self.max_lingering:
+            oldest, call = self.lingering.popitem(last=False)
+            call.cancel()
+            self.consumer.unsubscribe(oldest)
+
+    def _stop_lingering(self, topic):
+        del self.lingering[topic]
+        self.consumer.unsubscribe(topic)
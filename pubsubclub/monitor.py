@@ -0,0 +1,274 @@
+"""
+Monitoring of the reactor, to tell a blocked reactor apart from a slow
+network when latency spikes.
+
+The reactor lag is how late a timer firing at a fixed interval runs:  any
+callback hogging the reactor delays it.  The time spent in each protocol
+callback (see :attr:`pubsubclub.base.ProtocolBase.CALLBACK_MAP`) is measured
+too, and the callbacks and lags above a threshold are logged and kept.  Only
+the connections of the containers created with ``monitor_reactor=True`` are
+monitored, and the timer only runs while one of them is open.
+
+To find out where the time goes, a sampling profiler can be toggled with
+:meth:`SamplingProfiler.toggle`, or with a signal once
+:func:`install_signal_handler` is called.  It logs the hottest pubsubclub code
+paths when stopped.
+
+"""
+from __future__ import absolute_import
+
+import os
+import signal
+import time
+from collections import deque
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+LAG_INTERVAL = 0.1  # Seconds between measurements of the reactor lag
+SLOW_THRESHOLD = 0.05  # Callbacks and lags longer than this are logged
+SLOW_EVENTS = 100  # Slow callbacks and lags kept for inspection
+PROFILE_INTERVAL = 0.005  # Seconds of CPU time between profiler samples
+PROFILE_DEPTH = 8  # Frames of each sampled code path
+PROFILE_TOP = 20  # Code paths reported by the profiler
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+class Timing(object):
+    """
+    Durations of a kind of event, in seconds.
+
+    """
+    __slots__ = ('count', 'total', 'maximum', 'slow')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+        self.slow = 0
+
+    def record(self, elapsed, slow=False):
+        self.count += 1
+        self.total += elapsed
+        self.maximum = max(self.maximum, elapsed)
+        if slow:
+            self.slow += 1
+
+    def stats(self):
+        return {
+            'count': self.count,
+            'mean': self.total / self.count if self.count else None,
+            'max': self.maximum,
+            'slow': self.slow,
+        }
+
+
+class ReactorMonitor(object):
+    """
+    Measures the reactor lag and the time spent in protocol callbacks.
+
+    :param interval:  The seconds between measurements of the lag.
+    :type interval:  float
+    :param threshold:  The duration above which a callback or lag is slow, in
+        seconds.
+    :type threshold:  float
+
+    """
+    def __init__(
+            self, interval=LAG_INTERVAL, threshold=SLOW_THRESHOLD,
+            clock=reactor,
+    ):
+        self.interval = interval
+        self.threshold = threshold
+        self.clock = clock
+        self.lag = Timing()
+        #: :class:`Timing` of each protocol callback, by name.
+        self.callbacks = dict()
+        #: The latest slow events, as tuples of time, name and duration.
+        self.slow_events = deque(maxlen=SLOW_EVENTS)
+        self.last_tick = None
+        self.timer = LoopingCall(self._tick)
+        self.timer.clock = clock
+        #: The connections being monitored.
+        self.protocols = set()
+
+    @property
+    def running(self):
+        return self.timer.running
+
+    def register(self, protocol):
+        """
+        Start monitoring with the first connection.
+
+        """
+        self.protocols.add(protocol)
+        self.start()
+
+    def unregister(self, protocol):
+        """
+        Stop monitoring once the last connection has closed.
+
+        """
+        self.protocols.discard(protocol)
+        if not self.protocols:
+            self.stop()
+
+    def start(self):
+        if not self.timer.running:
+            self.last_tick = self.clock.seconds()
+            self.timer.start(self.interval, now=False)
+
+    def stop(self):
+        if self.timer.running:
+            self.timer.stop()
+
+    def _tick(self):
+        now = self.clock.seconds()
+        lag = max(0.0, now - self.last_tick - self.interval)
+        self.last_tick = now
+        slow = lag > self.threshold
+        self.lag.record(lag, slow)
+        if slow:
+            self.slow_events.append((now, 'reactor lag', lag))
+            log.msg('Reactor lagging by {0:.0f} ms'.format(lag * 1000))
+
+    def record(self, name, elapsed, peer=None):
+        """
+        Record the time spent in a protocol callback.
+
+        """
+        timing = self.callbacks.get(name)
+        if timing is None:
+            timing = self.callbacks[name] = Timing()
+        slow = elapsed > self.threshold
+        timing.record(elapsed, slow)
+        if slow:
+            self.slow_events.append((time.time(), name, elapsed))
+            log.msg('Slow {0} from {1} took {2:.0f} ms'.format(
+                name, peer, elapsed * 1000,
+            ))
+
+    def stats(self):
+        """
+        :returns:  The reactor lag and callback durations, in seconds.
+        :rtype:  dict
+
+        """
+        return {
+            'lag': self.lag.stats(),
+            'callbacks': dict(
+                (name, timing.stats())
+                for name, timing in self.callbacks.items()
+            ),
+            'slow': list(self.slow_events),
+        }
+
+
+class SamplingProfiler(object):
+    """
+    Samples the code running at regular intervals of CPU time, counting the
+    code paths through pubsubclub.  Relies on ``SIGPROF``, so it is only
+    available on Unix.
+
+    :param interval:  The CPU time between samples, in seconds.
+    :type interval:  float
+
+    """
+    def __init__(self, interval=PROFILE_INTERVAL):
+        self.interval = interval
+        self.running = False
+        #: Sample counts by code path, see :meth:`_sample`.
+        self.samples = dict()
+
+    def start(self):
+        if self.running:
+            return
+        if not hasattr(signal, 'setitimer'):
+            raise RuntimeError('Profiling needs signal.setitimer')
+        self.samples.clear()
+        signal.signal(signal.SIGPROF, self._sample)
+        signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+        self.running = True
+        log.msg('Profiler started.')
+
+    def stop(self):
+        """
+        Stop sampling and log the hottest code paths.
+
+        """
+        if not self.running:
+            return
+        signal.setitimer(signal.ITIMER_PROF, 0, 0)
+        signal.signal(signal.SIGPROF, signal.SIG_DFL)
+        self.running = False
+        self.log_report()
+
+    def toggle(self):
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def _sample(self, signum, frame):
+        # The code path is the frame running, followed by the innermost
+        # pubsubclub frames leading to it.
+        path = []
+        leaf = True
+        while frame is not None and len(path) < PROFILE_DEPTH:
+            code = frame.f_code
+            if leaf or code.co_filename.startswith(PACKAGE_DIR):
+                path.append((
+                    os.path.basename(code.co_filename), frame.f_lineno,
+                    code.co_name,
+                ))
+            leaf = False
+            frame = frame.f_back
+        path = tuple(path)
+        self.samples[path] = self.samples.get(path, 0) + 1
+
+    def report(self, top=PROFILE_TOP):
+        """
+        :returns:  The most sampled code paths and their share of the
+            samples, hottest first.  Paths are lists of ``file:line
+            (function)`` strings, innermost first.
+        :rtype:  list of (float, list) tuples
+
+        """
+        total = float(sum(self.samples.values())) or 1.0
+        hottest = sorted(
+            self.samples.items(), key=lambda item: item[1], reverse=True,
+        )[:top]
+        return [
+            (count / total, [
+                '{0}:{1} ({2})'.format(*frame) for frame in path
+            ])
+            for path, count in hottest
+        ]
+
+    def log_report(self, top=PROFILE_TOP):
+        log.msg('Profiler stopped after {0} samples, hottest paths:'.format(
+            sum(self.samples.values()),
+        ))
+        for share, path in self.report(top):
+            log.msg('{0:5.1%}  {1}'.format(share, ' < '.join(path)))
+
+
+#: The monitor of the reactor, running while connections are monitored.
+MONITOR = ReactorMonitor()
+
+#: The profiler of the process.
+PROFILER = SamplingProfiler()
+
+
+def install_signal_handler(signum=getattr(signal, 'SIGUSR2', None)):
+    """
+    Toggle :data:`PROFILER` whenever the process receives a signal.
+
+    :param signum:  The signal, ``SIGUSR2`` by default.
+    :type signum:  int
+
+    """
+    signal.signal(signum, lambda signum, frame: PROFILER.toggle())
@@ -0,0 +1,358 @@
+"""
+Outbound scheduling for a connection.  Control messages (handshakes and
+subscriptions) are written straight to the transport, while publishes are
+queued and only written while the transport is not backlogged.  That way a
+link busy with large publishes still delivers control messages promptly.
+
+Publishes can be assigned priority classes by topic prefix, in which case
+the queue of a higher priority (lower number) class is always drained first.
+
+Within a class, each topic has its own FIFO, and the topics with messages
+queued share the connection by deficit round robin, so a busy topic can't
+hold up the others for longer than a round.  Topics can be given weights by
+prefix, a topic of weight 2 getting twice the bytes of a topic of weight 1
+while both are backlogged.
+
+Large publishes are queued as :class:`pubsubclub.fragments.Fragments`, which
+are sent one fragment at a time, taking turns with the other topics.  Later
+messages for the same topic queue up behind them, so the order of each topic
+is kept.
+
+"""
+from __future__ import division
+
+import time
+from collections import deque
+
+from .fragments import FRAGMENT_SIZE, Fragments
+
+
+DEFAULT_PRIORITY = 0  # The priority class of topics that match no prefix
+DEFAULT_WEIGHT = 1  # The weight of topics that match no prefix
+QUANTUM = FRAGMENT_SIZE  # Bytes per round for a topic of weight 1
+CACHE_SIZE = 10000  # Topics to remember the priority class of
+
+
+def is_data(action):
+    """
+    Whether a message is data (a publication) rather than control.
+
+    """
+    return 300 <= action < 400
+
+
+def jain_index(values):
+    """
+    Jain's fairness index of some allocations:  ``1.0`` when they are all
+    equal, down to ``1 / n`` when one gets everything.
+
+    """
+    values = list(values)
+    squares = sum(value * value for value in values)
+    if not squares:
+        return 1.0
+    return sum(values) ** 2 / (len(values) * squares)
+
+
+class PrefixMap(object):
+    """
+    Assigns values to topics by prefix.  The longest matching prefix wins.
+
+    :param prefixes:  Pairs of topic prefix and value.
+    :type prefixes:  list of tuples
+    :param default:  The value for topics matching no prefix.
+
+    """
+    def __init__(self, prefixes=(), default=None):
+        self.prefixes = sorted(
+            prefixes, key=lambda item: len(item[0]), reverse=True,
+        )
+        self.default = default
+        self.cache = dict()
+
+    def __call__(self, topic):
+        try:
+            return self.cache[topic]
+        except KeyError:
+            pass
+        result = self.default
+        for prefix, value in self.prefixes:
+            if topic.startswith(prefix):
+                result = value
+                break
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[topic] = result
+        return result
+
+
+class PriorityClasses(PrefixMap):
+    """
+    Assigns topics to priority classes by prefix.
+
+    :param prefixes:  Pairs of topic prefix and priority class, where ``0`` is
+        the highest priority.
+    :type prefixes:  list of (str, int) tuples
+    :param default:  The class for topics matching no prefix.
+    :type default:  int
+
+    """
+    def __init__(self, prefixes=(), default=DEFAULT_PRIORITY):
+        super(PriorityClasses, self).__init__(prefixes, default)
+        self.count = max(
+            [default] + [priority for _, priority in self.prefixes]
+        ) + 1
+
+
+class TopicWeights(PrefixMap):
+    """
+    Assigns topics their weight within their priority class by prefix.
+
+    :param prefixes:  Pairs of topic prefix and weight.
+    :type prefixes:  list of (str, float) tuples
+    :param default:  The weight of topics matching no prefix.
+    :type default:  float
+
+    """
+    def __init__(self, prefixes=(), default=DEFAULT_WEIGHT):
+        for prefix, weight in prefixes:
+            if weight <= 0:
+                raise ValueError(
+                    'Weight of {0!r} must be positive'.format(prefix)
+                )
+        super(TopicWeights, self).__init__(prefixes, default)
+
+
+class FairLane(object):
+    """
+    The publishes queued for a priority class of a connection, in a FIFO per
+    topic.  The topics with messages queued take turns by deficit round
+    robin:  on its turn, a topic is credited its weight times
+    :data:`QUANTUM` bytes, and sends messages (or fragments) as long as its
+    credit covers them, keeping the rest for its next turn.
+
+    """
+    __slots__ = ('topics', 'active', 'deficits', 'granted', 'turn', 'length')
+
+    def __init__(self):
+        #: The ``(queued_at, payload)`` entries of each topic.
+        self.topics = dict()
+        #: The topics with messages queued, the first one having its turn.
+        self.active = deque()
+        #: The credit of each active topic, in bytes.
+        self.deficits = dict()
+        #: Whether the first active topic was credited for its turn.
+        self.granted = False
+        #: The bytes the first active topic sent on its turn.
+        self.turn = 0
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def push(self, topic, entry):
+        fifo = self.topics.get(topic)
+        if fifo is None:
+            fifo = self.topics[topic] = deque()
+            self.active.append(topic)
+            self.deficits[topic] = 0
+        fifo.append(entry)
+        self.length += 1
+
+    def pop(self, weights, stats=None):
+        """
+        Take the next message (or fragment) to write.
+
+        :param weights:  The :class:`TopicWeights`.
+        :param stats:  The :class:`OutboundStats` to record the turns of the
+            topics in, if any.
+
+        :returns:  The payload, and when the message was queued if this was
+            the last of it (``None`` otherwise).
+        :rtype:  tuple
+
+        """
+        active = self.active
+        while True:
+            topic = active[0]
+            fifo = self.topics[topic]
+            queued_at, item = fifo[0]
+            if isinstance(item, Fragments):
+                size = item.next_size
+            else:
+                size = len(item)
+            if len(active) == 1:
+                # Nothing to share the link with.
+                self.deficits[topic] = 0
+                self.granted = False
+                break
+            if not self.granted:
+                self.deficits[topic] += QUANTUM * weights(topic)
+                self.granted = True
+                self.turn = 0
+            if size <= self.deficits[topic]:
+                self.deficits[topic] -= size
+                self.turn += size
+                break
+            # The topic is still backlogged at the end of its turn.
+            if stats is not None:
+                stats.turn(topic, self.turn / weights(topic))
+            active.rotate(-1)
+            self.granted = False
+        if isinstance(item, Fragments):
+            payload = item.next()
+            if item.remaining:
+                return payload, None
+        else:
+            payload = item
+        fifo.popleft()
+        self.length -= 1
+        if not fifo:
+            del self.topics[topic]
+            del self.deficits[topic]
+            active.popleft()
+            self.granted = False
+        return payload, queued_at
+
+
+class OutboundQueue(object):
+    """
+    The publishes queued for a single connection, in a :class:`FairLane` per
+    priority class.  The lanes are only allocated once something is queued,
+    as connections to consumers never queue anything.
+
+    :param classes:  The priority classes.
+    :type classes:  :class:`PriorityClasses`
+    :param weights:  The weights of the topics within their class.
+    :type weights:  :class:`TopicWeights`
+    :param stats:  Where to record what is sent, if anywhere.
+    :type stats:  :class:`OutboundStats`
+
+    """
+    __slots__ = ('classes', 'weights', 'stats', 'lanes', 'length')
+
+    def __init__(self, classes, weights, stats=None):
+        self.classes = classes
+        self.weights = weights
+        self.stats = stats
+        self.lanes = ()
+        self.length = 0
+
+    def __len__(self):
+        return self.length
+
+    def push(self, topic, payload):
+        """
+        Queue a serialized message (or :class:`Fragments`) for the topic.
+
+        """
+        if not self.lanes:
+            self.lanes = [FairLane() for _ in range(self.classes.count)]
+        self.lanes[self.classes(topic)].push(topic, (time.time(), payload))
+        self.length += 1
+
+    def pop(self):
+        """
+        Take the next message (or fragment) to write, from the highest
+        priority class with messages queued.
+
+        :raises IndexError:  if the queue is empty.
+
+        """
+        for priority, lane in enumerate(self.lanes):
+            if lane:
+                payload, queued_at = lane.pop(self.weights, self.stats)
+                if queued_at is not None:
+                    self.length -= 1
+                    if self.stats is not None:
+                        self.stats.sent(priority, time.time() - queued_at)
+                return payload
+        raise IndexError('pop from an empty queue')
+
+    def clear(self):
+        self.lanes = ()
+        self.length = 0
+
+
+class OutboundStats(object):
+    """
+    Statistics of the outbound queues of a container's connections.
+
+    Besides the messages currently queued, the latency of each priority
+    class (from a publish being queued to its last byte being written) and
+    the fairness between the topics competing for congested links are
+    measured since the last :meth:`snapshot`.  Fairness is Jain's index of
+    the mean bytes per turn, divided by weight, of the topics which were
+    still backlogged at the end of their turn:  ``1.0`` means each got its
+    share of the link.
+
+    """
+    def __init__(self):
+        self.count = dict()
+        self.latency = dict()
+        self.max_latency = dict()
+        #: The weighted bytes sent and turns taken by each topic, for the
+        #: turns ending with the topic backlogged.
+        self.shares = dict()
+
+    def sent(self, priority, latency):
+        self.count[priority] = self.count.get(priority, 0) + 1
+        self.latency[priority] = self.latency.get(priority, 0.0) + latency
+        self.max_latency[priority] = max(
+            self.max_latency.get(priority, 0.0), latency,
+        )
+
+    def turn(self, topic, size):
+        share = self.shares.get(topic)
+        if share is None:
+            if len(self.shares) >= CACHE_SIZE:
+                return
+            share = self.shares[topic] = [0, 0]
+        share[0] += size
+        share[1] += 1
+
+    def snapshot(self, queues, classes):
+        """
+        :param queues:  The :class:`OutboundQueue` of each connection.
+        :param classes:  The number of priority classes.
+        :type classes:  int
+
+        :returns:  The messages queued (in total, for the most backlogged
+            connection and by class), the connections with messages queued,
+            the messages sent and their mean and maximum latency in seconds
+            by class, and the fairness index.
+        :rtype:  dict
+
+        """
+        lengths = []
+        queued = [0] * classes
+        for queue in queues:
+            lengths.append(len(queue))
+            for priority, lane in enumerate(queue.lanes):
+                if priority < classes:
+                    queued[priority] += len(lane)
+        stats = {
+            'outbound.queued': sum(lengths),
+            'outbound.queued_max': max(lengths or [0]),
+            'outbound.backlogged': sum(1 for length in lengths if length),
+            'outbound.fairness': jain_index(
+                size / turns for size, turns in self.shares.values()
+            ),
+            'outbound.contending_topics': len(self.shares),
+        }
+        for priority in range(classes):
+            prefix = 'outbound.class{0}.'.format(priority)
+            count = self.count.get(priority, 0)
+            stats[prefix + 'queued'] = queued[priority]
+            stats[prefix + 'sent'] = count
+            stats[prefix + 'latency_mean'] = (
+                self.latency[priority] / count if count else 0.0
+            )
+            stats[prefix + 'latency_max'] = self.max_latency.get(
+                priority, 0.0,
+            )
+        self.count = dict()
+        self.latency = dict()
+        self.max_latency = dict()
+        self.shares = dict()
+        return stats
@@ -0,0 +1,208 @@
+from __future__ import absolute_import
+
+from twisted.internet.defer import gatherResults
+from twisted.python import log
+
+from . import consumer, producer
+from .base import DRAIN_TIMEOUT, ContainerBase, make_client, make_server
+
+
+class PeerProtocol(consumer.ConsumerProtocol, producer.ProducerProtocol):
+    """
+    A protocol filling both the consumer and the producer role over a single
+    connection.
+
+    The server side behaves like a consumer server and the client side like a
+    producer client, so peers interoperate with single-role nodes following
+    the usual convention.  If both ends are peers, the ``peer`` extension is
+    negotiated and the reverse direction is set up over the same connection.
+
+    """
+    ROLE = 'peer'
+    SUPPORTED_VERSIONS = (
+        consumer.ConsumerProtocol.SUPPORTED_VERSIONS &
+        producer.ProducerProtocol.SUPPORTED_VERSIONS
+    )
+    EXTENSIONS = (
+        consumer.ConsumerProtocol.EXTENSIONS |
+        producer.ProducerProtocol.EXTENSIONS |
+        frozenset(['peer'])
+    )
+
+    @property
+    def consuming(self):
+        """
+        Whether we act as a consumer on this connection.
+
+        """
+        return self.factory.isServer or 'peer' in self.extensions
+
+    @property
+    def producing(self):
+        """
+        Whether we act as a producer on this connection.
+
+        """
+        return not self.factory.isServer or 'peer' in self.extensions
+
+    @property
+    def initiator_id(self):
+        """
+        The ID of the node which opened this connection.
+
+        """
+        return self.remote_id if self.factory.isServer else self.factory.id
+
+    def onOpen(self):
+        producer.ProducerProtocol.onOpen(self)
+        if self.factory.isServer:
+            consumer.ConsumerProtocol.onOpen(self)
+
+    def onDeclaredVersions(self, *versions):
+        """
+        Choose the version as a producer.  If the consumer is a peer, start
+        consuming as well.
+
+        """
+        producer.ProducerProtocol.onDeclaredVersions(self, *versions)
+        if not self.ready or 'peer' not in self.extensions:
+            return
+        if self.close_duplicate():
+            return
+        self.replay_subscriptions()
+        self.send_sessions(self.factory.local_sessions, full=True)
+
+    def onVersionChosen(self, version, id=None, options=None):
+        consumer.ConsumerProtocol.onVersionChosen(self, version, id, options)
+        self.close_duplicate()
+
+    def close_duplicate(self):
+        """
+        Two peers which discovered each other will both open a connection.
+        Keep the one opened by the node with the lowest ID and close the other.
+
+        :returns:  Whether this connection was closed.
+        :rtype:  bool
+
+        """
+        if 'peer' not in self.extensions or self.initiator_id is None:
+            return False
+        for node in list(self.factory.nodes):
+            if(
+                    node is self
+                    or not node.ready
+                    or node.remote_id != self.remote_id
+                    or 'peer' not in node.extensions
+            ):
+                continue
+            loser = max(self, node, key=lambda item: item.initiator_id)
+            log.msg(
+                'Duplicate connection to peer {0}, closing one.'.format(
+                    self.remote_id,
+                )
+            )
+            loser.sendClose()
+            return loser is self
+        return False
+
+    def subscribe(self, topic):
+        if self.consuming:
+            consumer.ConsumerProtocol.subscribe(self, topic)
+
+    def unsubscribe(self, topic):
+        if self.consuming:
+            consumer.ConsumerProtocol.unsubscribe(self, topic)
+
+    def send_sessions(self, added, removed=(), full=False):
+        if self.consuming:
+            consumer.ConsumerProtocol.send_sessions(
+                self, added, removed, full,
+            )
+
+    def publish(self, topic, message, via=(), origin=None, targets=None):
+        if self.producing:
+            producer.ProducerProtocol.publish(
+                self, topic, message, via, origin, targets,
+            )
+
+
+PASSTHROUGH = consumer.PASSTHROUGH + producer.PASSTHROUGH
+CONTAINER_BASES = (consumer.ConsumerContainer, producer.ProducerContainer)
+PeerClient = make_client(
+    'PeerClient', PASSTHROUGH, PeerProtocol, CONTAINER_BASES,
+)
+PeerServer = make_server(
+    'PeerServer', PASSTHROUGH, PeerProtocol, CONTAINER_BASES,
+)
+
+
+class PeerNode(
+        ContainerBase,
+        consumer.ConsumerContainer,
+        producer.ProducerContainer,
+):
+    """
+    A node which is both a consumer and a producer.  It listens for
+    connections from other peers and connects to them, keeping a single
+    bidirectional connection per pair of peers.  Set it as both the
+    ``consumer`` and the ``producer`` of your WAMP server factory.
+
+    :param interface:  The interface to listen on.
+    :type interface:  str
+    :param port:  The port to listen on.
+    :type port:  int
+    :param nodes:  The peers to connect to.
+    :type nodes:  list of (host, port) tuples
+    :param id:  The ID of the node.  Required to avoid duplicate connections.
+    :type id:  int
+
+    Further keyword arguments, such as ``priorities``, are those of
+    :meth:`pubsubclub.base.ContainerBase.setup`.
+
+    """
+    def __init__(self, interface, port, nodes=tuple(), id=None, **kwargs):
+        self.setup(id, **kwargs)
+        self.server = PeerServer(interface, port, id=id, **kwargs)
+        self.client = PeerClient(id=id, **kwargs)
+        # Share the state, so passthroughs reach every peer.
+        self.share_state(self.server)
+        self.share_state(self.client)
+        for host, port in nodes:
+            self.connect(host, port)
+
+    @property
+    def processor(self):
+        """
+        The WAMP server factory to forward consumed data to.
+
+        """
+        return self.server.processor
+
+    @processor.setter
+    def processor(self, value):
+        self.server.processor = self.client.processor = value
+
+    def connect(self, host, port, id=None):
+        """
+        Make a connection to another peer.
+
+        """
+        self.client.connect(host, port, id=id)
+
+    def disconnect(self, host, port):
+        """
+        Lose a previously made connection.
+
+        """
+        self.client.disconnect(host, port)
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Leave the cluster gracefully, see
+        :meth:`pubsubclub.base.ContainerBase.drain`.
+
+        """
+        self.draining = True
+        return gatherResults([
+            self.server.drain(timeout), self.client.drain(timeout),
+        ])
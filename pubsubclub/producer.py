@@ -1,6 +1,14 @@
 from __future__ import absolute_import
 
+from twisted.internet import reactor
+from twisted.python import log
+
+from . import deltas
 from .base import ProtocolBase, make_client, make_server
+from .capture import PUBLISH
+from .directory import narrow
+from .topics import intern_topic
+from .resume import Session
 
 
 class ProducerProtocol(ProtocolBase):
@@ -12,12 +20,89 @@ class ProducerProtocol(ProtocolBase):
     """
     ROLE = 'producer'
     SUPPORTED_VERSIONS = set([
-        (1, 0), (1, 1),
+        (1, 0), (1, 1), (1, 2),
+    ])
+    EXTENSIONS = ProtocolBase.EXTENSIONS | frozenset([
+        'aliases', 'resume', 'filters', 'deltas', 'dedup', 'targets',
     ])
+
+    #: Map of the topics the consumer is subscribed to and their alias (or
+    #: ``None``).
     subscriptions = None
 
+    #: The :class:`pubsubclub.resume.Session` with the consumer, if the
+    #: ``resume`` extension is in use.
+    session = None
+
+    #: Map of the topics the consumer subscribed to with a filter and the
+    #: compiled :class:`pubsubclub.filters.Filter`.
+    filters = None
+
+    #: The :class:`pubsubclub.deltas.Baselines` of the delta encoded
+    #: publishes sent, if the ``deltas`` extension is in use.
+    sent_baselines = None
+
+    #: The WAMP sessions hosted by the consumer, see
+    #: :mod:`pubsubclub.directory`.
+    hosted = None
+
     def onOpen(self):
-        self.subscriptions = set()
+        self.subscriptions = dict()
+        self.factory.subscribers.hold(self.subscriptions)
+        self.filters = dict()
+        self.hosted = set()
+
+    def onClose(self, clean, code, reason):
+        if self.session is not None and self.session.attached:
+            if self.drained:
+                # The consumer left for good, it won't resume the session.
+                if self.factory.sessions.get(self.remote_id) is self.session:
+                    del self.factory.sessions[self.remote_id]
+            else:
+                self.detach_session(self.session)
+        super(ProducerProtocol, self).onClose(clean, code, reason)
+        if self.subscriptions is not None:
+            self.release_subscriptions(self.subscriptions)
+        if self.hosted:
+            gone = self.factory.directory.remove(self, self.hosted)
+            if gone:
+                self.factory.sessions_changed([], gone)
+
+    def detach_session(self, session):
+        """
+        Keep a session for the grace period, in case the consumer reconnects,
+        unless the consumer already reconnected with a new session.
+
+        """
+        sessions = self.factory.sessions
+        detached = self.factory.detached_sessions
+        remote_id = self.remote_id
+        if sessions.get(remote_id) is not session:
+            return
+
+        factory = self.factory
+
+        def expire():
+            if sessions.get(remote_id) is session:
+                del sessions[remote_id]
+                del detached[remote_id]
+            changed = factory.subscribers.release(session.subscriptions)
+            if changed:
+                factory.subscriptions_changed(changed)
+
+        session.detach(expire)
+        detached[remote_id] = session
+        factory.subscribers.hold(session.subscriptions)
+
+    def release_subscriptions(self, subscriptions):
+        """
+        Stop counting a map of subscriptions held by the connection or its
+        session, see :class:`pubsubclub.topics.SubscriberCounts`.
+
+        """
+        changed = self.factory.subscribers.release(subscriptions)
+        if changed:
+            self.factory.subscriptions_changed(changed)
 
     def onDeclaredVersions(self, *versions):
         """
@@ -25,43 +110,493 @@ class ProducerProtocol(ProtocolBase):
         one we want to use.
 
         """
+        options = dict()
+        if versions and isinstance(versions[-1], dict):
+            # From version 1.2 the versions are followed by the options.
+            versions, options = versions[:-1], versions[-1]
         version_set = set(tuple(item) for item in versions)
         mutual_versions = version_set & self.SUPPORTED_VERSIONS
         if not mutual_versions:
             self.sendClose()
             return
         selected = max(mutual_versions)
-        if selected >= (1, 1):
+        if selected >= (1, 2):
+            self.remote_id = options.get('id')
+            self.negotiate(options)
+            if 'deltas' in self.extensions:
+                self.sent_baselines = deltas.Baselines(
+                    self.factory.deltas.baseline_size,
+                )
+            response = {'extensions': sorted(self.extensions)}
+            if 'resume' in self.extensions and self.remote_id is not None:
+                self.session = self.find_session()
+                response['session'] = self.session.token
+            self.send(102, list(selected), self.factory.id, response)
+        elif selected >= (1, 1):
             self.send(102, list(selected), self.factory.id)
         else:
             self.send(102, list(selected))
-        self.ready()
+        self.set_ready()
+        self.join_ring()
+
+    def find_session(self):
+        """
+        Find the consumer's session kept from a previous connection, or start
+        a new one.  The session stays detached until the consumer resumes it
+        with PSC104, so publishes in the meantime are still recorded.
+
+        """
+        sessions = self.factory.sessions
+        session = sessions.get(self.remote_id)
+        if session is None or session.attached:
+            session = Session(self.subscriptions, self.filters, self.hosted)
+            sessions[self.remote_id] = session
+            self.detach_session(session)
+        return session
+
+    def onResume(self, last_seq=None):
+        """
+        The consumer either resumes the session from the last publish it
+        received, or starts afresh if ``last_seq`` is ``None``.
+
+        """
+        session = self.session
+        # The subscriptions the session held while detached are released
+        # once the connection holds those it keeps, so that the topics they
+        # share are not unsubscribed from in between.
+        held = None if session.attached else session.subscriptions
+        session.attach()
+        detached = self.factory.detached_sessions
+        if detached.get(self.remote_id) is session:
+            del detached[self.remote_id]
+        if last_seq is None:
+            session.subscriptions = self.subscriptions
+            session.filters = self.filters
+            session.hosted = self.hosted
+            session.buffer.clear()
+            if held is not None:
+                self.release_subscriptions(held)
+            return
+        previous = self.subscriptions
+        self.subscriptions = session.subscriptions
+        changed = self.factory.subscribers.hold(self.subscriptions)
+        if changed:
+            self.factory.subscriptions_changed(changed)
+        self.release_subscriptions(previous)
+        if held is not None:
+            self.release_subscriptions(held)
+        self.filters = session.filters
+        # Until the consumer announces its sessions again, assume they are
+        # those it had.
+        self.update_hosted(session.hosted)
+        session.hosted = self.hosted
+        replay = session.replay(last_seq)
+        log.msg('Resuming session, replaying {0} publishes.'.format(
+            len(replay),
+        ))
+        self.factory.counters.incr('resume.resumed')
+        self.factory.counters.incr('resume.replayed', len(replay))
+        for seq, topic, message, via, origin, targets in replay:
+            self.send_publish(
+                topic, message, seq, via=via, origin=origin, targets=targets,
+            )
+
+    def onSessions(self, added, removed, full=False):
+        """
+        The consumer announces the WAMP sessions of its end users added and
+        removed, or all of them if ``full``.
+
+        """
+        hosted = set(added) if full else self.hosted | set(added)
+        hosted.difference_update(removed)
+        self.update_hosted(hosted)
+
+    def update_hosted(self, hosted):
+        """
+        Replace the sessions hosted by the consumer, updating the directory.
 
-    def onSubscribe(self, topic):
+        """
+        directory = self.factory.directory
+        gone = directory.remove(self, self.hosted - hosted)
+        located = directory.add(self, hosted - self.hosted)
+        self.hosted.clear()
+        self.hosted.update(hosted)
+        if located or gone:
+            self.factory.sessions_changed(located, gone)
+
+    def onSubscribe(self, *topics):
         """
         Subscribe a consumer to a topic.
 
         """
-        self.subscriptions.add(topic)
+        for topic in topics:
+            topic = intern_topic(topic)
+            self.filters.pop(topic, None)
+            self.add_subscription(topic, None)
+
+    def onSubscribeAlias(self, topic, alias):
+        """
+        Subscribe a consumer to a topic, which will be referred to by the
+        given alias in publishes.
+
+        """
+        topic = intern_topic(topic)
+        self.filters.pop(topic, None)
+        self.add_subscription(topic, alias)
+
+    def onSubscribeFilter(self, topic, alias, expression):
+        """
+        Subscribe a consumer to the messages of a topic which match a filter
+        (see :mod:`pubsubclub.filters`), optionally with an alias.  Invalid
+        filters are ignored, so the consumer gets every message.
+
+        """
+        topic = intern_topic(topic)
+        compiled = self.factory.filter_cache.get(expression)
+        if compiled is None:
+            self.filters.pop(topic, None)
+        else:
+            self.filters[topic] = compiled
+        self.add_subscription(topic, alias)
+
+    def add_subscription(self, topic, alias):
+        """
+        Subscribe the consumer, sending it the topic's retained message if
+        it is newly subscribed.
+
+        """
+        if topic in self.subscriptions:
+            if self.subscriptions[topic] == alias:
+                return
+            self.subscriptions[topic] = alias
+        else:
+            self.subscriptions[topic] = alias
+            changed = self.factory.subscribers.add(self.subscriptions, topic)
+            if changed:
+                self.factory.subscriptions_changed(changed)
+        if self.ready and topic in self.factory.last_values:
+            message = self.factory.last_values[topic]
+            if self.wants(topic, message):
+                self.factory.counters.incr('retain.sent')
+                self.deliver(topic, message)
 
     def onUnsubscribe(self, topic):
         """
         Unsubscribe a consumer from a topic.
 
         """
-        self.subscriptions.remove(topic)
+        if topic in self.subscriptions:
+            del self.subscriptions[topic]
+            changed = self.factory.subscribers.discard(
+                self.subscriptions, topic,
+            )
+            if changed:
+                self.factory.subscriptions_changed(changed)
+        self.filters.pop(topic, None)
+        if self.sent_baselines is not None:
+            self.sent_baselines.discard(topic)
 
-    def publish(self, topic, message):
+    def onResync(self, topic):
         """
-        Check if subscribed to topic.  If we are, send message.
+        The consumer lost track of a delta encoded topic, send it the
+        baseline in full.
 
         """
-        if not self.ready:
+        if self.sent_baselines is None:
             return
-        if topic in self.subscriptions:
-            self.send(301, topic, message)
+        baseline = self.sent_baselines.get(topic)
+        if baseline is None or topic not in self.subscriptions:
+            return
+        self.factory.counters.incr('deltas.resyncs')
+        baseline = deltas.Baseline(
+            baseline.version + 1, baseline.message, baseline.size,
+        )
+        self.sent_baselines.put(topic, baseline)
+        self.send_publish(topic, baseline.message, version=baseline.version)
+
+    def wants(self, topic, message, generation=None):
+        """
+        Whether the consumer is subscribed to the topic and the message
+        passes its filter.
+
+        """
+        if topic not in self.subscriptions:
+            return False
+        compiled = self.filters.get(topic)
+        if compiled is None or compiled(message, generation):
+            return True
+        self.factory.counters.incr('filters.dropped')
+        return False
+
+    def publish(self, topic, message, via=(), origin=None, targets=None):
+        """
+        Check if subscribed to topic.  If we are, send message, unless the
+        consumer is a relay the message already went through, is leaving,
+        or hosts none of the sessions the message is for.
+
+        :returns:  The size of the message sent (see :meth:`deliver`), if
+            any.
+        :rtype:  int
+
+        """
+        if not self.ready or self.drained or self.remote_id in via:
+            return
+        if targets is not None:
+            if 'targets' in self.extensions:
+                targets = narrow(targets, self.hosted)
+                if targets is None:
+                    return
+            elif targets.eligible is not None:
+                return  # The consumer couldn't tell the sessions apart
+            else:
+                targets = None
+        generation = self.factory.filter_cache.generation
+        if self.wants(topic, message, generation):
+            return self.deliver(
+                topic, message, generation, via, origin, targets,
+            )
+
+    def deliver(
+            self, topic, message, generation=None, via=(), origin=None,
+            targets=None,
+    ):
+        """
+        Send a publish to the consumer, numbering it if a session is in use
+        and delta encoding it if the topic opted in.
+
+        :param generation:  Identifies the publish, if the message is being
+            published to every consumer.
+        :param via:  The IDs of the relays the message went through.
+        :type via:  tuple
+        :param origin:  The origin tag of the publish, see
+            :mod:`pubsubclub.dedup`.
+        :type origin:  tuple
+        :param targets:  The sessions of the consumer the publish is for, see
+            :mod:`pubsubclub.directory`.
+        :type targets:  :class:`pubsubclub.directory.Targets`
+
+        :returns:  The approximate serialized size of the message, or
+            ``None`` if it's being encoded by the worker pool.
+        :rtype:  int
+
+        """
+        if 'dedup' not in self.extensions:
+            origin = None
+        if self.factory.hitters is not None:
+            self.factory.hitters.add('fanout', topic)
+        seq = None
+        if self.session is not None and self.session.attached:
+            seq = self.session.record(topic, message, via, origin, targets)
+        if (
+                self.sent_baselines is not None and
+                self.factory.deltas.encodes(topic)
+        ):
+            return self.send_delta(
+                topic, message, seq, generation, via, origin, targets,
+            )
+        return self.send_publish(
+            topic, message, seq, via=via, origin=origin, targets=targets,
+        )
+
+    def send_delta(
+            self, topic, message, seq=None, generation=None, via=(),
+            origin=None, targets=None,
+    ):
+        """
+        Send a PSC303 patching the topic's baseline, or a snapshot if there's
+        no baseline or the patch isn't worth it.
+
+        """
+        encoder = self.factory.deltas
+        frozen, size = encoder.freeze(message, generation)
+        baseline = self.sent_baselines.get(topic)
+        if (
+                baseline is not None and
+                baseline.patches < deltas.SNAPSHOT_INTERVAL
+        ):
+            ops, ops_size = encoder.diff(baseline, frozen, generation)
+            if ops is not None and ops_size < size:
+                self.sent_baselines.put(topic, deltas.Baseline(
+                    baseline.version + 1, frozen, size, baseline.patches + 1,
+                ))
+                alias = self.subscriptions.get(topic)
+                params = [
+                    topic if alias is None else alias, baseline.version, ops,
+                ]
+                extra = self.publish_extra(
+                    seq, via=via, origin=origin, targets=targets,
+                )
+                if extra:
+                    params.append(extra)
+                self.factory.counters.incr('deltas.patches')
+                self.send_data(topic, 303, *params)
+                return size
+        version = 1 if baseline is None else baseline.version + 1
+        self.sent_baselines.put(
+            topic, deltas.Baseline(version, frozen, size),
+        )
+        self.factory.counters.incr('deltas.snapshots')
+        return self.send_publish(
+            topic, message, seq, version, via, origin, targets,
+        )
+
+    def send_publish(
+            self, topic, message, seq=None, version=None, via=(), origin=None,
+            targets=None,
+    ):
+        """
+        Send a PSC301, with the topic's alias if it has one.
+
+        :param version:  The version of the baseline, if the message is a
+            delta encoding snapshot.
+
+        """
+        alias = self.subscriptions.get(topic)
+        params = [topic if alias is None else alias, message]
+        extra = self.publish_extra(seq, version, via, origin, targets)
+        if extra:
+            params.append(extra)
+        return self.send_data(topic, 301, *params)
+
+    @staticmethod
+    def publish_extra(
+            seq=None, version=None, via=(), origin=None, targets=None,
+    ):
+        """
+        The extra information object of a PSC301 or PSC303.
+
+        """
+        extra = dict()
+        if seq is not None:
+            extra['s'] = seq
+        if version is not None:
+            extra['b'] = version
+        if via:
+            extra['v'] = list(via)
+        if origin is not None:
+            extra['o'] = list(origin)
+        if targets is not None:
+            if targets.eligible is not None:
+                extra['e'] = list(targets.eligible)
+            if targets.exclude:
+                extra['x'] = list(targets.exclude)
+        return extra
+
+
+class ProducerContainer(object):
+    """
+    Container methods for producers, mixed into the producer client and
+    server.
+
+    """
+    def publish(self, topic, message, via=(), origin=None, targets=None):
+        """
+        Publish a message to all consumers, recording it in the sessions of
+        the consumers that are disconnected and in the last-value cache.
+        A message for some WAMP sessions only is only sent to the consumers
+        hosting them.
+
+        :param via:  The IDs of the relays the message went through, see
+            :mod:`pubsubclub.relay`.
+        :type via:  tuple
+        :param origin:  The origin tag of a relayed publish, see
+            :mod:`pubsubclub.dedup`.  Publishes from this node are tagged
+            with its own.
+        :type origin:  tuple
+        :param targets:  The sessions the message is for, see
+            :mod:`pubsubclub.directory`.
+        :type targets:  :class:`pubsubclub.directory.Targets`
+
+        """
+        if origin is None and self.origin_tagger is not None:
+            origin = self.origin_tagger.next()
+        if self.recorder is not None and not via:
+            self.recorder.record(PUBLISH, topic, message)
+        self.filter_cache.generation += 1
+        if self.hitters is not None:
+            self.hitters.add('published', topic)
+        # The size of a frame sent, for the last-value cache.
+        size = None
+        if self.ring is None:
+            if targets is None or targets.eligible is None:
+                nodes = self.nodes
+            else:
+                nodes = self.directory.locate(targets.eligible)
+            for node in nodes:
+                size = node.publish(
+                    topic, message, via, origin, targets,
+                ) or size
+            owner = None
+        else:
+            # Only the broker owning the topic gets it.
+            owner = self.ring.owner(topic)
+            for node in self.nodes:
+                if node.remote_id == owner and node.ready:
+                    size = node.publish(topic, message, via, origin, targets)
+                    break
+        if targets is None or targets.eligible is None:
+            self.last_values.put(topic, message, size)
+        for consumer_id, session in self.detached_sessions.items():
+            if owner not in (None, consumer_id):
+                continue
+            if consumer_id in via:
+                continue
+            session.record_if_subscribed(
+                topic, message, self.filter_cache.generation, via, origin,
+                targets,
+            )
+
+    def publish_local(self, topic, message, session=None, targets=None):
+        """
+        Publish a message from a local WAMP session, within the rate limits
+        (see :mod:`pubsubclub.ratelimit`).
+
+        :param session:  The ID of the publishing session, if known.
+        :type session:  str
+
+        """
+        if self.rate_limiter:
+            delay = self.rate_limiter.check(topic, session, reactor.seconds())
+            if delay is None:
+                self.counters.incr('ratelimit.dropped')
+                return
+            if delay:
+                self.counters.incr('ratelimit.delayed')
+                reactor.callLater(
+                    delay, self.publish, topic, message, targets=targets,
+                )
+                return
+        self.publish(topic, message, targets=targets)
+
+    def consumer_topics(self):
+        """
+        The topics consumers are subscribed to, including those of the
+        sessions kept for disconnected consumers.
+
+        :rtype:  set
+
+        """
+        return self.subscribers.topics()
+
+    def subscriptions_changed(self, topics):
+        """
+        Called when topics gained their first subscriber among the consumers
+        or lost their last one.
+
+        """
+
+    def sessions_changed(self, located, gone):
+        """
+        Called when WAMP sessions were first located on a consumer, or are no
+        longer hosted by any.
+
+        """
 
 
-PASSTHROUGH = ['publish']
-ProducerClient = make_client('ProducerClient', PASSTHROUGH, ProducerProtocol)
-ProducerServer = make_server('ProducerServer', PASSTHROUGH, ProducerProtocol)
+PASSTHROUGH = []
+ProducerClient = make_client(
+    'ProducerClient', PASSTHROUGH, ProducerProtocol, (ProducerContainer,),
+)
+ProducerServer = make_server(
+    'ProducerServer', PASSTHROUGH, ProducerProtocol, (ProducerContainer,),
+)
@@ -0,0 +1,155 @@
+"""
+Rate limiting of the messages published by the local WAMP sessions, so that
+a client publishing in a loop can't saturate every link of the cluster.
+
+Limits are token buckets, set per topic (for the topics matching a prefix,
+each topic getting its own bucket) and per publishing session.  A message
+over a limit is either dropped, or delayed until the buckets have refilled
+(up to :data:`MAX_DELAY`, beyond which it is dropped anyway).
+
+"""
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+DROP = 'drop'
+DELAY = 'delay'
+MAX_DELAY = 5.0  # Seconds a message may be delayed before it's dropped
+MAX_BUCKETS = 10000  # Buckets of each kind, least recently used evicted
+CACHE_SIZE = 10000  # Topics to remember the limit of
+
+
+class TokenBucket(object):
+    """
+    Allows ``rate`` messages per second, in bursts of up to ``burst``.
+    Tokens may be taken in advance by delayed messages, leaving the bucket
+    in debt.
+
+    """
+    __slots__ = ('rate', 'burst', 'tokens', 'updated')
+
+    def __init__(self, rate, burst, now):
+        # As a float, or integer division would let every message through.
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.updated = now
+
+    def delay(self, now):
+        """
+        :returns:  The seconds until a token is available.
+        :rtype:  float
+
+        """
+        self.tokens = min(
+            self.burst, self.tokens + (now - self.updated) * self.rate,
+        )
+        self.updated = now
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class Buckets(object):
+    """
+    Token buckets by key, the least recently used being forgotten.
+
+    """
+    def __init__(self, max_size=MAX_BUCKETS):
+        self.max_size = max_size
+        self.buckets = OrderedDict()
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def get(self, key, rate, burst, now):
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst, now)
+            while len(self.buckets) >= self.max_size:
+                self.buckets.popitem(last=False)
+        self.buckets[key] = bucket
+        return bucket
+
+
+class RateLimiter(object):
+    """
+    The rate limits of a producer.
+
+    :param topic_limits:  Triples of topic prefix, rate (messages per second)
+        and burst for the topics matching the prefix.  The longest matching
+        prefix wins.
+    :type topic_limits:  list of (str, float, int) tuples
+    :param session_limit:  Pair of rate and burst for each publishing session,
+        or ``None``.
+    :type session_limit:  tuple
+    :param policy:  :data:`DROP` or :data:`DELAY` the messages over a limit.
+    :type policy:  str
+
+    """
+    def __init__(self, topic_limits=(), session_limit=None, policy=DROP):
+        if policy not in (DROP, DELAY):
+            raise ValueError('Unknown rate limit policy {0!r}'.format(policy))
+        self.topic_limits = sorted(
+            topic_limits, key=lambda item: len(item[0]), reverse=True,
+        )
+        self.session_limit = session_limit
+        self.policy = policy
+        self.topic_buckets = Buckets()
+        self.session_buckets = Buckets()
+        self.cache = dict()
+
+    def __nonzero__(self):
+        return bool(self.topic_limits or self.session_limit)
+
+    def topic_limit(self, topic):
+        """
+        :returns:  The rate and burst of a topic, or ``None``.
+        :rtype:  tuple
+
+        """
+        try:
+            return self.cache[topic]
+        except KeyError:
+            pass
+        limit = None
+        for prefix, rate, burst in self.topic_limits:
+            if topic.startswith(prefix):
+                limit = rate, burst
+                break
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[topic] = limit
+        return limit
+
+    def check(self, topic, session, now):
+        """
+        Check a message against the limits, taking its tokens if it is let
+        through.
+
+        :param session:  The ID of the publishing session, if known.
+
+        :returns:  The seconds to delay the message by, or ``None`` to drop
+            it.
+        :rtype:  float
+
+        """
+        buckets = []
+        limit = self.topic_limit(topic)
+        if limit is not None:
+            rate, burst = limit
+            buckets.append(self.topic_buckets.get(topic, rate, burst, now))
+        if session is not None and self.session_limit is not None:
+            rate, burst = self.session_limit
+            buckets.append(self.session_buckets.get(session, rate, burst, now))
+        delay = max([bucket.delay(now) for bucket in buckets] or [0.0])
+        if delay > 0 and (self.policy == DROP or delay > MAX_DELAY):
+            return None
+        for bucket in buckets:
+            bucket.take()
+        return delay
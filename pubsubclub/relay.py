@@ -0,0 +1,157 @@
+"""
+Relays, which consume from one set of producers and produce to another set
+of consumers.  For example, a relay in each datacenter can consume from the
+producers of the other datacenters and fan the publishes out to the local
+consumers, so each publish crosses the WAN once per datacenter rather than
+once per remote consumer.
+
+A relay subscribes on its producers to the union of the topics its
+consumers are subscribed to, and announces them the WAMP sessions hosted by
+its consumers (see :mod:`pubsubclub.directory`).  Relays add their node ID
+to the publishes they forward, and drop publishes that already went through
+them, so relays connected in a cycle don't forward publishes forever.
+Producers also skip the consumers which a publish already went through.
+
+"""
+from __future__ import absolute_import
+
+from twisted.internet.defer import gatherResults
+from twisted.python import log
+
+from . import consumer, producer
+from .base import DRAIN_TIMEOUT, make_client, make_server
+
+
+class UpstreamContainer(object):
+    """
+    Container methods for the consumer side of a relay.
+
+    """
+    #: The :class:`Relay`.
+    relay = None
+
+    def subscribed_topics(self):
+        return self.relay.downstream.consumer_topics()
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        self.relay.forward(topic, message, via, origin, targets)
+
+
+class DownstreamContainer(object):
+    """
+    Container methods for the producer side of a relay.
+
+    """
+    #: The :class:`Relay`.
+    relay = None
+
+    def subscriptions_changed(self, topics):
+        self.relay.relay_subscriptions(topics)
+
+    def sessions_changed(self, located, gone):
+        for id in located:
+            self.relay.upstream.session_opened(id)
+        for id in gone:
+            self.relay.upstream.session_closed(id)
+
+
+UPSTREAM_BASES = (UpstreamContainer, consumer.ConsumerContainer)
+DOWNSTREAM_BASES = (DownstreamContainer, producer.ProducerContainer)
+RelayConsumerClient = make_client(
+    'RelayConsumerClient', consumer.PASSTHROUGH, consumer.ConsumerProtocol,
+    UPSTREAM_BASES,
+)
+RelayConsumerServer = make_server(
+    'RelayConsumerServer', consumer.PASSTHROUGH, consumer.ConsumerProtocol,
+    UPSTREAM_BASES,
+)
+RelayProducerClient = make_client(
+    'RelayProducerClient', producer.PASSTHROUGH, producer.ProducerProtocol,
+    DOWNSTREAM_BASES,
+)
+RelayProducerServer = make_server(
+    'RelayProducerServer', producer.PASSTHROUGH, producer.ProducerProtocol,
+    DOWNSTREAM_BASES,
+)
+
+
+class Relay(object):
+    """
+    A node consuming from some producers and producing to other consumers.
+
+    :param upstream:  The consumer side, a :class:`RelayConsumerClient` or
+        :class:`RelayConsumerServer`.
+    :param downstream:  The producer side, a :class:`RelayProducerClient` or
+        :class:`RelayProducerServer`.
+
+    Both sides must have the same ID, which is required for loop prevention.
+
+    """
+    def __init__(self, upstream, downstream):
+        if upstream.id is None or upstream.id != downstream.id:
+            raise ValueError('Both sides of a relay need the same ID')
+        self.id = upstream.id
+        self.upstream = upstream
+        self.downstream = downstream
+        upstream.relay = downstream.relay = self
+        downstream.counters = upstream.counters
+        #: The topics subscribed to on the producers.
+        self.relayed = set()
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        """
+        Forward a publish from the producers to the consumers, unless it
+        already went through this relay.  The publish keeps its origin tag
+        and targets.
+
+        """
+        if self.id in via:
+            log.msg('Dropping publish for {0} looping through {1}'.format(
+                topic, list(via),
+            ))
+            self.upstream.counters.incr('relay.loops')
+            return
+        self.downstream.publish(
+            topic, message, via + (self.id,), origin, targets,
+        )
+
+    def relay_subscriptions(self, topics):
+        """
+        Subscribe to or unsubscribe from topics on the producers, as the
+        consumers did.
+
+        """
+        wanted = self.downstream.subscribers
+        for topic in topics:
+            if topic in wanted and topic not in self.relayed:
+                self.relayed.add(topic)
+                self.upstream.subscribe(topic)
+            elif topic not in wanted and topic in self.relayed:
+                self.relayed.discard(topic)
+                self.upstream.unsubscribe(topic)
+
+    def stats(self):
+        return self.upstream.stats()
+
+    def rtt_stats(self):
+        stats = self.upstream.rtt_stats()
+        stats.update(self.downstream.rtt_stats())
+        return stats
+
+    def reactor_stats(self):
+        return self.upstream.reactor_stats()
+
+    def top_topics(self):
+        top = self.upstream.top_topics()
+        top.update(self.downstream.top_topics())
+        return top
+
+    def drain(self, timeout=DRAIN_TIMEOUT):
+        """
+        Leave the cluster gracefully on both sides, see
+        :meth:`pubsubclub.base.ContainerBase.drain`.
+
+        """
+        return gatherResults([
+            self.upstream.drain(timeout), self.downstream.drain(timeout),
+        ])
@@ -0,0 +1,258 @@
+"""
+Replay of a traffic capture (see :mod:`pubsubclub.capture`) against a local
+cluster, to test changes against real traffic shapes::
+
+    python -m pubsubclub.replay capture.log --speed 2
+
+This starts a producer server and a consumer connected to it, and replays the
+captured subscriptions and messages at the recorded pace (times ``--speed``,
+or as fast as possible with ``--speed max``).  Both published and received
+messages are published by the local producer.  If the capture holds no
+subscriptions, topics are subscribed to as they are first published.
+
+Once done, it reports the throughput and the latency of the messages from
+publish to delivery.  Messages are wrapped to carry the time they were
+published at, and captures without payloads are replayed with placeholder
+strings of the captured size.
+
+"""
+from __future__ import absolute_import, print_function
+
+import argparse
+import json
+import sys
+import time
+from array import array
+
+from twisted.internet import reactor
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+from . import consumer
+from .base import make_client
+from .capture import (
+    KINDS, PUBLISH, RECEIVE, SUBSCRIBE, UNSUBSCRIBE, read_capture,
+)
+from .producer import ProducerServer
+
+
+BATCH = 100  # Messages published per reactor iteration at maximum speed
+SETTLE_TIME = 1.0  # Seconds without deliveries after which a replay is done
+
+
+class ReplayContainer(object):
+    """
+    Container methods for the consumer of a replay, which measures the
+    latency of the messages rather than dispatching them.
+
+    """
+    #: The :class:`Replay`.
+    replay = None
+
+    def subscribed_topics(self):
+        return set(self.replay.topics)
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        self.replay.delivered(message)
+
+
+ReplayConsumerClient = make_client(
+    'ReplayConsumerClient', consumer.PASSTHROUGH, consumer.ConsumerProtocol,
+    (ReplayContainer, consumer.ConsumerContainer),
+)
+
+
+class Replay(object):
+    """
+    Replays a capture against a producer server, and a consumer connected to
+    it ``connections`` times.
+
+    :param path:  The capture file.
+    :type path:  str
+    :param speed:  The factor to speed the replay up by, or ``None`` to replay
+        as fast as possible.
+    :type speed:  float
+    :param connections:  The connections from the consumer to the producer,
+        each receiving every message.
+    :type connections:  int
+    :param port:  The local port of the producer server.
+    :type port:  int
+
+    """
+    def __init__(self, path, speed=1.0, connections=1, port=19900):
+        self.records = read_capture(path)
+        self.speed = speed
+        self.connections = connections
+        self.producer = ProducerServer('127.0.0.1', port)
+        self.consumer = ReplayConsumerClient(
+            [('127.0.0.1', port)] * connections,
+        )
+        self.consumer.replay = self
+        #: The topics subscribed to.
+        self.topics = set()
+        #: Whether the capture holds subscriptions.
+        self.subscriptions = False
+        self.published = 0
+        self.received = 0
+        self.bytes = 0
+        #: The latency of each message received, in seconds.
+        self.latencies = array('d')
+        self.started = None
+        self.last_delivery = None
+        self.waiting = LoopingCall(self._wait_ready)
+        self.settling = LoopingCall(self._settle)
+
+    def run(self):
+        """
+        Run the reactor until the replay is done.
+
+        """
+        self.waiting.start(0.1)
+        reactor.run()
+
+    def _wait_ready(self):
+        ready = sum(1 for node in self.consumer.nodes if node.ready)
+        if ready >= self.connections:
+            self.waiting.stop()
+            self.started = time.time()
+            self._next(None)
+
+    def _next(self, record):
+        played = 0
+        while True:
+            if record is not None:
+                self._play(record)
+                played += 1
+            record = next(self.records, None)
+            if record is None:
+                self.settling.start(SETTLE_TIME, now=False)
+                return
+            if self.speed is None:
+                if played >= BATCH:
+                    reactor.callLater(0, self._next, record)
+                    return
+                continue
+            delay = self.started + record.time / self.speed - time.time()
+            if delay > 0:
+                reactor.callLater(delay, self._next, record)
+                return
+
+    def _play(self, record):
+        if record.kind == SUBSCRIBE:
+            self.subscriptions = True
+            self.topics.add(record.topic)
+            self.consumer.subscribe(record.topic)
+        elif record.kind == UNSUBSCRIBE:
+            self.topics.discard(record.topic)
+            self.consumer.unsubscribe(record.topic)
+        elif record.kind in (PUBLISH, RECEIVE):
+            if not self.subscriptions and record.topic not in self.topics:
+                self.topics.add(record.topic)
+                self.consumer.subscribe(record.topic)
+            message = record.message
+            if message is None:
+                message = 'x' * record.size
+            self.published += 1
+            self.producer.publish(
+                record.topic, {'sent': time.time(), 'message': message},
+            )
+
+    def delivered(self, message):
+        now = time.time()
+        self.received += 1
+        self.bytes += len(json.dumps(message['message']))
+        self.latencies.append(now - message['sent'])
+        self.last_delivery = now
+
+    def _settle(self):
+        if (
+                self.last_delivery is None or
+                time.time() - self.last_delivery > SETTLE_TIME
+        ):
+            self.settling.stop()
+            reactor.stop()
+
+    def report(self):
+        """
+        :returns:  The throughput and latency of the replay.
+        :rtype:  dict
+
+        """
+        end = self.last_delivery or time.time()
+        duration = max(end - (self.started or end), 1e-6)
+        latencies = sorted(self.latencies)
+
+        def percentile(fraction):
+            if not latencies:
+                return None
+            index = min(int(len(latencies) * fraction), len(latencies) - 1)
+            return latencies[index]
+
+        return {
+            'duration': duration,
+            'published': self.published,
+            'received': self.received,
+            'messages_per_second': self.received / duration,
+            'bytes_per_second': self.bytes / duration,
+            'latency_p50': percentile(0.5),
+            'latency_p99': percentile(0.99),
+            'latency_max': percentile(1.0),
+        }
+
+
+def summarize(path):
+    """
+    Count the records of a capture by kind.
+
+    :rtype:  dict
+
+    """
+    summary = dict((name, 0) for name in KINDS.values())
+    summary.update(duration=0.0, bytes=0)
+    topics = set()
+    for record in read_capture(path):
+        summary[KINDS[record.kind]] += 1
+        summary['bytes'] += record.size
+        summary['duration'] = record.time
+        topics.add(record.topic)
+    summary['topics'] = len(topics)
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m pubsubclub.replay',
+        description='Replay a PubSubClub traffic capture on the local host.',
+    )
+    parser.add_argument('path', help='the capture file')
+    parser.add_argument(
+        '--speed', default='1',
+        help='factor to speed the replay up by, or "max" (default: 1)',
+    )
+    parser.add_argument(
+        '--connections', type=int, default=1,
+        help='connections from the consumer to the producer (default: 1)',
+    )
+    parser.add_argument('--port', type=int, default=19900)
+    parser.add_argument(
+        '--info', action='store_true',
+        help='only summarize the capture',
+    )
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args(argv)
+
+    if args.info:
+        results = summarize(args.path)
+    else:
+        if args.verbose:
+            log.startLogging(sys.stdout)
+        speed = None if args.speed == 'max' else float(args.speed)
+        replay = Replay(args.path, speed, args.connections, args.port)
+        replay.run()
+        results = replay.report()
+    for name, value in sorted(results.items()):
+        print('{0:20} {1}'.format(name, value))
+
+
+if __name__ == '__main__':
+    main()
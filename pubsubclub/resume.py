@@ -0,0 +1,143 @@
+"""
+Session resumption, for connections that drop briefly.
+
+The producer numbers the publishes it sends to each consumer and keeps the
+latest of them in a replay buffer.  When a connection drops, the producer
+keeps the consumer's session (its subscriptions and replay buffer) around for
+a grace period, recording the publishes the consumer misses.  A consumer that
+reconnects in time tells the producer the last publish it received, and the
+producer replays the rest without the consumer having to resubscribe.
+
+"""
+import random
+from collections import deque
+
+from twisted.internet import reactor
+
+from .directory import narrow
+
+
+GRACE_PERIOD = 30.0  # Seconds to keep a session after a connection drops
+REPLAY_BUFFER = 1000  # Publishes to keep for replay, per consumer
+
+
+class Session(object):
+    """
+    The producer's side of a session with a consumer.
+
+    """
+    __slots__ = (
+        'token', 'subscriptions', 'filters', 'hosted', 'buffer', 'seq',
+        'expiry',
+    )
+
+    def __init__(
+            self, subscriptions, filters, hosted=frozenset(),
+            buffer_size=REPLAY_BUFFER,
+    ):
+        self.token = random.randrange(2**31)
+        self.subscriptions = subscriptions
+        self.filters = filters
+        #: The WAMP sessions hosted by the consumer.
+        self.hosted = hosted
+        self.buffer = deque(maxlen=buffer_size)
+        self.seq = 0
+        self.expiry = None
+
+    @property
+    def attached(self):
+        """
+        Whether a connection is using the session.
+
+        """
+        return self.expiry is None
+
+    def record(self, topic, message, via=(), origin=None, targets=None):
+        """
+        Number a publish and keep it for replay.
+
+        :returns:  The sequence number of the publish.
+        :rtype:  int
+
+        """
+        self.seq += 1
+        self.buffer.append((self.seq, topic, message, via, origin, targets))
+        return self.seq
+
+    def record_if_subscribed(
+            self, topic, message, generation=None, via=(), origin=None,
+            targets=None,
+    ):
+        if topic not in self.subscriptions:
+            return
+        if targets is not None:
+            targets = narrow(targets, self.hosted)
+            if targets is None:
+                return
+        compiled = self.filters.get(topic)
+        if compiled is None or compiled(message, generation):
+            self.record(topic, message, via, origin, targets)
+
+    def replay(self, after):
+        """
+        :returns:  The buffered publishes following a sequence number, as
+            tuples of sequence number, topic, message, relay path, origin tag
+            and targets.
+        :rtype:  list
+
+        """
+        return [entry for entry in self.buffer if entry[0] > after]
+
+    def detach(self, expire):
+        """
+        Keep the session around for the grace period, after which ``expire``
+        is called.
+
+        """
+        self.expiry = reactor.callLater(GRACE_PERIOD, expire)
+
+    def attach(self):
+        if self.expiry is not None:
+            if self.expiry.active():
+                self.expiry.cancel()
+            self.expiry = None
+
+
+class ResumeState(object):
+    """
+    The consumer's side of a session with a producer.
+
+    """
+    __slots__ = ('token', 'last_seq', 'topics', 'expiry')
+
+    def __init__(self, token):
+        self.token = token
+        self.last_seq = 0
+        #: The topics subscribed to on the producer, and their alias and
+        #: filter.
+        self.topics = dict()
+        self.expiry = None
+
+    def receive(self, seq):
+        """
+        Note the receipt of a publish.
+
+        :returns:  The number of publishes missed before this one, or ``None``
+            if this publish was already received.
+        :rtype:  int
+
+        """
+        if seq <= self.last_seq:
+            return None
+        missed = seq - self.last_seq - 1
+        self.last_seq = seq
+        return missed
+
+    def detach(self, expire):
+        self.expiry = reactor.callLater(GRACE_PERIOD, expire)
+
+    def attach(self):
+        if self.expiry is not None:
+            if self.expiry.active():
+                self.expiry.cancel()
+            self.expiry = None
@@ -0,0 +1,78 @@
+"""
+A producer-side cache of the last message published to each topic, so a
+consumer subscribing to a topic gets its current value right away instead of
+waiting for the next publish.
+
+Topics opt in by prefix.  The cache is bounded by the serialized size of the
+messages it holds, evicting the least recently used topics first.
+
+"""
+import json
+
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+from .topics import TopicPrefixes
+
+
+RETAIN_SIZE = 16 * 1024 * 1024  # Default limit on the cache, in bytes
+
+
+class LastValueCache(object):
+    """
+    Retains the last message of the topics matching any of the prefixes.
+
+    :param prefixes:  The topic prefixes to retain messages for.
+    :type prefixes:  list of str
+    :param max_size:  The total serialized size of the retained messages, in
+        bytes.
+    :type max_size:  int
+
+    """
+    def __init__(self, prefixes=(), max_size=RETAIN_SIZE):
+        self.prefixes = TopicPrefixes(prefixes)
+        self.max_size = max_size
+        self.size = 0
+        #: Pairs of message and size by topic, least recently used first.
+        self.values = OrderedDict()
+
+    def __len__(self):
+        return len(self.values)
+
+    def __contains__(self, topic):
+        return topic in self.values
+
+    def __getitem__(self, topic):
+        message, size = self.values.pop(topic)
+        self.values[topic] = (message, size)
+        return message
+
+    def put(self, topic, message, size=None):
+        """
+        Retain the message if its topic opted in, evicting other topics as
+        needed to stay within the size limit.
+
+        :param size:  The serialized size of the message, if already known
+            (e.g. from the frame it was sent in).
+        :type size:  int
+
+        """
+        if topic not in self.prefixes:
+            return
+        self.discard(topic)
+        if size is None:
+            size = len(json.dumps(message))
+        if size > self.max_size:
+            return
+        while self.size + size > self.max_size:
+            _, (_, evicted) = self.values.popitem(last=False)
+            self.size -= evicted
+        self.values[topic] = (message, size)
+        self.size += size
+
+    def discard(self, topic):
+        entry = self.values.pop(topic, None)
+        if entry is not None:
+            self.size -= entry[1]
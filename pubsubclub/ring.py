@@ -0,0 +1,90 @@
+"""
+Consistent hashing of topics onto the nodes of a broker tier (see
+:mod:`pubsubclub.broker`).  Each node is placed at several points of a hash
+ring, and a topic is owned by the node at the first point following the
+topic's hash.  When a node joins or leaves, only the topics between its
+points and the preceding ones change owner.
+
+"""
+import bisect
+import hashlib
+import struct
+
+
+REPLICAS = 64  # Points on the ring per node, to spread topics evenly
+CACHE_SIZE = 10000  # Topics to remember the owner of
+
+
+def ring_hash(key):
+    """
+    Hash a string onto the ring.
+
+    :rtype:  int
+
+    """
+    if isinstance(key, unicode):
+        key = key.encode('utf-8')
+    return struct.unpack('>Q', hashlib.md5(key).digest()[:8])[0]
+
+
+class HashRing(object):
+    """
+    A consistent hash ring of node IDs.
+
+    :param replicas:  The points on the ring per node.
+    :type replicas:  int
+
+    """
+    def __init__(self, replicas=REPLICAS):
+        self.replicas = replicas
+        self.members = set()
+        self.points = []
+        self.owners = []
+        self.cache = dict()
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, member):
+        return member in self.members
+
+    def add(self, member):
+        if member not in self.members:
+            self.members.add(member)
+            self._build()
+
+    def remove(self, member):
+        if member in self.members:
+            self.members.discard(member)
+            self._build()
+
+    def _build(self):
+        points = sorted(
+            (ring_hash('{0}-{1}'.format(member, replica)), member)
+            for member in self.members
+            for replica in range(self.replicas)
+        )
+        self.points = [point for point, _ in points]
+        self.owners = [member for _, member in points]
+        self.cache.clear()
+
+    def owner(self, topic):
+        """
+        The node owning a topic.
+
+        :returns:  The ID of the node, or ``None`` if the ring is empty.
+        :rtype:  int
+
+        """
+        try:
+            return self.cache[topic]
+        except KeyError:
+            pass
+        if not self.points:
+            return None
+        index = bisect.bisect(self.points, ring_hash(topic))
+        owner = self.owners[index % len(self.owners)]
+        if len(self.cache) >= CACHE_SIZE:
+            self.cache.clear()
+        self.cache[topic] = owner
+        return owner
@@ -0,0 +1,27 @@
+"""
+Counters for monitoring a container.
+
+"""
+
+
+class Counters(object):
+    """
+    A set of named counters, all starting at zero.
+
+    """
+    def __init__(self):
+        self.values = dict()
+
+    def __getitem__(self, name):
+        return self.values.get(name, 0)
+
+    def incr(self, name, amount=1):
+        self.values[name] = self.values.get(name, 0) + amount
+
+    def snapshot(self):
+        """
+        :returns:  The current value of every counter.
+        :rtype:  dict
+
+        """
+        return dict(self.values)
@@ -0,0 +1,190 @@
+"""
+Compact integer aliases for topics, so publishes don't have to carry the full
+topic URI on the wire.
+
+"""
+CACHE_SIZE = 10000  # Topics to remember whether they match the prefixes
+
+
+def intern_topic(topic):
+    """
+    The shared copy of a topic, so that the connections subscribed to it
+    don't each hold their own.  ASCII topics (the usual URIs) are stored as
+    byte strings, which take less memory than unicode and compare equal to
+    it.  Interned strings are freed once no longer used.
+
+    """
+    if isinstance(topic, unicode):
+        try:
+            topic = topic.encode('ascii')
+        except UnicodeEncodeError:
+            return topic
+    return intern(topic)
+
+
+class TopicTable(object):
+    """
+    Assigns integer aliases to topics.  Aliases are never reused, so a
+    publish still in flight for a released alias can't be mistaken for
+    another topic.
+
+    """
+    __slots__ = ('aliases', 'topics', 'last_alias')
+
+    def __init__(self):
+        self.aliases = dict()
+        self.topics = dict()
+        self.last_alias = 0
+
+    def __len__(self):
+        return len(self.aliases)
+
+    def alias(self, topic):
+        """
+        Get the alias of a topic, assigning one if needed.
+
+        :rtype:  int
+
+        """
+        try:
+            return self.aliases[topic]
+        except KeyError:
+            pass
+        self.last_alias += 1
+        self.aliases[topic] = self.last_alias
+        self.topics[self.last_alias] = topic
+        return self.last_alias
+
+    def topic(self, alias):
+        """
+        Get the topic for an alias.
+
+        :returns:  The topic, or ``None`` if the alias is unknown.
+        :rtype:  str
+
+        """
+        return self.topics.get(alias)
+
+    def release(self, topic):
+        """
+        Forget the alias of a topic.
+
+        """
+        alias = self.aliases.pop(topic, None)
+        if alias is not None:
+            del self.topics[alias]
+
+
+class SubscriberCounts(object):
+    """
+    Counts the subscription maps holding each topic, so that the topics
+    consumers are subscribed to are known without going through every
+    connection.  Maps are held by the connections to consumers and by the
+    sessions kept for disconnected ones (see :mod:`pubsubclub.resume`), and
+    a map held by both only counts once.
+
+    The methods return the topics which gained their first subscriber or
+    lost their last one.
+
+    """
+    __slots__ = ('counts', 'holders')
+
+    def __init__(self):
+        self.counts = dict()
+        #: The maps held and their number of holders, by ``id()``.
+        self.holders = dict()
+
+    def __contains__(self, topic):
+        return topic in self.counts
+
+    def topics(self):
+        """
+        :returns:  The topics with subscribers.
+        :rtype:  set
+
+        """
+        return set(self.counts)
+
+    def hold(self, subscriptions):
+        """
+        Count the topics of a map, unless it is already held.
+
+        """
+        entry = self.holders.get(id(subscriptions))
+        if entry is not None:
+            entry[1] += 1
+            return []
+        self.holders[id(subscriptions)] = [subscriptions, 1]
+        return [topic for topic in subscriptions if self._incr(topic)]
+
+    def release(self, subscriptions):
+        """
+        Stop counting the topics of a map, once it has no holder left.
+
+        """
+        entry = self.holders.get(id(subscriptions))
+        if entry is None:
+            return []
+        entry[1] -= 1
+        if entry[1]:
+            return []
+        del self.holders[id(subscriptions)]
+        return [topic for topic in subscriptions if self._decr(topic)]
+
+    def add(self, subscriptions, topic):
+        """
+        Count a topic newly added to a map.
+
+        """
+        if id(subscriptions) in self.holders and self._incr(topic):
+            return [topic]
+        return []
+
+    def discard(self, subscriptions, topic):
+        """
+        Stop counting a topic removed from a map.
+
+        """
+        if id(subscriptions) in self.holders and self._decr(topic):
+            return [topic]
+        return []
+
+    def _incr(self, topic):
+        count = self.counts.get(topic, 0)
+        self.counts[topic] = count + 1
+        return count == 0
+
+    def _decr(self, topic):
+        count = self.counts.pop(topic) - 1
+        if count:
+            self.counts[topic] = count
+        return count == 0
+
+
+class TopicPrefixes(object):
+    """
+    A set of topic prefixes, for topics to opt in to a feature.
+
+    :param prefixes:  The topic prefixes.
+    :type prefixes:  list of str
+
+    """
+    def __init__(self, prefixes=()):
+        self.prefixes = tuple(prefixes)
+        self.matches = dict()
+
+    def __nonzero__(self):
+        return bool(self.prefixes)
+
+    def __contains__(self, topic):
+        if not self.prefixes:
+            return False
+        try:
+            return self.matches[topic]
+        except KeyError:
+            pass
+        match = topic.startswith(self.prefixes)
+        if len(self.matches) >= CACHE_SIZE:
+            self.matches.clear()
+        self.matches[topic] = match
+        return match
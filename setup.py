@@ -4,6 +4,10 @@ setup(
     name='pubsubclub',
     version='0.1.1',
     packages=find_packages(),
+    install_requires=[
+        'Twisted',
+        'autobahn<=0.8.15',  # WAMPv1 was removed in 0.9.0
+    ],
     entry_points={
         'console_scripts': [
         ],
@@ -4,6 +4,7 @@ from autobahn.twisted.websocket import listenWS
 
 from pubsubclub import (
     ConsumerMixin, ProducerMixin, ConsumerServer, ProducerClient, consul,
+    generate_id,
 )
 
 
@@ -41,9 +42,10 @@ if __name__ == '__main__':
     import sys
     log.startLogging(sys.stderr)
 
-    consumer = ConsumerServer('0.0.0.0', 19000)
+    id = generate_id()
+    consumer = ConsumerServer('0.0.0.0', 19000, id=id)
     WampServerFactory.consumer = consumer
-    producer = ProducerClient([])
+    producer = ProducerClient([], id=id)
     WampServerFactory.producer = producer
 
     server = WampServerFactory('ws://localhost:9900')
@@ -53,6 +55,7 @@ if __name__ == '__main__':
     discovery = consul.ConsulDiscovery(
         'http://localhost:8500/', 'pubsubclub', producer,
     )
+    discovery.register(19000)
     discovery.start()
     print('Starting...')
 
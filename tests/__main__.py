@@ -1,9 +1,14 @@
 from __future__ import print_function
 
+import json
+import os
+import random
+import shutil
+import tempfile
 
 from twisted.internet import reactor
 from twisted.internet.defer import Deferred, DeferredList
-from twisted.internet.task import deferLater
+from twisted.internet.task import Clock, deferLater
 
 from autobahn.twisted.websocket import listenWS, connectWS
 from autobahn.wamp1 import protocol as wamp
@@ -11,10 +16,22 @@ from autobahn.wamp1 import protocol as wamp
 from pubsubclub import (
     ConsumerMixin,
     ProducerMixin,
+    ConsumerClient,
     ConsumerServer,
     ProducerClient,
+    ProducerServer,
+    PeerNode,
+    Relay,
+    RelayConsumerClient,
+    RelayProducerServer,
     generate_id,
 )
+from pubsubclub import (
+    capture, codec, dedup, deltas, discovery, filters, fragments, heartbeat,
+    hitters, monitor, outbound, producer, ratelimit, resume, retain, ring,
+    topics,
+)
+from pubsubclub.base import ProtocolBase
 
 
 def test_basic():
@@ -254,14 +271,1423 @@ def test_no_self_connect():
     return deferLater(reactor, 1.0, check_connection)
 
 
+def test_peer():
+    """
+    Test that two peers which connect to each other end up with a single
+    bidirectional connection and exchange pubsubs both ways.
+
+    """
+    print('Running test_peer')
+    received = [Deferred(), Deferred()]
+
+    class WampPeerServerProtocol(wamp.WampServerProtocol):
+        def onSessionOpen(self):
+            self.registerForPubSub('http://example.com/mytopic')
+
+    class WampPeerServerFactory(
+            ConsumerMixin, ProducerMixin, wamp.WampServerFactory,
+    ):
+        protocol = WampPeerServerProtocol
+
+    def make_peer(index, port):
+        class WampClientProtocol(wamp.WampClientProtocol):
+            def onSessionOpen(self):
+                self.subscribe('http://example.com/mytopic', self.onEvent)
+
+            def onEvent(self, topic, event):
+                if event == {'from': 1 - index}:
+                    received[index].callback(None)
+
+        class WampClientFactory(wamp.WampClientFactory):
+            protocol = WampClientProtocol
+
+        peer = PeerNode('localhost', port, id=index + 1)
+        factory = WampPeerServerFactory('ws://localhost:{0}'.format(port + 2))
+        factory.consumer = factory.producer = peer
+        peer.processor = factory
+        listenWS(factory)
+        connectWS(WampClientFactory('ws://localhost:{0}'.format(port + 2)))
+        return peer, factory
+
+    peer1, factory1 = make_peer(0, 19300)
+    peer2, factory2 = make_peer(1, 19400)
+    peer1.connect('localhost', 19400)
+    peer2.connect('localhost', 19300)
+
+    def check_connection():
+        assert len(set(peer1.nodes)) == 1, set(peer1.nodes)
+        assert len(set(peer2.nodes)) == 1, set(peer2.nodes)
+        node1, = peer1.nodes
+        node2, = peer2.nodes
+        # The duplicate was closed, keeping the link opened by peer1, which
+        # has the lowest ID.
+        assert node1.remote_id == 2 and node2.remote_id == 1
+        assert 'peer' in node1.extensions and 'peer' in node2.extensions
+        assert not node1.factory.isServer and node2.factory.isServer
+        factory1.dispatch('http://example.com/mytopic', {'from': 0})
+        factory2.dispatch('http://example.com/mytopic', {'from': 1})
+
+    checked = deferLater(reactor, 1.0, check_connection)
+    return DeferredList([checked] + received, fireOnOneErrback=True)
+
+
+def test_unsubscribe_linger():
+    """
+    Test that the consumer stays subscribed for a while after the last user
+    unsubscribes.
+
+    """
+    print('Running test_unsubscribe_linger')
+    topic = 'http://example.com/mytopic'
+
+    class WampConsumerServerProtocol(wamp.WampServerProtocol):
+        def onSessionOpen(self):
+            self.registerForPubSub(topic)
+
+    class WampConsumerServerFactory(ConsumerMixin, wamp.WampServerFactory):
+        protocol = WampConsumerServerProtocol
+        unsubscribe_linger = 1.0
+
+    class WampConsumerClientProtocol(wamp.WampClientProtocol):
+        def onSessionOpen(self):
+            self.subscribe(topic, lambda topic, event: None)
+            deferLater(reactor, 0.5, self.unsubscribe, topic)
+
+    class WampConsumerClientFactory(wamp.WampClientFactory):
+        protocol = WampConsumerClientProtocol
+
+    consumer = ConsumerServer('localhost', 19500)
+    WampConsumerServerFactory.consumer = consumer
+    consumer_server = WampConsumerServerFactory('ws://localhost:19502')
+    listenWS(consumer_server)
+    consumer.processor = consumer_server
+    producer = ProducerClient([('localhost', 19500)])
+    deferLater(reactor, 0.5, connectWS, WampConsumerClientFactory(
+        'ws://localhost:19502',
+    ))
+
+    def subscribed():
+        return [topic in node.subscriptions for node in producer.nodes]
+
+    def check_lingering():
+        assert subscribed() == [True], subscribed()
+
+    def check_unsubscribed():
+        assert subscribed() == [False], subscribed()
+
+    d = deferLater(reactor, 1.5, check_lingering)
+    d.addCallback(lambda _: deferLater(reactor, 1.0, check_unsubscribed))
+    return d
+
+
+def test_retain_publish():
+    """
+    Test that a message published by a WAMP client, which Autobahn excludes
+    the publisher from by default, is retained and sent to every session.
+
+    """
+    print('Running test_retain_publish')
+    topic = 'http://example.com/state/mytopic'
+
+    class WampProducerServerProtocol(wamp.WampServerProtocol):
+        def onSessionOpen(self):
+            self.registerForPubSub(topic)
+
+    class WampProducerServerFactory(ProducerMixin, wamp.WampServerFactory):
+        protocol = WampProducerServerProtocol
+
+    class WampProducerClientProtocol(wamp.WampClientProtocol):
+        def onSessionOpen(self):
+            self.publish(topic, {'a': 'b'})
+
+    class WampProducerClientFactory(wamp.WampClientFactory):
+        protocol = WampProducerClientProtocol
+
+    producer = ProducerClient(retain=['http://example.com/state/'])
+    WampProducerServerFactory.producer = producer
+    seen = []
+    publish_local = producer.publish_local
+
+    def record_targets(topic, message, session=None, targets=None):
+        seen.append(targets)
+        publish_local(topic, message, session, targets)
+
+    producer.publish_local = record_targets
+    listenWS(WampProducerServerFactory('ws://localhost:19601'))
+    connectWS(WampProducerClientFactory('ws://localhost:19601'))
+
+    def check_retained():
+        assert seen == [None], seen
+        assert topic in producer.last_values
+        assert producer.last_values[topic] == {'a': 'b'}
+
+    return deferLater(reactor, 1.0, check_retained)
+
+
+def test_reactor_monitor():
+    """
+    Test that the reactor monitor measures the lag, and only runs while
+    connections are monitored.
+
+    """
+    print('Running test_reactor_monitor')
+    # The connections of the previous tests aren't monitored.
+    assert not monitor.MONITOR.running
+    clock = Clock()
+    reactor_monitor = monitor.ReactorMonitor(
+        interval=0.1, threshold=0.05, clock=clock,
+    )
+    first, second = object(), object()
+    reactor_monitor.register(first)
+    reactor_monitor.register(second)
+    assert reactor_monitor.running
+    clock.advance(0.1)
+    clock.advance(0.3)  # A callback held the reactor for 0.2 seconds
+    lag = reactor_monitor.stats()['lag']
+    assert lag['count'] == 2 and lag['slow'] == 1, lag
+    assert abs(lag['max'] - 0.2) < 1e-9, lag
+    reactor_monitor.unregister(first)
+    assert reactor_monitor.running
+    reactor_monitor.unregister(second)
+    assert not reactor_monitor.running
+    assert not clock.getDelayedCalls()
+
+
+def test_heavy_hitters():
+    """
+    Test that the count-min sketch never underestimates a topic, stays close
+    to the true counts, and finds the heaviest topics among many light ones.
+
+    """
+    print('Running test_heavy_hitters')
+    counts = dict()
+    for index in range(2000):
+        counts['http://example.com/light/{0}'.format(index)] = index % 3 + 1
+    for index in range(5):
+        counts['http://example.com/heavy/{0}'.format(index)] = 500 * (
+            index + 1
+        )
+    stream = [topic for topic, count in counts.items() for _ in range(count)]
+    random.Random(0).shuffle(stream)
+    sketch = hitters.TopK(k=5)
+    for topic in stream:
+        sketch.add(topic)
+    heavy = sorted(
+        (topic for topic in counts if '/heavy/' in topic),
+        key=counts.get, reverse=True,
+    )
+    assert [topic for topic, _ in sketch.top()] == heavy, sketch.top()
+    errors = [sketch.estimate(topic) - counts[topic] for topic in counts]
+    assert min(errors) >= 0
+    # The expected error of a count-min sketch is e / width of the total.
+    bound = 2.72 / sketch.width * len(stream)
+    assert sum(errors) / float(len(errors)) < bound, sum(errors)
+    assert all(sketch.estimate(topic) - counts[topic] < bound
+               for topic in heavy)
+
+    clock = Clock()
+    tracker = hitters.HeavyHitters(k=2, interval=10.0, clock=clock)
+    tracker.add('fanout', 'http://example.com/a')
+    assert tracker.timer.running
+    assert tracker.top() == {'fanout': [('http://example.com/a', 1)]}
+    clock.advance(10.0)  # Logged and cleared
+    assert tracker.top() == {'fanout': []}
+    assert tracker.timer.running
+    clock.advance(10.0)  # Nothing counted, so logging stops
+    assert not tracker.timer.running
+    tracker.add('fanout', 'http://example.com/a')
+    assert tracker.timer.running
+    tracker.stop()
+    assert not clock.getDelayedCalls()
+
+
+class FakeCodecPool(object):
+    """
+    Stands for the worker pool, letting the test fire each message it was
+    handed when it likes.
+
+    """
+    def __init__(self):
+        self.calls = []
+
+    def decode(self, payload):
+        self.calls.append((payload, Deferred()))
+        return self.calls[-1][1]
+
+    def encode(self, message):
+        self.calls.append((message, Deferred()))
+        return self.calls[-1][1]
+
+
+def test_codec_order():
+    """
+    Test that a connection processes the messages it receives, and queues
+    those it sends, in their original order whichever are handled by the
+    worker pool, and drops those the pool fails on.
+
+    """
+    print('Running test_codec_order')
+    pool = FakeCodecPool()
+    offload = codec.Offload(size=40, pool=pool)
+    received = []
+    sent = []
+    large = ' ' * 40
+
+    def message(name, *params):
+        return json.dumps([name] + list(params))
+
+    class Factory(object):
+        pass
+
+    class Protocol(ProtocolBase):
+        factory = Factory()
+
+        def process(self, size, obj):
+            received.append(obj[0])
+            if obj[0] == 'fragment':
+                # Stands for the last fragment of a large message.
+                self.receive(message('large2', large), current=True)
+
+        def queue_data(self, topic, serialized):
+            sent.append(topic)
+
+    Protocol.factory.offload = offload
+    protocol = Protocol()
+    protocol.receive(message('small1'))
+    assert received == ['small1'] and not pool.calls
+    protocol.receive(message('large1', large))
+    protocol.receive(message('small2'))
+    protocol.receive(message('fragment'))
+    protocol.receive(message('small3'))
+    protocol.receive(message('failed', large))
+    protocol.receive(message('small4'))
+    assert received == ['small1']
+    assert len(pool.calls) == 2
+
+    # Later messages wait for the pool, even once it's done with them.
+    pool.calls[1][1].errback(ValueError('Not JSON'))
+    assert received == ['small1']
+    pool.calls[0][1].callback(json.loads(pool.calls[0][0]))
+    # The reassembled message goes in front of those received after the
+    # fragment, and the rest wait for it.
+    assert received == [
+        'small1', 'large1', 'small2', 'fragment',
+    ], received
+    assert len(pool.calls) == 3
+    pool.calls[2][1].callback(json.loads(pool.calls[2][0]))
+    # The message the pool failed to decode is dropped.
+    assert received == [
+        'small1', 'large1', 'small2', 'fragment', 'large2', 'small3',
+        'small4',
+    ], received
+    assert not protocol.decoding
+
+    del pool.calls[:]
+    offload.encoded('http://example.com/large', 100)
+    offload.encoded('http://example.com/failed', 100)
+    protocol.send_data('http://example.com/small1', 'publish', 1)
+    assert sent == ['http://example.com/small1']
+    protocol.send_data('http://example.com/large', 'publish', 2)
+    protocol.send_data('http://example.com/failed', 'publish', 3)
+    protocol.send_data('http://example.com/small2', 'publish', 4)
+    assert len(pool.calls) == 2 and len(sent) == 1
+    pool.calls[0][1].callback(json.dumps(pool.calls[0][0]))
+    assert sent[1:] == ['http://example.com/large']
+    pool.calls[1][1].errback(ValueError('Not serializable'))
+    assert sent[1:] == [
+        'http://example.com/large', 'http://example.com/small2',
+    ], sent
+    assert not protocol.encoding
+
+
+def test_codec_pool():
+    """
+    Test that the worker pool decodes and encodes JSON, and fails on what
+    isn't.
+
+    """
+    print('Running test_codec_pool')
+    pool = codec.CodecPool()
+    pool.start(workers=1)
+    failures = []
+
+    def failed(failure):
+        failures.append(failure.check(ValueError))
+
+    def check(results):
+        pool.stop()
+        assert results == [[1, 'a'], '[1, "a"]', None, None], results
+        assert failures == [ValueError, ValueError], failures
+        stats = pool.stats()
+        assert stats['decoded'] == 2 and stats['encoded'] == 2
+        assert stats['failed'] == 2 and stats['pending'] == 0
+
+    return DeferredList([
+        pool.decode('[1, "a"]'),
+        pool.encode([1, 'a']),
+        pool.decode('[1, ').addErrback(failed),
+        pool.encode(set([1])).addErrback(failed),
+    ], fireOnOneErrback=True).addCallback(
+        lambda results: check([value for _, value in results])
+    )
+
+
+def test_drain():
+    """
+    Test that a producer draining with publishes still queued delivers them
+    all before closing, that the consumer doesn't reconnect, and that a
+    client draining stops retrying the servers it can't reach.
+
+    """
+    print('Running test_drain')
+    topic = 'http://example.com/mytopic'
+    received = []
+
+    class Processor(object):
+        subscriptions = {topic: set()}
+
+    def forward(topic, message, *args):
+        received.append(message)
+
+    producer = ProducerServer('localhost', 19700)
+    consumer = ConsumerClient([('localhost', 19700)])
+    consumer.processor = Processor()
+    consumer.forward = forward
+    # Nothing listens there, so the client keeps retrying.
+    unreachable = ConsumerClient([('localhost', 19709)])
+    unreachable.processor = Processor()
+
+    def drain():
+        node, = producer.nodes
+        assert topic in node.subscriptions
+        node.pauseProducing()
+        for index in range(50):
+            producer.publish(topic, index)
+        assert len(node.outbound) == 50
+        drained = producer.drain()
+        deferLater(reactor, 0.5, node.resumeProducing)
+        return drained
+
+    def check_drained(_):
+        assert received == list(range(50)), received
+        assert not producer.nodes and not consumer.nodes
+        assert consumer.drained_nodes == set([('localhost', 19700)])
+        assert not any(factory.continueTrying
+                       for factory in consumer.factories)
+        return unreachable.drain()
+
+    def check_unreachable(_):
+        assert not unreachable.nodes
+        factory, = unreachable.factories
+        assert not factory.continueTrying
+        # No connection was made again.
+        assert not consumer.nodes and not producer.nodes
+
+    d = deferLater(reactor, 1.0, drain)
+    d.addCallback(check_drained)
+    d.addCallback(lambda _: deferLater(reactor, 1.0, lambda: None))
+    d.addCallback(check_unreachable)
+    return d
+
+
+def test_drained_discovery():
+    """
+    Test that discovery only connects to a drained node again once it has
+    been unlisted and listed again, and that unlisting a server stops the
+    client retrying it.
+
+    """
+    print('Running test_drained_discovery')
+
+    class Client(object):
+        id = None
+
+        def __init__(self):
+            self.connects = []
+            self.drained_nodes = set()
+
+        def connect(self, host, port, id=None):
+            self.drained_nodes.discard((host, port))
+            self.connects.append((host, port))
+
+        def disconnect(self, host, port):
+            pass
+
+    client = Client()
+    backend = discovery.Discovery(client)
+    first, second = ('localhost', 1), ('localhost', 2)
+    backend.reconcile({first: None})
+    # The first node drains, but stays listed for a while.
+    client.drained_nodes.add(first)
+    backend.reconcile({first: None, second: None})
+    assert client.connects == [first, second], client.connects
+    backend.reconcile({second: None})
+    backend.reconcile({first: None, second: None})
+    assert client.connects == [first, second, first], client.connects
+
+    # Nothing listens there, so the client keeps retrying until unlisted.
+    retrying = ConsumerClient([('localhost', 19760), ('localhost', 19761)])
+    retrying.disconnect('localhost', 19760)
+    trying = dict(
+        (factory.port, factory.continueTrying)
+        for factory in retrying.factories
+    )
+    assert trying == {19760: False, 19761: True}, trying
+    retrying.disconnect('localhost', 19761)
+
+
+def test_heartbeat():
+    """
+    Test the RTT estimation, when a peer is declared dead, and that the
+    heartbeat only runs while connections are registered.
+
+    """
+    print('Running test_heartbeat')
+    liveness = heartbeat.Liveness()
+    liveness.pong(liveness.ping(0.0), 0.2)
+    assert abs(liveness.mean - 0.2) < 1e-9
+    assert abs(liveness.variance - 0.01) < 1e-9
+    payload = liveness.ping(5.0)
+    liveness.pong('1', 5.4)  # Answers an older ping, ignored
+    assert liveness.outstanding
+    liveness.pong(payload, 5.6)
+    # SRTT moves by 1/8 of the error, RTTVAR by 1/4.
+    assert abs(liveness.mean - 0.25) < 1e-9
+    assert abs(liveness.variance - (0.01 + 0.25 * (0.16 - 0.01))) < 1e-9
+    assert liveness.stats()['min'] == 0.2
+    assert abs(liveness.stats()['max'] - 0.6) < 1e-9
+
+    # The suspicion grows with the time the pong is overdue, and the pong is
+    # overdue once it crosses the threshold.
+    sent = 10.0
+    liveness.ping(sent)
+    steps = [sent + step / 100.0 for step in range(1, 3000)]
+    levels = [liveness.phi(now) for now in steps]
+    assert levels == sorted(levels)
+    crossing = next(
+        now for now, level in zip(steps, levels)
+        if level > heartbeat.PHI_THRESHOLD
+    )
+    expected = liveness.mean + heartbeat.ACCEPTABLE_PAUSE
+    assert sent + expected < crossing < sent + expected + 3.0, crossing
+    assert not liveness.overdue(crossing - 0.01)
+    assert liveness.overdue(crossing)
+    # The peer is only dead if the pong is still overdue at the next check.
+    assert not liveness.is_dead(crossing)
+    assert liveness.is_dead(crossing + 1.0)
+    # A pong read in between, e.g. after the reactor stalled, saves it.
+    liveness.ping(100.0)
+    assert not liveness.is_dead(150.0)
+    liveness.pong(str(liveness.sequence), 150.0)
+    assert not liveness.is_dead(151.0)
+
+    # However stable the RTT, a pong is given at least MIN_PONG_WAIT, the
+    # longest a pong was waited for before RTTs were measured.
+    stable = heartbeat.Liveness()
+    for index in range(100):
+        stable.pong(stable.ping(index * 5.0), index * 5.0 + 0.001)
+    stable.ping(1000.0)
+    wait = heartbeat.MIN_PONG_WAIT
+    assert stable.phi(1000.0 + wait - 0.1) < heartbeat.PHI_THRESHOLD
+    assert not stable.is_dead(1000.0 + wait - 0.1)
+
+    # However erratic the RTT, a peer is dead after MAX_PONG_WAIT.
+    erratic = heartbeat.Liveness()
+    erratic.pong(erratic.ping(0.0), 20.0)
+    erratic.ping(100.0)
+    wait = heartbeat.MAX_PONG_WAIT
+    assert erratic.phi(100.0 + wait + 0.1) < heartbeat.PHI_THRESHOLD
+    assert not erratic.overdue(100.0 + wait - 0.1)
+    assert not erratic.is_dead(100.0 + wait + 0.1)
+    assert erratic.is_dead(100.0 + wait + 1.1)
+
+    class Transport(object):
+        lost = False
+
+        def loseConnection(self):
+            self.lost = True
+
+    class Protocol(object):
+        def __init__(self):
+            self.liveness = heartbeat.Liveness()
+            self.transport = Transport()
+            self.pings = []
+
+        def sendPing(self, payload):
+            self.pings.append(payload)
+
+    clock = Clock()
+    beat = heartbeat.Heartbeat(interval=5.0, tick=0.5, clock=clock)
+    answering, silent = Protocol(), Protocol()
+    beat.register(answering)
+    beat.register(silent)
+    assert beat.timer.running
+
+    def run(ticks):
+        for _ in range(ticks):
+            clock.advance(0.5)
+            if answering.liveness.outstanding:
+                answering.liveness.pong(answering.pings[-1], clock.seconds())
+
+    run(10)
+    assert len(answering.pings) == 1 and len(silent.pings) == 1
+    # The silent peer is kept for MIN_PONG_WAIT, then dropped once its pong
+    # has been overdue for two checks.
+    sent = silent.liveness.sent_at
+    while not silent.transport.lost:
+        run(1)
+    lost = clock.seconds() - sent
+    assert heartbeat.MIN_PONG_WAIT + 1.0 <= lost <= 10.0, lost
+    assert len(answering.pings) >= 2 and len(silent.pings) == 1
+    assert not answering.transport.lost
+    assert silent not in beat.wheel.positions
+    assert beat.timer.running
+    # The timer stops with the last connection.
+    beat.unregister(answering)
+    assert not beat.timer.running and not clock.getDelayedCalls()
+
+
+def test_fair_queueing():
+    """
+    Test that a heavy topic shares a congested link with several light ones
+    in turns, in proportion to the weights of the topics.
+
+    """
+    print('Running test_fair_queueing')
+    heavy = 'http://example.com/heavy'
+    light = ['http://example.com/light/{0}'.format(index)
+             for index in range(4)]
+    # Each message is a quarter of a turn's credit, and says its topic.
+    size = outbound.QUANTUM // 4
+
+    def send(weights):
+        stats = outbound.OutboundStats()
+        queue = outbound.OutboundQueue(
+            outbound.PriorityClasses(), outbound.TopicWeights(weights),
+            stats,
+        )
+        for _ in range(200):
+            queue.push(heavy, heavy.ljust(size))
+        for topic in light:
+            for _ in range(20):
+                queue.push(topic, topic.ljust(size))
+        order = []
+        while queue:
+            order.append(queue.pop().rstrip())
+        return order, stats.snapshot([queue], 1)
+
+    order, stats = send([])
+    # While the light topics are backlogged, every topic sends a turn's
+    # worth in turn.
+    assert order[:100] == [
+        topic for _ in range(5) for topic in [heavy] + light
+        for _ in range(4)
+    ], order[:100]
+    assert order[100:] == [heavy] * 180
+    assert stats['outbound.contending_topics'] == 5
+    assert stats['outbound.fairness'] == 1.0, stats
+
+    # A topic of weight 2 gets twice the bytes while contending.
+    order, stats = send([(heavy, 2)])
+    contended = order[:len(order) - order[::-1].index(light[-1])]
+    counts = [contended.count(topic) for topic in [heavy] + light]
+    assert counts == [40, 20, 20, 20, 20], counts
+    assert outbound.jain_index([counts[0] / 2.0] + counts[1:]) == 1.0
+    assert outbound.jain_index(counts) < 1.0
+    assert stats['outbound.fairness'] == 1.0, stats
+
+
+def test_resume_state():
+    """
+    Test the replay window and grace period of a producer's session, and
+    the consumer noticing missed and repeated publishes.
+
+    """
+    print('Running test_resume_state')
+    session = resume.Session(dict(), dict(), buffer_size=3)
+    for index in range(5):
+        session.record('http://example.com/mytopic', index)
+    # Only the latest publishes are kept.
+    assert [entry[0] for entry in session.replay(0)] == [3, 4, 5]
+    assert [entry[2] for entry in session.replay(4)] == [4]
+    assert session.replay(5) == []
+
+    expired = []
+    session.detach(lambda: expired.append(True))
+    assert not session.attached
+    delay = session.expiry.getTime() - reactor.seconds()
+    assert abs(delay - resume.GRACE_PERIOD) < 1.0, delay
+    session.attach()
+    assert session.attached and not expired
+
+    state = resume.ResumeState(session.token)
+    assert state.receive(1) == 0
+    assert state.receive(4) == 2
+    assert state.receive(3) is None
+    assert state.last_seq == 4
+
+
+def test_resume_reconnect(port, producer_id):
+    """
+    Test that a consumer which loses its connection resumes its session on
+    reconnecting, getting the publishes it missed replayed exactly once.
+    Without the producer's ID, the session isn't kept for resuming.
+
+    """
+    print('Running test_resume_reconnect')
+    topic = 'http://example.com/mytopic'
+    received = []
+
+    class Processor(object):
+        subscriptions = {topic: set()}
+
+    def forward(topic, message, *args):
+        received.append(message)
+
+    producer = ProducerServer('localhost', port, id=producer_id)
+    consumer = ConsumerClient([('localhost', port)], id=2)
+    consumer.processor = Processor()
+    consumer.forward = forward
+    resumed = producer_id is not None
+
+    def connected():
+        node, = consumer.nodes
+        assert 'resume' in node.extensions
+        assert (node.resume is not None) == resumed
+        assert list(consumer.resume_states) == ([1] if resumed else [])
+        assert producer.sessions[2].attached
+        assert not producer.detached_sessions
+        for index in range(5):
+            producer.publish(topic, index)
+
+    def disconnect():
+        assert received == list(range(5)), received
+        node, = producer.nodes
+        node.transport.abortConnection()
+
+    def publish():
+        assert not producer.nodes
+        # The topic stays subscribed to while the session is kept.
+        assert producer.consumer_topics() == set([topic])
+        assert list(producer.detached_sessions) == [2]
+        for index in range(5, 10):
+            producer.publish(topic, index)
+
+    def check_resumed():
+        assert len(consumer.nodes) == 1, consumer.nodes
+        assert consumer.counters['resume.missed'] == 0
+        if resumed:
+            assert received == list(range(10)), received
+            assert producer.counters['resume.resumed'] == 1
+            assert producer.counters['resume.replayed'] == 5
+        else:
+            assert received == list(range(5)), received
+            assert not producer.counters['resume.resumed']
+            assert not consumer.resume_states
+        assert producer.consumer_topics() == set([topic])
+        assert not producer.detached_sessions
+        for node in producer.nodes:
+            node.transport.abortConnection()
+        for factory in consumer.factories:
+            factory.stopTrying()
+
+    d = deferLater(reactor, 1.0, connected)
+    d.addCallback(lambda _: deferLater(reactor, 0.5, disconnect))
+    d.addCallback(lambda _: deferLater(reactor, 0.5, publish))
+    d.addCallback(lambda _: deferLater(reactor, 5.0, check_resumed))
+    return d
+
+
+class StubFactory(object):
+    """
+    Stands for the container of a connection.
+
+    """
+    offload = hitters = None
+    max_message_size = fragments.MAX_MESSAGE_SIZE
+
+
+class StubProtocol(ProtocolBase):
+    """
+    A connection writing its messages to a list rather than a transport.
+
+    """
+    def __init__(self, factory=None):
+        self.factory = factory or StubFactory()
+        self.payloads = []
+        self.written = []
+
+    def sendMessage(self, payload, is_binary=False):
+        self.payloads.append(payload)
+        if payload.startswith(fragments.FRAGMENT_PREFIX):
+            self.written.append(fragments.parse_fragment(payload))
+        else:
+            self.written.append(json.loads(payload))
+
+
+def test_outbound_priorities():
+    """
+    Test that control messages skip the publishes queued, and that queued
+    publishes are written by priority class, in order within a topic.
+
+    """
+    print('Running test_outbound_priorities')
+    alerts = 'http://example.com/alerts/fire'
+    bulk = 'http://example.com/bulk/logs'
+    normal = 'http://example.com/bulkier'
+    classes = outbound.PriorityClasses([
+        ('http://example.com/bulk/', 2), ('http://example.com/alerts/', 0),
+    ], default=1)
+    assert classes.count == 3
+    assert [classes(topic) for topic in [alerts, bulk, normal]] == [0, 2, 1]
+    assert outbound.is_data(301) and not outbound.is_data(201)
+
+    queue = outbound.OutboundQueue(classes, outbound.TopicWeights())
+    for topic, payload in [
+            (bulk, 'b1'), (normal, 'n1'), (alerts, 'a1'), (bulk, 'b2'),
+            (alerts, 'a2'),
+    ]:
+        queue.push(topic, payload)
+    assert len(queue) == 5
+    assert [queue.pop() for _ in range(5)] == ['a1', 'a2', 'n1', 'b1', 'b2']
+    try:
+        queue.pop()
+    except IndexError:
+        pass
+    else:
+        raise AssertionError('Popped from an empty queue')
+
+    protocol = StubProtocol()
+    protocol.outbound = outbound.OutboundQueue(
+        classes, outbound.TopicWeights(),
+    )
+    protocol.pauseProducing()
+    protocol.send(301, bulk, 1)
+    protocol.send(301, alerts, 2)
+    protocol.send(201, normal)
+    # The transport is backlogged, yet the subscription is written.
+    assert protocol.written == [[201, normal]], protocol.written
+    protocol.resumeProducing()
+    assert protocol.written[1:] == [[301, alerts, 2], [301, bulk, 1]]
+    assert not protocol.outbound
+
+
+def test_fragments():
+    """
+    Test that large publishes are sent as fragments interleaved with other
+    topics and reassembled, and that messages over the size limit are
+    dropped, fragmented or not.
+
+    """
+    print('Running test_fragments')
+    # Quotes would double the size of the fragments if escaped.
+    data = '"' * (fragments.FRAGMENT_SIZE * 2 + 1000)
+    message = fragments.Fragments('http://example.com/large', 7, data)
+    sizes = []
+    frames = []
+    while message.remaining:
+        sizes.append(message.next_size)
+        frames.append(message.next())
+    # Frames, header included, are sized by the fragment size.
+    assert sizes == [len(frame) for frame in frames], sizes
+    assert sizes[:2] == [fragments.FRAGMENT_SIZE] * 2, sizes
+    assert sizes[2] < 1100, sizes
+    chunks = [fragments.parse_fragment(frame) for frame in frames]
+    assert [chunk[:3] for chunk in chunks] == [
+        [302, 7, False], [302, 7, False], [302, 7, True],
+    ]
+    assert ''.join(chunk[3] for chunk in chunks) == data
+    try:
+        fragments.parse_fragment('[302, 7, false]')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Parsed a fragment without a header')
+
+    # Messages are reassembled from interleaved fragments.
+    reassembly = fragments.Reassembly()
+    assert reassembly.add(1, False, 'ab') is None
+    assert reassembly.add(2, False, 'xy') is None
+    assert reassembly.add(1, True, 'c') == 'abc'
+    assert reassembly.add(2, True, 'z') == 'xyz'
+    # Messages over the limit are dropped, up to their last fragment.
+    reassembly = fragments.Reassembly(max_message_size=100)
+    assert reassembly.add(3, False, 'x' * 60) is None
+    assert reassembly.add(3, False, 'x' * 60) is None
+    assert reassembly.add(3, True, 'x') is None
+    assert reassembly.add(3, True, 'x') == 'x'
+    # So is the oldest message, once too many are being reassembled.
+    for id in range(fragments.MAX_PARTIAL_MESSAGES + 1):
+        reassembly.add(id, False, 'x')
+    assert reassembly.add(0, True, 'x') is None
+    assert reassembly.add(1, True, 'x') == 'xx'
+
+    class Receiver(StubProtocol):
+        def __init__(self, factory=None):
+            StubProtocol.__init__(self, factory)
+            self.received = []
+
+        def process(self, size, obj):
+            if obj[0] == 302:
+                StubProtocol.process(self, size, obj)
+            else:
+                self.received.append(obj)
+
+    sender = StubProtocol()
+    sender.extensions = frozenset(['fragments'])
+    sender.outbound = outbound.OutboundQueue(
+        outbound.PriorityClasses(), outbound.TopicWeights(),
+    )
+    sender.pauseProducing()
+    sender.send(301, 'http://example.com/large', data)
+    sender.send(301, 'http://example.com/small', 'a')
+    sender.resumeProducing()
+    kinds = [item[0] for item in sender.written]
+    assert kinds[:2] == [302, 301] and set(kinds[2:]) == set([302]), kinds
+    assert max(len(payload) for payload in sender.payloads) == (
+        fragments.FRAGMENT_SIZE
+    )
+    receiver = Receiver()
+    for payload in sender.payloads:
+        receiver.onMessage(payload, False)
+    assert receiver.received == [
+        [301, 'http://example.com/small', 'a'],
+        [301, 'http://example.com/large', data],
+    ]
+
+    factory = StubFactory()
+    factory.max_message_size = 1000
+    receiver = Receiver(factory)
+    receiver.onMessage(json.dumps([301, 'a', 'x' * 1000]), False)
+    receiver.onMessage(json.dumps([301, 'a', 'x' * 980]), False)
+    assert [len(item[2]) for item in receiver.received] == [980]
+
+    # Autobahn fails the connections sending far larger messages.
+    server = ProducerServer('localhost', 19730, max_message_size=1000)
+    assert server.maxMessagePayloadSize == 2000
+    client = ConsumerClient([('localhost', 19739)], max_message_size=1000)
+    factory, = client.factories
+    assert factory.maxMessagePayloadSize == 2000
+    factory.stopTrying()
+    return server.listener.stopListening()
+
+
+def test_topic_aliases():
+    """
+    Test that topics get stable aliases which are never reused, and that
+    topics are interned.
+
+    """
+    print('Running test_topic_aliases')
+    table = topics.TopicTable()
+    first = table.alias('http://example.com/a')
+    second = table.alias('http://example.com/b')
+    assert first != second
+    assert table.alias('http://example.com/a') == first
+    assert table.topic(second) == 'http://example.com/b'
+    assert table.topic(second + 1) is None
+    table.release('http://example.com/a')
+    table.release('http://example.com/a')
+    assert table.topic(first) is None and len(table) == 1
+    # A publish still in flight for the released alias can't be taken for
+    # another topic.
+    assert table.alias('http://example.com/a') not in (first, second)
+
+    topic = topics.intern_topic(u'http://example.com/' + u'a')
+    assert type(topic) is str
+    assert topic is topics.intern_topic('http://example.com/' + 'a')
+    assert topics.intern_topic(u'http://example.com/\xe9') == (
+        u'http://example.com/\xe9'
+    )
+
+    prefixes = topics.TopicPrefixes(['http://example.com/state/'])
+    assert prefixes and not topics.TopicPrefixes()
+    assert 'http://example.com/state/a' in prefixes
+    assert 'http://example.com/a' not in prefixes
+    assert 'http://example.com/a' not in topics.TopicPrefixes()
+
+
+def test_last_values():
+    """
+    Test that the last value cache only retains the topics opted in, and
+    evicts the least recently used ones to stay within its size.
+
+    """
+    print('Running test_last_values')
+    prefix = 'http://example.com/state/'
+    # Each value is 10 bytes of JSON, so three fit.
+    cache = retain.LastValueCache([prefix], max_size=30)
+    for name in 'abc':
+        cache.put(prefix + name, name * 8)
+    cache.put('http://example.com/a', 'a' * 8)
+    assert len(cache) == 3 and cache.size == 30
+    assert 'http://example.com/a' not in cache
+    assert cache[prefix + 'a'] == 'aaaaaaaa'  # Now the most recently used
+    cache.put(prefix + 'd', 'd' * 8)
+    assert prefix + 'b' not in cache
+    assert list(cache.values) == [prefix + name for name in 'cad']
+    # Replacing a value refreshes the topic.
+    cache.put(prefix + 'c', 'C' * 8)
+    cache.put(prefix + 'e', 'e' * 8)
+    assert list(cache.values) == [prefix + name for name in 'dce']
+    assert cache[prefix + 'c'] == 'CCCCCCCC' and cache.size == 30
+    # A value too large for the cache isn't retained, nor is the previous.
+    cache.put(prefix + 'd', 'd' * 40)
+    assert prefix + 'd' not in cache and cache.size == 20
+    cache.discard(prefix + 'c')
+    assert list(cache.values) == [prefix + 'e'] and cache.size == 10
+    # A size already known isn't measured again.
+    cache.put(prefix + 'f', 'f' * 8, size=15)
+    assert cache.size == 25
+
+    # Producers retain messages with the size of the frames they sent.
+    class Node(object):
+        def publish(self, topic, message, via, origin, targets):
+            return 12
+
+    producer = ProducerServer('localhost', 19762, retain=[prefix])
+    node = Node()
+    producer.nodes.add(node)
+    producer.publish(prefix + 'a', 'a' * 8)
+    assert producer.last_values.size == 12
+    # Without a frame sent, the message is measured.
+    producer.nodes.discard(node)
+    producer.publish(prefix + 'b', 'b' * 8)
+    assert producer.last_values.size == 22
+    return producer.listener.stopListening()
+
+
+def test_filters():
+    """
+    Test compiling and evaluating content filters, and sharing them between
+    connections.
+
+    """
+    print('Running test_filters')
+    compiled = filters.compile_filter({
+        'user.id': 42, 'kind': {'in': ['created', 'deleted']},
+    })
+    assert compiled({'user': {'id': 42}, 'kind': 'created'})
+    assert compiled({'user': {'id': 42, 'name': 'a'}, 'kind': 'deleted'})
+    assert not compiled({'user': {'id': 43}, 'kind': 'created'})
+    assert not compiled({'user': {'id': 42}, 'kind': 'updated'})
+    assert not compiled({'user': {'id': 42}})  # Missing field
+    assert not compiled({'user': 42, 'kind': 'created'})
+    assert not compiled({'user': {'id': [42]}, 'kind': 'created'})
+    assert not compiled('created')
+    # The result is kept for the publish, whichever consumers evaluate it.
+    assert compiled({'user': {'id': 42}, 'kind': 'created'}, generation=1)
+    assert compiled({}, generation=1)
+    assert not compiled({}, generation=2)
+
+    for expression in [
+            {}, [], {'': 1}, {'a': {'in': 1}}, {'a': {'in': [1], 'b': 2}},
+            {'a': {'in': [[1]]}}, {'a': [1]}, {'a': {'b': 1}},
+    ]:
+        try:
+            filters.compile_filter(expression)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Compiled {0!r}'.format(expression))
+
+    cache = filters.FilterCache()
+    shared = cache.get({'a': 1, 'b': {'in': [2, 3]}})
+    assert cache.get({'b': {'in': [2, 3]}, 'a': 1}) is shared
+    assert cache.get({'a': {'b': 1}}) is None
+    assert len(cache) == 1
+    del shared
+    assert len(cache) == 0  # Forgotten once no connection uses it
+
+
+def test_delta_patches():
+    """
+    Test that patches computed between documents turn one into the other,
+    without modifying the original.
+
+    """
+    print('Running test_delta_patches')
+    old = {'a': 1, 'b': {'c': 2, 'd': {'e': 3}}, 'f': [1], 'g': True}
+    new = {'a': 1, 'b': {'c': 4, 'd': {'e': 3}}, 'f': [1, 2], 'g': 1}
+    ops = deltas.diff(old, new)
+    assert sorted(ops) == [[['b', 'c'], 4], [['f'], [1, 2]], [['g'], 1]]
+    assert deltas.patch(old, ops) == new
+    assert old['b'] == {'c': 2, 'd': {'e': 3}}
+    assert deltas.diff(old, old) == []
+    assert deltas.patch(new, deltas.diff(new, {'b': {}})) == {'b': {}}
+    assert deltas.patch(old, deltas.diff(old, {})) == {}
+    assert deltas.diff(old, [1]) is None and deltas.diff(1, old) is None
+
+    for base, ops in [
+            ([1], []), (old, [[['a', 'x'], 1]]), (old, [[]]),
+            (old, [[['a'], 1, 2]]), (old, ['a']),
+    ]:
+        try:
+            deltas.patch(base, ops)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Applied {0!r}'.format(ops))
+
+
+def test_delta_resync():
+    """
+    Test that delta encoded publishes reach the consumer whole, and that a
+    consumer which lost its baseline asks for a snapshot.
+
+    """
+    print('Running test_delta_resync')
+    topic = 'http://example.com/state/mytopic'
+    received = []
+
+    class Processor(object):
+        subscriptions = {topic: set()}
+
+    def forward(topic, message, *args):
+        received.append(message)
+
+    producer = ProducerServer(
+        'localhost', 19740, deltas=['http://example.com/state/'],
+    )
+    consumer = ConsumerClient([('localhost', 19740)])
+    consumer.processor = Processor()
+    consumer.forward = forward
+    documents = [
+        {'count': count, 'padding': 'x' * 100} for count in range(5)
+    ]
+
+    def publish(*counts):
+        for count in counts:
+            producer.publish(topic, documents[count])
+
+    def lose_baseline():
+        node, = consumer.nodes
+        node.received_baselines.discard(topic)
+        publish(3)
+
+    def check_resynced():
+        # The patch the consumer couldn't apply was made up for by the
+        # snapshot.
+        assert received == documents, received
+        assert producer.counters['deltas.snapshots'] == 1
+        assert producer.counters['deltas.patches'] == 4
+        assert producer.counters['deltas.resyncs'] == 1
+        assert consumer.counters['deltas.desyncs'] == 1
+        node, = consumer.nodes
+        assert not node.resyncing
+        # Baselines are sized by the frames they were received in.
+        baseline = node.received_baselines.get(topic)
+        assert baseline.size >= len(json.dumps(documents[-1])), baseline.size
+        for node in producer.nodes:
+            node.transport.abortConnection()
+        for factory in consumer.factories:
+            factory.stopTrying()
+
+    d = deferLater(reactor, 1.0, publish, 0, 1, 2)
+    d.addCallback(lambda _: deferLater(reactor, 0.5, lose_baseline))
+    d.addCallback(lambda _: deferLater(reactor, 0.5, publish, 4))
+    d.addCallback(lambda _: deferLater(reactor, 0.5, check_resynced))
+    return d
+
+
+def test_hash_ring():
+    """
+    Test that the hash ring spreads topics evenly, and only moves the topics
+    of the nodes joining or leaving.
+
+    """
+    print('Running test_hash_ring')
+    hash_ring = ring.HashRing()
+    assert hash_ring.owner('http://example.com/a') is None
+    for member in [1, 2, 3, 4]:
+        hash_ring.add(member)
+    hash_ring.add(4)
+    assert len(hash_ring) == 4 and 4 in hash_ring
+    names = ['http://example.com/{0}'.format(index) for index in range(4000)]
+    owners = dict((name, hash_ring.owner(name)) for name in names)
+    counts = [list(owners.values()).count(member) for member in [1, 2, 3, 4]]
+    assert all(600 < count < 1400 for count in counts), counts
+
+    # Every node agrees on the owners, whatever order it learnt of the
+    # others in.
+    other = ring.HashRing()
+    for member in [4, 2, 3, 1]:
+        other.add(member)
+    assert all(other.owner(name) == owners[name] for name in names)
+
+    hash_ring.add(5)
+    moved = [name for name in names if hash_ring.owner(name) != owners[name]]
+    assert all(hash_ring.owner(name) == 5 for name in moved)
+    assert 400 < len(moved) < 1200, len(moved)
+    hash_ring.remove(5)
+    assert all(hash_ring.owner(name) == owners[name] for name in names)
+    hash_ring.remove(2)
+    assert all(
+        hash_ring.owner(name) == owners[name]
+        for name in names if owners[name] != 2
+    )
+
+
+def test_relay_loops():
+    """
+    Test that a relay adds itself to the path of the publishes it forwards
+    and drops those which already went through it, and that producers skip
+    the consumers a publish went through.
+
+    """
+    print('Running test_relay_loops')
+    topic = 'http://example.com/mytopic'
+    upstream = RelayConsumerClient(id=7)
+    downstream = RelayProducerServer('localhost', 19750, id=7)
+    for other in [RelayConsumerClient(id=8), RelayConsumerClient()]:
+        try:
+            Relay(other, downstream)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Relayed between different IDs')
+    relay = Relay(upstream, downstream)
+    forwarded = []
+    downstream.publish = lambda topic, message, via, origin, targets: (
+        forwarded.append(via)
+    )
+    relay.forward(topic, 1)
+    relay.forward(topic, 2, via=(3,))
+    relay.forward(topic, 3, via=(3, 7))
+    assert forwarded == [(7,), (3, 7)], forwarded
+    assert upstream.counters['relay.loops'] == 1
+
+    delivered = []
+
+    class Protocol(producer.ProducerProtocol):
+        factory = downstream
+        ready = True
+        remote_id = 3
+
+        def deliver(self, topic, message, *args):
+            delivered.append(message)
+
+    node = Protocol()
+    node.onOpen()
+    node.subscriptions[topic] = None
+    node.publish(topic, 1, via=(7,))
+    node.publish(topic, 2, via=(3, 7))
+    assert delivered == [1], delivered
+
+    # The relay subscribes on its producers while any consumer is.
+    upstream_topics = []
+    upstream.subscribe = lambda topic: upstream_topics.append(('+', topic))
+    upstream.unsubscribe = lambda topic: upstream_topics.append(('-', topic))
+    first, second = Protocol(), Protocol()
+    first.onOpen()
+    second.onOpen()
+    first.onSubscribe('a', 'b')
+    second.onSubscribe('b')
+    second.onUnsubscribe('b')
+    second.onSubscribe('b')
+    first.onUnsubscribe('b')
+    first.onUnsubscribe('a')
+    assert upstream_topics == [('+', 'a'), ('+', 'b'), ('-', 'a')], (
+        upstream_topics
+    )
+    assert downstream.consumer_topics() == set(['b'])
+    return downstream.listener.stopListening()
+
+
+def test_subscriber_counts():
+    """
+    Test that a topic is counted while any map holds it, a map held by both
+    a connection and its session counting once.
+
+    """
+    print('Running test_subscriber_counts')
+    counts = topics.SubscriberCounts()
+    connection, session = {'a': None}, {'a': None, 'b': None}
+    assert counts.hold(connection) == ['a']
+    assert counts.hold(session) == ['b']
+    assert counts.topics() == set(['a', 'b'])
+    # The connection adopts the session's map, then releases its own.
+    assert counts.hold(session) == []
+    assert counts.release(connection) == []
+    assert counts.release(session) == []
+    session['c'] = connection['d'] = None
+    assert counts.add(session, 'c') == ['c']
+    assert counts.add(connection, 'd') == []  # Not held any more
+    del session['a']
+    assert counts.discard(session, 'a') == ['a']
+    assert sorted(counts.release(session)) == ['b', 'c']
+    assert not counts.topics() and not counts.holders
+
+
+def test_dedup_window():
+    """
+    Test that publishes received twice within the window are dropped,
+    whatever order they arrive in, and that origins are told apart.
+
+    """
+    print('Running test_dedup_window')
+    tagger = dedup.OriginTagger(1)
+    tags = [list(tagger.next()) for _ in range(5)]
+    assert [tag[2] for tag in tags] == [1, 2, 3, 4, 5]
+    assert len(set(tag[1] for tag in tags)) == 1
+
+    window = dedup.DedupWindow(window=8, max_origins=2)
+    accepted = [window.accept(tags[index]) for index in [0, 2, 1, 2, 4, 0]]
+    assert accepted == [True, True, True, False, True, False], accepted
+    # Another epoch of the same producer, i.e. after a restart.
+    restarted = [1, tags[0][1] + 1, 1]
+    assert window.accept(restarted) and not window.accept(restarted)
+    # Publishes older than the window can't be told from a restart.
+    assert window.accept([2, 0, 20])
+    assert window.accept([2, 0, 12]) and window.accept([2, 0, 12])
+    assert window.accept([2, 0, 13]) and not window.accept([2, 0, 13])
+    # A jump past the window starts it afresh.
+    assert window.accept([2, 0, 30]) and window.accept([2, 0, 29])
+    assert not window.accept([2, 0, 30])
+    # The least recently seen origin was forgotten.
+    assert len(window) == 2
+    assert window.accept(tags[1])
+    # Invalid tags are let through.
+    assert window.accept(None) and window.accept([1, 2])
+    assert window.accept([1, [2], 3]) and window.accept([1, 2, 'a'])
+
+
+def test_capture():
+    """
+    Test that the records of a capture are read back as written, including
+    from a file appended to and from one truncated by a crash.
+
+    """
+    print('Running test_capture')
+    directory = tempfile.mkdtemp()
+    try:
+        path = os.path.join(directory, 'capture')
+        recorder = capture.Recorder(path)
+        recorder.record(capture.SUBSCRIBE, u'http://example.com/\xe9')
+        recorder.record(capture.PUBLISH, 'http://example.com/a', {'a': 1})
+        recorder.record(capture.RECEIVE, 'http://example.com/a', [1], 10)
+        recorder.close()
+        # Appending, without the message this time.
+        recorder = capture.Recorder(path, payloads=False)
+        recorder.record(capture.RECEIVE, 'http://example.com/a', [1, 2], 10)
+        recorder.record(capture.PUBLISH, 'http://example.com/a', [1, 2])
+        recorder.close()
+        records = list(capture.read_capture(path))
+        assert [
+            (record.kind, record.topic, record.size, record.message)
+            for record in records
+        ] == [
+            (capture.SUBSCRIBE, u'http://example.com/\xe9', 0, None),
+            (capture.PUBLISH, 'http://example.com/a', 8, {'a': 1}),
+            (capture.RECEIVE, 'http://example.com/a', 3, [1]),
+            (capture.RECEIVE, 'http://example.com/a', 10, None),
+            (capture.PUBLISH, 'http://example.com/a', 6, None),
+        ], records
+        times = [record.time for record in records]
+        assert times[0] == 0 and times == sorted(times), times
+
+        # A record cut short is skipped.
+        with open(path, 'rb') as original:
+            data = original.read()
+        with open(path, 'wb') as truncated:
+            truncated.write(data[:-3])
+        assert len(list(capture.read_capture(path))) == 4
+
+        with open(path, 'wb') as other:
+            other.write('{"a": 1}\n')
+        try:
+            list(capture.read_capture(path))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('Read a file which is not a capture')
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_rate_limits():
+    """
+    Test that messages over a rate limit are dropped, or delayed up to
+    ``MAX_DELAY`` with the bucket going into debt.
+
+    """
+    print('Running test_rate_limits')
+    assert not ratelimit.RateLimiter()
+    try:
+        ratelimit.RateLimiter(policy='queue')
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('Accepted an unknown policy')
+
+    # The longest matching prefix wins, and each topic has its own bucket.
+    limiter = ratelimit.RateLimiter([('a.', 2, 2), ('a.b.', 1, 1)])
+    assert limiter
+    checks = [limiter.check('a.x', None, 0) for _ in range(3)]
+    assert checks == [0.0, 0.0, None], checks
+    assert limiter.check('a.y', None, 0) == 0.0
+    assert limiter.check('a.x', None, 0.5) == 0.0
+    assert limiter.check('a.x', None, 0.5) is None
+    checks = [limiter.check('a.b.x', None, 0) for _ in range(2)]
+    assert checks == [0.0, None], checks
+    assert all(limiter.check('c', None, 0) == 0.0 for _ in range(10))
+
+    # A message dropped by one limit takes no token from the other.
+    limiter = ratelimit.RateLimiter([('a', 10, 10)], session_limit=(1, 1))
+    assert limiter.check('a', 1, 0) == 0.0
+    assert limiter.check('a', 1, 0) is None
+    assert limiter.check('c', 1, 0) is None
+    assert limiter.check('c', None, 0) == 0.0
+    checks = [limiter.check('a', 2 + i, 0) for i in range(10)]
+    assert checks == [0.0] * 9 + [None], checks
+
+    # Delayed messages take tokens in advance, until the delay would exceed
+    # MAX_DELAY, and the debt is paid back before the next message.
+    limiter = ratelimit.RateLimiter([('a', 1, 1)], policy=ratelimit.DELAY)
+    delays = [limiter.check('a', None, 0) for _ in range(8)]
+    assert delays == [0.0, 1.0, 2.0, 3.0, 4.0, 5.0, None, None], delays
+    assert limiter.check('a', None, 5.5) == 0.5
+    assert limiter.check('a', None, 7) == 0.0
+    assert limiter.check('a', None, 7) == 1.0
+
+
 if __name__ == '__main__':
     import logging
     import sys
     logging.basicConfig(level=logging.INFO)
 
-    d = test_basic()
+    # The worker pool forks, so it's started before the reactor runs any
+    # thread.
+    d = test_codec_pool()
+    d.addCallback(lambda _: test_basic())
     d.addCallback(lambda _: test_connect_replay())
     d.addCallback(lambda _: test_no_self_connect())
+    d.addCallback(lambda _: test_peer())
+    d.addCallback(lambda _: test_unsubscribe_linger())
+    d.addCallback(lambda _: test_retain_publish())
+    d.addCallback(lambda _: test_reactor_monitor())
+    d.addCallback(lambda _: test_heavy_hitters())
+    d.addCallback(lambda _: test_codec_order())
+    d.addCallback(lambda _: test_drain())
+    d.addCallback(lambda _: test_drained_discovery())
+    d.addCallback(lambda _: test_heartbeat())
+    d.addCallback(lambda _: test_fair_queueing())
+    d.addCallback(lambda _: test_resume_state())
+    d.addCallback(lambda _: test_resume_reconnect(19710, 1))
+    d.addCallback(lambda _: test_resume_reconnect(19720, None))
+    d.addCallback(lambda _: test_outbound_priorities())
+    d.addCallback(lambda _: test_fragments())
+    d.addCallback(lambda _: test_topic_aliases())
+    d.addCallback(lambda _: test_last_values())
+    d.addCallback(lambda _: test_filters())
+    d.addCallback(lambda _: test_delta_patches())
+    d.addCallback(lambda _: test_delta_resync())
+    d.addCallback(lambda _: test_hash_ring())
+    d.addCallback(lambda _: test_relay_loops())
+    d.addCallback(lambda _: test_subscriber_counts())
+    d.addCallback(lambda _: test_dedup_window())
+    d.addCallback(lambda _: test_capture())
+    d.addCallback(lambda _: test_rate_limits())
     exit_code = 0
 
     def errback(err):
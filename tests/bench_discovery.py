@@ -0,0 +1,375 @@
+"""
+Benchmark of how fast consumers discovering producers through Consul
+reconverge after membership changes, and of the load they put on Consul.
+
+A fake Consul agent serves the health API (with blocking queries) for a set
+of local producer servers, while consumer clients follow it with
+:class:`pubsubclub.consul.ConsulDiscovery`.  Churn patterns are scripted
+against the catalog:
+
+* ``scale-out`` -- producers join one at a time.
+* ``rolling-restart`` -- producers are stopped, taken out of the catalog and
+  brought back one at a time.  With ``--drain``, they are taken out of the
+  catalog first and drained rather than stopped abruptly.
+* ``flapping`` -- a producer's health check fails and recovers repeatedly,
+  the producer itself staying up.
+
+For each change, the time until every consumer is connected to exactly the
+producers in the catalog is measured.  The connects and disconnects issued
+by discovery, the requests made to Consul and the publishes missed by the
+consumers are reported for each pattern.
+
+Run with ``python tests/bench_discovery.py --help`` for the options.
+
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.python import log
+from twisted.web import resource, server
+from twisted.web.server import NOT_DONE_YET
+
+from autobahn.twisted import websocket
+
+from pubsubclub import consul, consumer, discovery
+from pubsubclub.base import make_client
+from pubsubclub.producer import ProducerServer
+
+
+SERVICE = 'bench-producers'
+TOPIC = 'http://example.com/bench'
+
+
+def sleep(seconds):
+    return deferLater(reactor, seconds, lambda: None)
+
+
+class FakeConsul(resource.Resource):
+    """
+    Serves the health API of a service, counting the requests made.
+
+    """
+    isLeaf = True
+
+    def __init__(self):
+        resource.Resource.__init__(self)
+        #: The instances in the catalog, as ``(port, id)`` pairs.
+        self.instances = set()
+        self.index = 1
+        self.requests = 0
+        self.waiting = []
+
+    def set_instances(self, instances):
+        self.instances = set(instances)
+        self.index += 1
+        waiting, self.waiting = self.waiting, []
+        for request, timeout in waiting:
+            timeout.cancel()
+            self._respond(request)
+
+    def add(self, port, id):
+        self.set_instances(self.instances | set([(port, id)]))
+
+    def remove(self, port, id):
+        self.set_instances(self.instances - set([(port, id)]))
+
+    def render_GET(self, request):
+        self.requests += 1
+        if request.path != '/v1/health/service/{0}'.format(SERVICE):
+            request.setResponseCode(404)
+            return ''
+        index = int(request.args.get('index', [0])[0] or 0)
+        wait = request.args.get('wait', [None])[0]
+        if wait and index == self.index:
+            # A blocking query, answered on change or once the wait is over.
+            entry = [request, None]
+            entry[1] = reactor.callLater(
+                float(wait.rstrip('s')), self._timeout, entry,
+            )
+            self.waiting.append(entry)
+            request.notifyFinish().addErrback(
+                lambda _: entry in self.waiting and self.waiting.remove(entry)
+            )
+            return NOT_DONE_YET
+        return self._body(request)
+
+    def _timeout(self, entry):
+        self.waiting.remove(entry)
+        self._respond(entry[0])
+
+    def _respond(self, request):
+        request.write(self._body(request))
+        request.finish()
+
+    def _body(self, request):
+        request.setHeader('X-Consul-Index', str(self.index))
+        return json.dumps([{
+            'Node': {'Node': 'bench', 'Address': '127.0.0.1'},
+            'Service': {
+                'ID': '{0}-{1}'.format(SERVICE, id),
+                'Service': SERVICE,
+                'Port': port,
+                'Meta': {consul.ID_KEY: str(id)},
+            },
+            'Checks': [],
+        } for port, id in sorted(self.instances)])
+
+
+class Producer(object):
+    """
+    A producer server publishing numbered messages while it's up.
+
+    """
+    def __init__(self, port, id, rate):
+        self.port = port
+        self.id = id
+        self.server = ProducerServer('127.0.0.1', port, id=id)
+        self.seq = 0
+        self.publishing = LoopingCall(self.publish)
+        self.publishing.start(1.0 / rate)
+
+    def publish(self):
+        self.seq += 1
+        self.server.publish(TOPIC, {'id': self.id, 'seq': self.seq})
+
+    def stop(self):
+        self.publishing.stop()
+        self.server.listener.stopListening()
+        for node in list(self.server.nodes):
+            node.transport.loseConnection()
+
+    def drain(self):
+        self.publishing.stop()
+        return self.server.drain()
+
+    def start(self, rate):
+        self.server.draining = False
+        self.server.listener = websocket.listenWS(self.server)
+        self.publishing.start(1.0 / rate)
+
+
+class BenchContainer(object):
+    """
+    Container methods for the consumers, counting what discovery asks of them
+    and the publishes they miss.
+
+    """
+    def setup(self, *args, **kwargs):
+        super(BenchContainer, self).setup(*args, **kwargs)
+        self.connects = 0
+        self.disconnects = 0
+        self.missed = 0
+        self.received = 0
+        #: The last sequence number received by producer ID.
+        self.last_seq = dict()
+
+    def connect(self, host, port, id=None):
+        self.connects += 1
+        super(BenchContainer, self).connect(host, port, id=id)
+
+    def disconnect(self, host, port):
+        self.disconnects += 1
+        super(BenchContainer, self).disconnect(host, port)
+
+    def subscribed_topics(self):
+        return set([TOPIC])
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        self.received += 1
+        last = self.last_seq.get(message['id'])
+        if last is not None and message['seq'] > last + 1:
+            self.missed += message['seq'] - last - 1
+        if last is None or message['seq'] > last:
+            self.last_seq[message['id']] = message['seq']
+
+    def connected_ids(self):
+        return set(node.remote_id for node in self.nodes if node.ready)
+
+
+BenchConsumer = make_client(
+    'BenchConsumer', consumer.PASSTHROUGH, consumer.ConsumerProtocol,
+    (BenchContainer, consumer.ConsumerContainer),
+)
+
+
+class Bench(object):
+    def __init__(self, args):
+        self.args = args
+        self.consul = FakeConsul()
+        reactor.listenTCP(args.consul_port, server.Site(self.consul))
+        consul_url = 'http://127.0.0.1:{0}/'.format(args.consul_port)
+        self.producers = []
+        self.consumers = []
+        for i in range(args.consumers):
+            client = BenchConsumer(id=100000 + i)
+            consul.ConsulDiscovery(
+                consul_url, SERVICE, client, debounce=args.debounce,
+            ).start()
+            self.consumers.append(client)
+
+    def add_producer(self):
+        id = len(self.producers) + 1
+        producer = Producer(self.args.base_port + id, id, self.args.rate)
+        self.producers.append(producer)
+        self.consul.add(producer.port, producer.id)
+        return producer
+
+    def expected_ids(self):
+        return set(id for _, id in self.consul.instances)
+
+    @inlineCallbacks
+    def converge(self):
+        """
+        Wait for every consumer to be connected to the producers in the
+        catalog.
+
+        :returns:  A deferred firing with the seconds it took, or ``None``
+            on timeout.
+
+        """
+        started = time.time()
+        while time.time() - started < self.args.timeout:
+            expected = self.expected_ids()
+            if all(
+                    client.connected_ids() == expected
+                    for client in self.consumers
+            ):
+                returnValue(time.time() - started)
+            yield sleep(0.05)
+        returnValue(None)
+
+    def totals(self):
+        return {
+            'connects': sum(client.connects for client in self.consumers),
+            'disconnects': sum(
+                client.disconnects for client in self.consumers
+            ),
+            'http_requests': self.consul.requests,
+            'missed': sum(client.missed for client in self.consumers),
+            'received': sum(client.received for client in self.consumers),
+        }
+
+    @inlineCallbacks
+    def measure(self, name, steps):
+        """
+        Run a churn pattern, given as a list of functions making a change.
+
+        """
+        before = self.totals()
+        times = []
+        for step in steps:
+            yield step()
+            times.append((yield self.converge()))
+            yield sleep(self.args.pause)
+        after = self.totals()
+        converged = [elapsed for elapsed in times if elapsed is not None]
+        print('{0}:'.format(name))
+        print('  changes            {0}'.format(len(times)))
+        print('  timeouts           {0}'.format(len(times) - len(converged)))
+        if converged:
+            print('  convergence mean   {0:.3f}s'.format(
+                sum(converged) / len(converged),
+            ))
+            print('  convergence max    {0:.3f}s'.format(max(converged)))
+        for key in sorted(after):
+            print('  {0:18} {1}'.format(key, after[key] - before[key]))
+
+    def scale_out(self):
+        return self.measure('scale-out', [
+            self.add_producer for _ in range(self.args.producers)
+        ])
+
+    def rolling_restart(self):
+        steps = []
+        for producer in list(self.producers):
+            def stop(producer=producer):
+                if self.args.drain:
+                    self.consul.remove(producer.port, producer.id)
+                    return producer.drain()
+                producer.stop()
+                self.consul.remove(producer.port, producer.id)
+
+            def start(producer=producer):
+                producer.start(self.args.rate)
+                self.consul.add(producer.port, producer.id)
+
+            steps.extend([stop, start])
+        return self.measure('rolling-restart', steps)
+
+    def flapping(self):
+        producer = self.producers[0]
+
+        def fail():
+            self.consul.remove(producer.port, producer.id)
+
+        def recover():
+            self.consul.add(producer.port, producer.id)
+
+        steps = [fail, recover] * self.args.flaps
+        return self.measure('flapping', steps)
+
+    @inlineCallbacks
+    def run(self):
+        patterns = self.args.patterns
+        # Scaling out also brings up the producers for the other patterns.
+        yield self.scale_out()
+        if 'rolling-restart' in patterns:
+            yield self.rolling_restart()
+        if 'flapping' in patterns:
+            yield self.flapping()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--producers', type=int, default=5)
+    parser.add_argument('--consumers', type=int, default=5)
+    parser.add_argument(
+        '--patterns', nargs='+',
+        default=['scale-out', 'rolling-restart', 'flapping'],
+        choices=['scale-out', 'rolling-restart', 'flapping'],
+    )
+    parser.add_argument('--flaps', type=int, default=5)
+    parser.add_argument(
+        '--drain', action='store_true',
+        help='drain the producers of a rolling restart',
+    )
+    parser.add_argument(
+        '--rate', type=float, default=20.0,
+        help='publishes per second per producer',
+    )
+    parser.add_argument(
+        '--debounce', type=float, default=discovery.DEBOUNCE_PERIOD,
+        help='seconds ConsulDiscovery waits before applying changes',
+    )
+    parser.add_argument(
+        '--pause', type=float, default=1.0,
+        help='seconds between changes, once converged',
+    )
+    parser.add_argument('--timeout', type=float, default=120.0)
+    parser.add_argument('--consul-port', type=int, default=18500)
+    parser.add_argument('--base-port', type=int, default=19500)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.startLogging(sys.stdout)
+    consul.MIN_QUERY_PERIOD = 0.0
+
+    def failed(failure):
+        failure.printTraceback()
+
+    d = Bench(args).run()
+    d.addErrback(failed)
+    d.addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,231 @@
+"""
+Scale test of the memory used per link and per subscription.
+
+A producer process listens on a few ports, and this process runs a consumer
+opening ``--links`` connections to it, subscribed to ``--topics`` topics
+each.  The resident memory of both processes is sampled with no links, once
+the links are up, and once every link is subscribed, and the cost of a link
+and of a subscription is reported for each side.
+
+Needs Linux (for ``/proc``) and a file descriptor limit above twice the
+links, as both ends of every link live on this host::
+
+    ulimit -n 30000
+    python tests/scale_links.py --links 10000 --topics 100
+
+"""
+from __future__ import print_function
+
+import argparse
+import resource
+import subprocess
+import sys
+import time
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.python import log
+
+from pubsubclub import consumer
+from pubsubclub.base import make_client
+from pubsubclub.producer import ProducerServer
+
+
+BATCH = 200  # Links opened at a time, to stay within the listen backlogs
+
+
+def sleep(seconds):
+    return deferLater(reactor, seconds, lambda: None)
+
+
+def rss(pid='self'):
+    """
+    The resident memory of a process, in bytes.
+
+    """
+    with open('/proc/{0}/status'.format(pid)) as status:
+        for line in status:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) * 1024
+    return None
+
+
+def raise_file_limit(needed):
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < needed:
+        soft = needed if hard == resource.RLIM_INFINITY else min(needed, hard)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+    return soft
+
+
+def serve(args):
+    """
+    Run the producer side.
+
+    """
+    raise_file_limit(args.links + 100)
+    for index in range(args.ports):
+        ProducerServer('127.0.0.1', args.base_port + index)
+    reactor.run()
+
+
+class ScaleContainer(object):
+    """
+    Container methods for the consumer of the scale test, whose topics are
+    set by the test rather than by WAMP users.
+
+    """
+    #: The topics subscribed to.
+    topics = frozenset()
+
+    def subscribed_topics(self):
+        return set(self.topics)
+
+    def forward(self, topic, message, via=(), origin=None, targets=None):
+        pass
+
+
+ScaleConsumerClient = make_client(
+    'ScaleConsumerClient', consumer.PASSTHROUGH, consumer.ConsumerProtocol,
+    (ScaleContainer, consumer.ConsumerContainer),
+)
+
+
+class ScaleTest(object):
+    def __init__(self, args):
+        self.args = args
+        self.producer = None
+        self.consumer = ScaleConsumerClient()
+        self.samples = []
+
+    def sample(self, name):
+        sample = (name, rss(), rss(self.producer.pid))
+        self.samples.append(sample)
+        print('{0:12} consumer {1:>8.1f} MB  producer {2:>8.1f} MB'.format(
+            name, sample[1] / 1e6, sample[2] / 1e6,
+        ))
+
+    @inlineCallbacks
+    def settle(self, check):
+        """
+        Wait for a condition to hold, and for the producer's memory to stop
+        growing.
+
+        """
+        started = time.time()
+        while not check():
+            if time.time() - started > self.args.timeout:
+                raise RuntimeError('Timed out')
+            yield sleep(0.5)
+        last = None
+        while last != rss(self.producer.pid):
+            last = rss(self.producer.pid)
+            yield sleep(1.0)
+        returnValue(None)
+
+    def ready_links(self):
+        return sum(1 for node in self.consumer.nodes if node.ready)
+
+    def subscribed_links(self):
+        return sum(
+            1 for node in self.consumer.nodes
+            if len(node.subscribed) == self.args.topics
+        )
+
+    @inlineCallbacks
+    def run(self):
+        args = self.args
+        self.producer = subprocess.Popen([
+            sys.executable, __file__, '--serve', '--links', str(args.links),
+            '--ports', str(args.ports), '--base-port', str(args.base_port),
+        ])
+        yield sleep(2.0)
+        self.sample('idle')
+
+        for index in range(args.links):
+            port = args.base_port + index % args.ports
+            self.consumer.connect('127.0.0.1', port)
+            if index % BATCH == BATCH - 1:
+                yield sleep(0.1)
+        yield self.settle(lambda: self.ready_links() >= args.links)
+        self.sample('links')
+
+        self.consumer.topics = frozenset(
+            'http://example.com/scale/{0}'.format(index)
+            for index in range(args.topics)
+        )
+        for topic in self.consumer.topics:
+            self.consumer.subscribe(topic)
+            yield sleep(0)
+        yield self.settle(lambda: self.subscribed_links() >= args.links)
+        self.sample('subscribed')
+        self.report()
+
+    def report(self):
+        args = self.args
+        subscriptions = args.links * args.topics
+        (_, idle_c, idle_p), (_, links_c, links_p), (_, subs_c, subs_p) = (
+            self.samples
+        )
+        print('{0} links, {1} subscriptions'.format(args.links, subscriptions))
+        for side, idle, links, subs in (
+                ('consumer', idle_c, links_c, subs_c),
+                ('producer', idle_p, links_p, subs_p),
+        ):
+            print('{0}:  {1:.0f} bytes per link, {2:.0f} per subscription'
+                  .format(
+                      side,
+                      float(links - idle) / args.links,
+                      float(subs - links) / subscriptions,
+                  ))
+
+    def stop(self):
+        if self.producer is not None:
+            self.producer.terminate()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--links', type=int, default=10000)
+    parser.add_argument(
+        '--topics', type=int, default=100,
+        help='topics each link is subscribed to',
+    )
+    parser.add_argument(
+        '--ports', type=int, default=10,
+        help='ports the producer listens on',
+    )
+    parser.add_argument('--base-port', type=int, default=19700)
+    parser.add_argument('--timeout', type=float, default=600.0)
+    parser.add_argument('--serve', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--verbose', action='store_true')
+    args = parser.parse_args()
+
+    if args.verbose:
+        log.startLogging(sys.stdout)
+    if args.serve:
+        serve(args)
+        return
+    limit = raise_file_limit(args.links + 100)
+    if limit < args.links + 100:
+        print('File descriptor limit of {0} is too low.'.format(limit))
+        sys.exit(1)
+
+    test = ScaleTest(args)
+
+    def failed(failure):
+        failure.printTraceback()
+
+    def done(_):
+        test.stop()
+        reactor.stop()
+
+    d = test.run()
+    d.addErrback(failed)
+    d.addBoth(done)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    main()
@@ -19,7 +19,7 @@ node_change = Deferred()
 change_index = 0
 
 
-consul.DEBOUNCE_PERIOD = 1.0
+DEBOUNCE = 1.0
 consul.MIN_QUERY_PERIOD = 0.0
 
 
@@ -58,7 +58,10 @@ class ConsulMock(resource.Resource):
                 'Service': {
                     'ID': 'pubsub',
                     'Service': 'pubsub',
-                    'Tags': None,
+                    'Tags': (
+                        None if id is None
+                        else ['{0}={1}'.format(consul.ID_KEY, id)]
+                    ),
                     'Port': port,
                 },
                 'Checks': [{
@@ -71,7 +74,9 @@ class ConsulMock(resource.Resource):
                     'ServiceID': 'pubsub',
                     'ServiceName': 'pubsub',
                 }],
-            } for (node, address, port) in nodes])
+            } for (node, address, port, id) in (
+                tuple(item) + (None,) * (4 - len(item)) for item in nodes
+            )])
             log.msg('ConsulMock:  Index is %i', change_index)
             request.setHeader('X-Consul-Index', str(change_index))
             log.msg('ConsulMock:  Content is:  %s', response)
@@ -87,10 +92,12 @@ class ConsulMock(resource.Resource):
 
 
 class ClientMock(object):
+    id = 42
+
     def __init__(self):
         self.connections = set()
 
-    def connect(self, host, port):
+    def connect(self, host, port, id=None):
         self.connections.add((host, port))
 
     def disconnect(self, host, port):
@@ -105,7 +112,7 @@ if __name__ == '__main__':
     reactor.listenTCP(18101, site)
 
     discovery = consul.ConsulDiscovery(
-        'http://localhost:18101/', 'consul', client,
+        'http://localhost:18101/', 'consul', client, debounce=DEBOUNCE,
     )
     discovery.start()
 
@@ -142,7 +149,7 @@ if __name__ == '__main__':
                     '{0!r} != {1!r}'.format(client.connections, compare)
                 )
 
-        return deferLater(reactor, consul.DEBOUNCE_PERIOD + 0.1, assertions)
+        return deferLater(reactor, DEBOUNCE + 0.1, assertions)
 
     def test_debounce(self):
         """
@@ -184,16 +191,45 @@ if __name__ == '__main__':
                     '{0!r} != {1!r}'.format(client.connections, compare)
                 )
 
-        d = deferLater(reactor, consul.DEBOUNCE_PERIOD * 2 / 3, first_test)
+        d = deferLater(reactor, DEBOUNCE * 2 / 3, first_test)
         return d.addCallback(lambda _: deferLater(
-            reactor, consul.DEBOUNCE_PERIOD * 2 / 3, second_test
+            reactor, DEBOUNCE * 2 / 3, second_test
         ))
 
+    def test_skip_self(self):
+        """
+        Test that a node announcing our own ID is never connected to.
+
+        """
+        change_nodes([
+            ('test1', '192.168.1.1', 123),
+            ('test3', '192.168.1.3', 125),
+            ('test4', '192.168.1.4', 321),
+            ('test5', '192.168.1.5', 322, ClientMock.id),
+            ('test6', '192.168.1.6', 323, ClientMock.id + 1),
+        ])
+
+        def assertions():
+            compare = set([
+                ('192.168.1.1', 123),
+                ('192.168.1.3', 125),
+                ('192.168.1.4', 321),
+                ('192.168.1.6', 323),
+            ])
+            if client.connections != compare:
+                raise AssertionError(
+                    '{0!r} != {1!r}'.format(client.connections, compare)
+                )
+
+        return deferLater(reactor, DEBOUNCE + 0.1, assertions)
+
     d = deferLater(reactor, 0.1, test_setup)
     d.addCallback(lambda _: deferLater(reactor, 0.5, lambda: None))
     d.addCallback(test_change)
     d.addCallback(lambda _: deferLater(reactor, 0.5, lambda: None))
     d.addCallback(test_debounce)
+    d.addCallback(lambda _: deferLater(reactor, 0.5, lambda: None))
+    d.addCallback(test_skip_self)
 
     def errback(err):
         # On error, print and then exit with a 2
@@ -0,0 +1,137 @@
+"""
+Test of :class:`pubsubclub.discovery.FileDiscovery`, following a list of
+servers in a temporary file as it is rewritten and replaced.  Needs Linux.
+
+"""
+import os
+import shutil
+import tempfile
+
+from twisted.python import log
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+
+from pubsubclub import discovery
+
+
+DEBOUNCE = 0.5
+
+
+class ClientMock(object):
+    id = 42
+
+    def __init__(self):
+        self.connections = set()
+
+    def connect(self, host, port, id=None):
+        self.connections.add((host, port))
+
+    def disconnect(self, host, port):
+        self.connections.remove((host, port))
+
+
+def check(client, compare):
+    if client.connections != set(compare):
+        raise AssertionError(
+            '{0!r} != {1!r}'.format(client.connections, set(compare))
+        )
+
+
+if __name__ == '__main__':
+    import sys
+    log.startLogging(sys.stdout)
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'nodes')
+    with open(path, 'w') as nodes:
+        nodes.write('192.168.1.1:123\n192.168.1.2:124  # second\n')
+
+    client = ClientMock()
+    watcher = discovery.FileDiscovery(path, client, debounce=DEBOUNCE)
+    watcher.start()
+
+    def test_setup():
+        check(client, [('192.168.1.1', 123), ('192.168.1.2', 124)])
+
+    def test_rewrite(_):
+        """
+        Test rewriting the file in place, skipping a server with our ID.
+
+        """
+        with open(path, 'w') as nodes:
+            nodes.write(
+                '192.168.1.1:123\n'
+                '192.168.1.3:125 7\n'
+                '192.168.1.4:126 {0}\n'.format(ClientMock.id)
+            )
+
+        def assertions():
+            check(client, [('192.168.1.1', 123), ('192.168.1.3', 125)])
+
+        return deferLater(reactor, DEBOUNCE + 0.2, assertions)
+
+    def test_malformed(_):
+        """
+        Test that a malformed list is ignored.
+
+        """
+        with open(path, 'w') as nodes:
+            nodes.write('not a server\n')
+
+        def assertions():
+            check(client, [('192.168.1.1', 123), ('192.168.1.3', 125)])
+            if watcher.stats().get('errors') != 1:
+                raise AssertionError(repr(watcher.stats()))
+
+        return deferLater(reactor, DEBOUNCE + 0.2, assertions)
+
+    def test_replace(_):
+        """
+        Test renaming a new file over the list.
+
+        """
+        replacement = os.path.join(directory, 'nodes.new')
+        with open(replacement, 'w') as nodes:
+            nodes.write('192.168.1.5:127\n')
+        os.rename(replacement, path)
+
+        def assertions():
+            check(client, [('192.168.1.5', 127)])
+            if watcher.stats()['nodes'] != 1:
+                raise AssertionError(repr(watcher.stats()))
+
+        return deferLater(reactor, DEBOUNCE + 0.2, assertions)
+
+    def test_remove(_):
+        """
+        Test removing the file, which lists no servers.
+
+        """
+        os.remove(path)
+        return deferLater(reactor, DEBOUNCE + 0.2, lambda: check(client, []))
+
+    d = deferLater(reactor, 0.1, test_setup)
+    d.addCallback(test_rewrite)
+    d.addCallback(test_malformed)
+    d.addCallback(test_replace)
+    d.addCallback(test_remove)
+
+    failures = []
+
+    def errback(err):
+        # On error, print, stop and then exit with a 2
+        failures.append(err)
+        err.printTraceback()
+        reactor.stop()
+
+    def cleanup(result):
+        watcher.stop()
+        shutil.rmtree(directory)
+        return result
+
+    d.addBoth(cleanup)
+    d.addCallback(lambda _: reactor.stop())
+    d.addErrback(errback)
+
+    reactor.run()
+    if failures:
+        sys.exit(2)